@@ -0,0 +1,202 @@
+import importlib
+import json
+import sys
+from time import perf_counter
+import numpy as np
+
+from utils import chgcar, io2, metrics_store
+
+"""
+sys.argv[1] = chgcar_folder
+sys.argv[2] = codec, pyrho/sz3/tthresh
+sys.argv[3] = target metric, one of mae/rmse/max_abs_error/rel_l2/avg_percentage_diff (upper bound), psnr/ratio (lower bound)
+sys.argv[4] = target value
+sys.argv[5] = sections the error target applies to, comma separated (default charge)
+sys.argv[6] = max trials per bisection (default 12)
+sys.argv[7] = pyrho smear_std candidates, comma separated (default 0.05,0.1,0.2)
+
+Per file, bisects the codec's knob (sz3 relative bound, pyrho dims_divisor, tthresh -e) over one in-memory parse and keeps
+the most aggressive setting that meets an error target, or the most accurate one that meets a ratio target. Trials are
+memoized and the search stops early within TARGET_TOLERANCE of the target. The chosen container is left in place as
+{chgcar}_{codec}.chgz and the choices are recorded in the metrics store as autotune_{codec}_{target}_{value}.
+Knobs are assumed monotone: a more aggressive setting never lowers the error or the ratio.
+
+pyrho has a second knob: dims_divisor is bisected once per smear_std candidate, and the most aggressive divisor that meets
+the target wins, ties going to the smear with the lower rmse. sz3 and tthresh have one knob each: the brick size does not
+change sz3's error, and tthresh's -r and -p bound the same error as -e in other units.
+Every trial hands the codec its parameters as a params dict, sys.argv is never touched.
+"""
+
+CODEC_MODULES = {"pyrho": "pyrho_custom", "sz3": "sz3", "tthresh": "tthresh"}
+# Candidates ordered from least to most aggressive
+CODEC_KNOBS = {
+    "pyrho": ("dims_divisor", list(range(1, 17))),
+    "sz3": ("rel_error", [float(v) for v in np.geomspace(1e-7, 1e-1, 49)]),
+    "tthresh": ("e", [float(v) for v in np.geomspace(1e-7, 1e-1, 49)]),
+}
+HIGHER_IS_BETTER_TARGETS = ("psnr", "ratio")
+TARGET_TOLERANCE = 0.05
+SMEAR_CANDIDATES = [0.05, 0.1, 0.2]
+
+
+def codec_params(codec: str, value, smear_std: float = None):
+    # The params dict the codec's functions take, parsed the way its sys.argv[3:] would be
+    if codec == "pyrho":
+        return {"dims_divisor": int(value), "smear_std": float(smear_std)}
+    if codec == "tthresh":
+        return {"target": "-e", "value": float(value)}
+    return {"rel_error": float(value), "brick_size": 0, "brick_workers": None}
+
+
+def compress_grids(module, codec: str, charge, mag, dims: list[int], params: dict):
+    if codec == "pyrho":
+        return module.compress_func(charge, mag, dims, params)[:2]
+    if codec == "sz3":
+        return module.compress_func(charge.grid_data, mag.grid_data, params)[:2]
+    return [compressed for compressed, _ in module.compress_pair(charge.grid_data, mag.grid_data, dims, params)]
+
+
+def decompress_grids(module, codec: str, file_no_ext: str, charge_compressed, mag_compressed, lattice, dims: list[int], params: dict):
+    # Only sz3 decompression has a parameter, its brick workers
+    if codec == "sz3":
+        return module.decompress_data(file_no_ext, charge_compressed, mag_compressed, lattice, dims, params)[1:3]
+    return module.decompress_data(file_no_ext, charge_compressed, mag_compressed, lattice, dims)[1:3]
+
+
+def run_trial(module, codec: str, file_no_ext: str, parsed, params: dict):
+    structure, charge, mag, data_aug, dims, fs = parsed
+
+    time_start = perf_counter()
+    charge_compressed, mag_compressed = compress_grids(module, codec, charge, mag, dims, params)
+    compress_duration = perf_counter() - time_start
+    module.store_compressed(file_no_ext, charge_compressed, mag_compressed, structure, data_aug, dims, params)
+    compressed_fs = io2.get_file_size_mb(chgcar.container_file(file_no_ext, codec))
+    chgcar.pop_container_metrics(file_no_ext)
+
+    time_start = perf_counter()
+    charge_decompressed, mag_decompressed = decompress_grids(module, codec, file_no_ext, charge_compressed, mag_compressed, structure.lattice.matrix, dims, params)
+    decompress_duration = perf_counter() - time_start
+    voxel_volume = structure.volume / charge.grid_data.size
+    metrics = chgcar.grid_error_metrics({
+        "charge": (charge.grid_data, charge_decompressed.grid_data, voxel_volume),
+        "mag": (mag.grid_data, mag_decompressed.grid_data, voxel_volume),
+    })
+    metrics["compressed_file_size"] = compressed_fs
+    metrics["ratio"] = fs / compressed_fs
+    metrics["compress_duration"] = compress_duration
+    metrics["decompress_duration"] = decompress_duration
+
+    return metrics, (charge_compressed, mag_compressed)
+
+
+def target_value(metrics: dict, target: str, sections: list[str]):
+    if target == "ratio":
+        return metrics["ratio"]
+    values = [metrics[f"{section}_{target}"] for section in sections]
+    return min(values) if target in HIGHER_IS_BETTER_TARGETS else max(values)
+
+
+def meets_target(value: float, target: str, goal: float):
+    return value >= goal if target in HIGHER_IS_BETTER_TARGETS else value <= goal
+
+
+def near_target(value: float, target: str, goal: float):
+    # Close enough that further trials would barely move the result
+    return abs(value - goal) <= TARGET_TOLERANCE * abs(goal)
+
+
+def bisect(trial, candidates: list, target: str, goal: float, sections: list[str], max_trials: int):
+    # Error targets hold for a prefix of the candidates (bisect for its end), a ratio target for a suffix (bisect for its start)
+    prefix = target != "ratio"
+    lo, hi, best, tried = 0, len(candidates) - 1, None, set()
+    while lo <= hi and len(tried) < max_trials:
+        mid = (lo + hi) // 2
+        tried.add(mid)
+        metrics, _ = trial(mid)
+        value = target_value(metrics, target, sections)
+        if meets_target(value, target, goal):
+            best = mid
+            if near_target(value, target, goal):
+                break
+            lo, hi = (mid + 1, hi) if prefix else (lo, mid - 1)
+        else:
+            lo, hi = (lo, mid - 1) if prefix else (mid + 1, hi)
+
+    # Nothing met the target: fall back to the trial closest to it
+    if best is None:
+        return (min(tried) if prefix else max(tried)), False
+    return best, True
+
+
+def tune_file(module, codec: str, file: str, target: str, goal: float, sections: list[str], max_trials: int, smear_stds: list[float]):
+    file_no_ext = file.split(".")[0]
+    parsed = chgcar.parse_chgcar_pymatgen(file)
+    knob, candidates = CODEC_KNOBS[codec]
+    prefix = target != "ratio"
+    trials = {}
+
+    # One bisection per value of the second knob, only pyrho has one
+    choices = []
+    for smear_std in (smear_stds if codec == "pyrho" else [None]):
+        def trial(index):
+            if (smear_std, index) not in trials:
+                trials[smear_std, index] = run_trial(module, codec, file_no_ext, parsed, codec_params(codec, candidates[index], smear_std))
+            return trials[smear_std, index]
+
+        best, met = bisect(trial, candidates, target, goal, sections, max_trials)
+        choices.append((smear_std, best, met))
+
+    def choice_key(choice):
+        # Met targets first, then the most aggressive setting (or the closest miss), then the lower rmse
+        smear_std, index, met = choice
+        metrics, _ = trials[smear_std, index]
+        closeness = (index if prefix else -index) if met else -abs(target_value(metrics, target, sections) - goal)
+        return met, closeness, -target_value(metrics, "rmse", sections)
+
+    smear_std, best, met = max(choices, key=choice_key)
+    metrics, (charge_compressed, mag_compressed) = trials[smear_std, best]
+    params = codec_params(codec, candidates[best], smear_std)
+    structure, _, _, data_aug, dims, fs = parsed
+    module.store_compressed(file_no_ext, charge_compressed, mag_compressed, structure, data_aug, dims, params)
+    chgcar.pop_container_metrics(file_no_ext)
+
+    return file_no_ext, {
+        **metrics,
+        knob: candidates[best],
+        **({"smear_std": smear_std} if smear_std is not None else {}),
+        "target_met": met,
+        "trials": len(trials),
+        "orig_file_size": fs,
+    }
+
+
+def main():
+    folder = sys.argv[1]
+    codec = sys.argv[2]
+    target = sys.argv[3]
+    goal = float(sys.argv[4])
+    sections = sys.argv[5].split(",") if len(sys.argv) > 5 else ["charge"]
+    max_trials = int(sys.argv[6]) if len(sys.argv) > 6 else 12
+    smear_stds = [float(v) for v in sys.argv[7].split(",")] if len(sys.argv) > 7 else SMEAR_CANDIDATES
+
+    if not io2.check_dir(folder):
+        print("Invalid directory")
+        sys.exit(1)
+    if codec not in CODEC_MODULES:
+        print(f"No auto-tuning for {codec}, choose from {', '.join(CODEC_MODULES)}")
+        sys.exit(1)
+
+    module = importlib.import_module(CODEC_MODULES[codec])
+    files = [file for file in io2.get_files_in_dir(folder) if file.endswith(".vasp") and not any(file.endswith(f"_{c}.vasp") for c in CODEC_MODULES)]
+
+    all_metrics = {}
+    for file in sorted(files):
+        file_no_ext, file_metrics = tune_file(module, codec, file, target, goal, sections, max_trials, smear_stds)
+        all_metrics[file_no_ext] = file_metrics
+        print(file_no_ext, json.dumps(file_metrics, sort_keys=True))
+
+    metrics_store.record_metrics(all_metrics, codec, {"target": target, "value": goal, "sections": ",".join(sections)}, f"autotune_{codec}_{target}_{goal}")
+
+
+if __name__ == "__main__":
+    main()
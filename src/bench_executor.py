@@ -0,0 +1,69 @@
+import os
+import sys
+from time import perf_counter
+
+from utils import cache, chgcar, io2
+
+"""
+sys.argv[1] = chgcar_folder
+sys.argv[2] = max number of workers (default cpu count)
+sys.argv[3] = comma separated backends (default serial,threads,processes)
+"""
+
+
+# Parse, remake and write back, the GIL-bound part every compressor shares
+def roundtrip_file_helper(file: str, file_no_ext: str):
+    time_start = perf_counter()
+
+    structure, charge, mag, data_aug, dims, fs = chgcar.parse_chgcar_pymatgen(file)
+    vasp_cden = chgcar.remake_chgcar_pymatgen(charge, mag, structure, data_aug)
+    chgcar.write_chgcar_pymatgen(vasp_cden, f"{file_no_ext}_bench_executor.txt")
+
+    time_end = perf_counter()
+
+    return file_no_ext, charge, mag, time_end - time_start, fs, 0, 0
+
+
+def time_compress_dir(files: list[str], backend: str, max_workers: int):
+    time_start = perf_counter()
+    orig_values, metrics = io2.compress_dir(files, roundtrip_file_helper, "bench", backend=backend, max_workers=max_workers)
+    time_end = perf_counter()
+
+    io2.delete_files([f"{file_no_ext}_bench_executor.txt" for file_no_ext in orig_values])
+
+    # The processes backend should hand the grids back through /dev/shm rather than the pipe
+    if backend == "processes" and not all(file_metrics.get("shared_grids") for file_metrics in metrics.values()):
+        print("Warning: grids were pickled through the pipe instead of shared memory")
+
+    return time_end - time_start
+
+
+def main():
+    folder = sys.argv[1]
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    backends = sys.argv[3].split(",") if len(sys.argv) > 3 else ["serial", "threads", "processes"]
+
+    if not io2.check_dir(folder):
+        print("Invalid directory")
+        sys.exit(1)
+    files = [file for file in io2.get_files_in_dir(folder) if file.endswith(".vasp")]
+
+    # Every run has to parse, otherwise later runs only measure cache hits
+    cache.CACHE_DIR = ""
+
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= max_workers:
+        worker_counts.append(worker_counts[-1] * 2)
+    if worker_counts[-1] != max_workers:
+        worker_counts.append(max_workers)
+
+    print(folder, "Files: ", len(files), "Cores: ", os.cpu_count())
+    serial_duration = time_compress_dir(files, "serial", 1)
+    for backend in backends:
+        for workers in ([1] if backend == "serial" else worker_counts):
+            duration = serial_duration if backend == "serial" else time_compress_dir(files, backend, workers)
+            print(folder, f"{backend} {workers} Workers Duration: ", duration, "s", "Speedup: ", serial_duration / duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import tempfile
+from time import perf_counter
+import numpy as np
+
+from utils import chgcar, io2
+
+"""
+sys.argv[1] = chgcar file
+sys.argv[2] = number of repeats (default 3)
+"""
+
+
+# Per-token parser parse_chgcar used before the chunked one, kept as the baseline
+def parse_chgcar_per_token(chgcar_fn, no_data_fn):
+
+    charge, mag = [], []
+    dims = None
+    is_charge, is_mag = False, False
+
+    with open(chgcar_fn, "r") as fi:
+
+        lines = fi.read().splitlines()
+        fo = open(no_data_fn, "w")
+
+        i = 0
+        while i < len(lines):
+            if not is_charge and not is_mag:
+                fo.write(lines[i] + "\n")
+
+            if not charge and not lines[i].strip():
+                dims = lines[i + 1]
+                is_charge = True
+                fo.write(lines[i + 1] + "\n")
+                i += 1
+            elif is_charge and "augmentation" not in lines[i]:
+                line_nums = lines[i].strip().split(" ")
+                for num in line_nums:
+                    charge.append(float(num))
+            elif is_charge and "augmentation" in lines[i]:
+                fo.write(lines[i] + "\n")
+                is_charge = False
+            elif not mag and dims == lines[i]:
+                is_mag = True
+            elif is_mag and "augmentation" not in lines[i]:
+                line_nums = lines[i].strip().split(" ")
+                for num in line_nums:
+                    mag.append(float(num))
+            elif is_mag and "augmentation" in lines[i]:
+                fo.write(lines[i] + "\n")
+                is_mag = False
+
+            i += 1
+
+        fo.close()
+
+    dims = [int(dim) for dim in dims.strip().split()]
+
+    return dims, charge, mag
+
+
+def time_parse(parse_func, chgcar_fn: str, no_data_fn: str, repeats: int):
+    durations = []
+    for _ in range(repeats):
+        time_start = perf_counter()
+        dims, charge, mag = parse_func(chgcar_fn, no_data_fn)
+        charge, mag = chgcar.data_to_raw(charge, dims), chgcar.data_to_raw(mag, dims)
+        time_end = perf_counter()
+        durations.append(time_end - time_start)
+
+    return min(durations), (dims, charge, mag)
+
+
+def main():
+    chgcar_fn = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    # The no_data outputs only exist to be compared, so they never land next to the CHGCAR
+    with tempfile.TemporaryDirectory(prefix="bench_parse_") as tmp_dir:
+        per_token_no_data_fn, chunked_no_data_fn = os.path.join(tmp_dir, "per_token_no_data"), os.path.join(tmp_dir, "chunked_no_data")
+        per_token_duration, (dims, charge, mag) = time_parse(parse_chgcar_per_token, chgcar_fn, per_token_no_data_fn, repeats)
+        chunked_duration, (chunked_dims, chunked_charge, chunked_mag) = time_parse(chgcar.parse_chgcar, chgcar_fn, chunked_no_data_fn, repeats)
+
+        matches = dims == chunked_dims \
+            and np.array_equal(charge, chunked_charge) \
+            and np.array_equal(mag, chunked_mag) \
+            and open(per_token_no_data_fn, "rb").read() == open(chunked_no_data_fn, "rb").read()
+
+    print(chgcar_fn, "File Size: ", io2.get_file_size_mb(chgcar_fn), "MB")
+    print(chgcar_fn, "Per-token Parse to Array Duration: ", per_token_duration, "s")
+    print(chgcar_fn, "Chunked Parse to Array Duration: ", chunked_duration, "s")
+    print(chgcar_fn, "Speedup: ", per_token_duration / chunked_duration)
+    print(chgcar_fn, "Outputs Match: ", matches)
+
+
+if __name__ == "__main__":
+    main()
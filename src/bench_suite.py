@@ -0,0 +1,172 @@
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+from time import perf_counter
+import numpy as np
+
+from utils import cache, chgcar, io2, memory
+
+"""
+sys.argv[1] = chgcar_folder (corpus)
+sys.argv[2] = matrix json file, {codec: [[param, ...], ...]} where each param list is that codec's sys.argv[3:]
+              e.g. {"pyrho": [["2", "0.1"], ["4", "0.1"]], "sz3": [["0.001"], ["0.001", "64"]], "tthresh": [["-e", "0.1"]]}
+sys.argv[3] = results json file
+sys.argv[4] = timed repeats per case (default 3)
+sys.argv[5] = warm-up runs per case (default 1)
+sys.argv[6] = baseline results json file (optional), exits with 1 when a metric regresses past REGRESSION_TOLERANCE
+
+Every (codec, params, file) case runs in a fresh process so codecs reading sys.argv see their own params and peak RSS is per case
+"""
+
+CODEC_MODULES = {"pyrho": "pyrho_custom", "sz3": "sz3", "tthresh": "tthresh", "neurcomp": "neurcomp"}
+REGRESSION_TOLERANCE = 0.1
+HIGHER_IS_BETTER = ["compress_throughput", "decompress_throughput", "compression_ratio", "grid_compression_ratio"]
+LOWER_IS_BETTER = ["parse_duration", "peak_rss_mb", "charge_mae", "mag_mae", "charge_rmse", "mag_rmse", "charge_max_abs_error", "mag_max_abs_error",
+                   "charge_avg_percentage_diff", "mag_avg_percentage_diff"]
+
+
+def run_case(codec: str, params: list[str], folder: str, file: str, repeats: int, warmups: int):
+    sys.argv = [f"{CODEC_MODULES[codec]}.py", folder, "remake", *params]
+    module = importlib.import_module(CODEC_MODULES[codec])
+    file_no_ext = file.split(".")[0]
+    compressed_fn = chgcar.container_file(file_no_ext, codec)
+    memory.reset_peak_rss()
+
+    # Parsed without the cache so parse_duration is the real cost, the helpers below still hit the cache
+    cache_dir, cache.CACHE_DIR = cache.CACHE_DIR, ""
+    time_start = perf_counter()
+    structure, charge, mag, data_aug, dims, fs = chgcar.parse_chgcar_pymatgen(file)
+    parse_duration = perf_counter() - time_start
+    cache.CACHE_DIR = cache_dir
+
+    compress_durations, decompress_durations = [], []
+    for run in range(warmups + repeats):
+        compressed = module.compress_file_helper(file, file_no_ext)
+        decompressed = module.decompress_file_helper(compressed_fn)
+        chgcar.pop_container_metrics(file_no_ext)
+        if run >= warmups:
+            compress_durations.append(_duration(compressed[3]))
+            decompress_durations.append(_duration(decompressed[-1]))
+
+    compressed_fs = io2.get_file_size_mb(compressed_fn)
+    io2.delete_files([compressed_fn])
+
+    grid_mb = (charge.grid_data.nbytes + mag.grid_data.nbytes) / (1024 * 1024)
+    metrics = {
+        "parse_duration": parse_duration,
+        "compress_duration_min": min(compress_durations),
+        "compress_duration_median": statistics.median(compress_durations),
+        "decompress_duration_min": min(decompress_durations),
+        "decompress_duration_median": statistics.median(decompress_durations),
+        "compress_throughput": grid_mb / min(compress_durations),
+        "decompress_throughput": grid_mb / min(decompress_durations),
+        "orig_file_size": fs,
+        "compressed_file_size": compressed_fs,
+        "compression_ratio": fs / compressed_fs,
+        "grid_compression_ratio": grid_mb / compressed_fs,
+        "peak_rss_mb": memory.peak_rss_mb(),
+        "projected_peak_mb": memory.estimate_chgcar_memory_mb(file, codec, dims)["process_peak_mb"],
+    }
+
+    error_metrics = chgcar.generate_metrics({file_no_ext: [charge, mag]}, {file_no_ext: decompressed[3:5]}, {file_no_ext: {}}, {file_no_ext: {}})
+    metrics.update(error_metrics[file_no_ext])
+
+    return metrics
+
+
+def _duration(duration):
+    # neurcomp reports "train,compress"
+    if isinstance(duration, str):
+        return sum(float(d) for d in duration.split(","))
+    return duration
+
+
+def run_matrix(folder: str, matrix: dict, repeats: int, warmups: int):
+    # Remade CHGCARs from earlier remake runs are not part of the corpus
+    files = sorted(file for file in io2.get_files_in_dir(folder) if file.endswith(".vasp") and not any(file.endswith(f"_{codec}.vasp") for codec in CODEC_MODULES))
+
+    results = {}
+    context = multiprocessing.get_context("fork")
+    for codec, param_sets in matrix.items():
+        for params in param_sets:
+            case_name = "_".join([codec, *[p.lstrip("-") for p in params]])
+            results[case_name] = {}
+            for file in files:
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    future = executor.submit(run_case, codec, params, folder, file, repeats, warmups)
+                    try:
+                        results[case_name][os.path.basename(file)] = future.result()
+                    except Exception as e:
+                        results[case_name][os.path.basename(file)] = {"error": f"{type(e).__name__}: {e}"}
+                print(case_name, os.path.basename(file), json.dumps(results[case_name][os.path.basename(file)], sort_keys=True))
+
+    return results
+
+
+def get_environment(repeats: int, warmups: int, matrix: dict):
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "executor": io2.EXECUTOR_BACKEND,
+        "repeats": repeats,
+        "warmups": warmups,
+        "matrix": matrix,
+    }
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE):
+    regressions = []
+    for case_name, files in results.items():
+        for file, metrics in files.items():
+            baseline_metrics = baseline.get(case_name, {}).get(file)
+            if not baseline_metrics or "error" in metrics or "error" in baseline_metrics:
+                continue
+
+            for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+                new, old = metrics.get(metric), baseline_metrics.get(metric)
+                if new is None or not old:
+                    continue
+                change = (new - old) / abs(old)
+                if (metric in HIGHER_IS_BETTER and change < -tolerance) or (metric in LOWER_IS_BETTER and change > tolerance):
+                    regressions.append(f"{case_name} {file} {metric}: {old} -> {new} ({change * 100:+.1f}%)")
+
+    return regressions
+
+
+def main():
+    folder = sys.argv[1]
+    with open(sys.argv[2]) as f:
+        matrix = json.load(f)
+    results_fn = sys.argv[3]
+    repeats = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+    warmups = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+    baseline_fn = sys.argv[6] if len(sys.argv) > 6 else None
+
+    if not io2.check_dir(folder):
+        print("Invalid directory")
+        sys.exit(1)
+
+    results = run_matrix(folder, matrix, repeats, warmups)
+    with open(results_fn, "w") as f:
+        json.dump({"environment": get_environment(repeats, warmups, matrix), "results": results}, f, sort_keys=True, indent=4)
+
+    if baseline_fn:
+        with open(baseline_fn) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline["results"])
+        for regression in regressions:
+            print("Regression:", regression)
+        print(f"{len(regressions)} regressions against {baseline_fn}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
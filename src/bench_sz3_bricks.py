@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+from time import perf_counter
+import numpy as np
+
+import sz3
+from utils import chgcar, io2
+
+"""
+sys.argv[1] = chgcar file
+sys.argv[2] = relative target accuracy
+sys.argv[3] = comma separated brick edge lengths, 0 = whole grid (default 0,32,64,128)
+sys.argv[4] = comma separated worker counts (default 1,2,4,8)
+
+Finishes with a read_region round trip through a container stored under a CHGCAR_LOSSLESS override
+"""
+
+REGION_CHECK_ENCODING = "zlib:6"
+
+
+def time_bricked(grids: list[np.ndarray], rel_error: float, brick_size: int, workers: int):
+    time_start = perf_counter()
+    compressed = [sz3.compress_bricked(grid, rel_error, brick_size, workers) for grid in grids]
+    compress_duration = perf_counter() - time_start
+
+    time_start = perf_counter()
+    decompressed = [sz3.decompress_bricked(c, grid.shape, workers) for c, grid in zip(compressed, grids)]
+    decompress_duration = perf_counter() - time_start
+
+    compressed_bytes = sum(c["data"].nbytes + c["bricks"].nbytes for c in compressed)
+    ratio = sum(grid.nbytes for grid in grids) / compressed_bytes
+    max_error = max(float(np.abs(d - grid).max()) / float(grid.max() - grid.min()) for d, grid in zip(decompressed, grids))
+
+    return compress_duration, decompress_duration, ratio, max_error, len(compressed[0]["bricks"])
+
+
+def check_region_round_trip(parsed, rel_error: float, brick_size: int, encoding: str = REGION_CHECK_ENCODING):
+    # The override must leave the brick payloads seekable, so read_region still matches a full decompression
+    structure, charge, mag, data_aug, dims, _ = parsed
+    params = {"rel_error": rel_error, "brick_size": brick_size, "brick_workers": None}
+    lossless_encoding, chgcar.LOSSLESS_ENCODING = chgcar.LOSSLESS_ENCODING, encoding
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_no_ext = os.path.join(tmp_dir, "region")
+            charge_compressed, mag_compressed, _ = sz3.compress_func(charge.grid_data, mag.grid_data, params)
+            sz3.store_compressed(file_no_ext, charge_compressed, mag_compressed, structure, data_aug, dims, params)
+            chgcar.pop_container_metrics(file_no_ext)
+
+            decompressed = sz3.decompress_func(charge_compressed, mag_compressed, dims, params)[:2]
+            region = tuple(slice(1, dim, 3) for dim in dims)
+            for component, grid in zip(["charge", "mag"], decompressed):
+                if not np.array_equal(sz3.read_region(chgcar.container_file(file_no_ext, "sz3"), component, region), grid[region]):
+                    raise AssertionError(f"read_region {component} differs from the full decompression under {encoding}")
+    finally:
+        chgcar.LOSSLESS_ENCODING = lossless_encoding
+
+
+def main():
+    chgcar_fn = sys.argv[1]
+    rel_error = float(sys.argv[2])
+    brick_sizes = [int(size) for size in sys.argv[3].split(",")] if len(sys.argv) > 3 else [0, 32, 64, 128]
+    worker_counts = [int(workers) for workers in sys.argv[4].split(",")] if len(sys.argv) > 4 else [1, 2, 4, 8]
+
+    parsed = chgcar.parse_chgcar_pymatgen(chgcar_fn)
+    structure, charge, mag, data_aug, dims, fs = parsed
+    grids = [charge.grid_data, mag.grid_data]
+
+    print(chgcar_fn, "File Size: ", io2.get_file_size_mb(chgcar_fn), "MB", "Dims: ", dims)
+    for brick_size in brick_sizes:
+        for workers in worker_counts:
+            compress_duration, decompress_duration, ratio, max_error, n_bricks = time_bricked(grids, rel_error, brick_size, workers)
+            print(chgcar_fn, f"Brick {brick_size} ({n_bricks} bricks) Workers {workers}",
+                  "Compression Duration: ", compress_duration, "s",
+                  "Decompression Duration: ", decompress_duration, "s",
+                  "Ratio: ", ratio,
+                  "Max Relative Error: ", max_error)
+
+    check_region_round_trip(parsed, rel_error, max(brick_sizes))
+    print(chgcar_fn, f"read_region round trip under CHGCAR_LOSSLESS={REGION_CHECK_ENCODING}: ok")
+
+
+if __name__ == "__main__":
+    main()
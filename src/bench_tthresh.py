@@ -0,0 +1,70 @@
+import sys
+from time import perf_counter
+import numpy as np
+
+import tthresh
+from utils import chgcar, io2
+
+"""
+sys.argv[1] = chgcar file
+sys.argv[2] = number of repeats
+sys.argv[3] = error target flag (-e/-r/-p)
+sys.argv[4] = error target value
+"""
+
+
+# Raw files next to the CHGCAR and sequential subprocess calls, as tthresh.py worked before the in-memory backend
+def roundtrip_files(file_no_ext: str, grids: list[np.ndarray], dims: list[int]):
+    decompressed = []
+    for section, grid in zip(["charge", "mag"], grids):
+        chgcar.data_to_raw(grid, dims, f"{file_no_ext}_tthresh_{section}.raw")
+        tthresh.compress_func(file_no_ext, section, dims)
+        tthresh.decompress_func(f"{file_no_ext}_tthresh_{section}_compressed.raw")
+        decompressed.append(np.array(chgcar.raw_to_data(f"{file_no_ext}_tthresh_{section}_compressed_decompressed.raw")))
+
+        chgcar.delete_raw_files([f"{file_no_ext}_tthresh_{section}{suffix}.raw" for suffix in ["", "_compressed", "_compressed_decompressed"]])
+
+    return decompressed
+
+
+def roundtrip_in_memory(file_no_ext: str, grids: list[np.ndarray], dims: list[int]):
+    compressed = [c for c, _ in tthresh.compress_grids(grids, dims)]
+    return [d for d, _ in tthresh.decompress_grids(compressed, dims)]
+
+
+def time_roundtrip(roundtrip_func, file_no_ext: str, grids: list[np.ndarray], dims: list[int], repeats: int):
+    durations = []
+    for _ in range(repeats):
+        time_start = perf_counter()
+        decompressed = roundtrip_func(file_no_ext, grids, dims)
+        time_end = perf_counter()
+        durations.append(time_end - time_start)
+
+    return min(durations), decompressed
+
+
+def main():
+    chgcar_fn = sys.argv[1]
+    repeats = int(sys.argv[2])
+    file_no_ext = chgcar_fn.split(".")[0]
+
+    structure, charge, mag, data_aug, dims, fs = chgcar.parse_chgcar_pymatgen(chgcar_fn)
+    grids = [charge.grid_data, mag.grid_data]
+
+    files_duration, files_decompressed = time_roundtrip(roundtrip_files, file_no_ext, grids, dims, repeats)
+    in_memory_duration, in_memory_decompressed = time_roundtrip(roundtrip_in_memory, file_no_ext, grids, dims, repeats)
+    tthresh.start_staging()
+    staging_duration, _ = time_roundtrip(roundtrip_in_memory, file_no_ext, grids, dims, repeats)
+    tthresh.stop_staging()
+
+    matches = all(np.array_equal(f, m) for f, m in zip(files_decompressed, in_memory_decompressed))
+
+    print(chgcar_fn, "File Size: ", io2.get_file_size_mb(chgcar_fn), "MB")
+    print(chgcar_fn, "File-based Round Trip Duration: ", files_duration, "s")
+    print(chgcar_fn, "In-memory Round Trip Duration: ", in_memory_duration, "s", "Speedup: ", files_duration / in_memory_duration)
+    print(chgcar_fn, "Run-wide Staging Round Trip Duration: ", staging_duration, "s", "Speedup: ", files_duration / staging_duration)
+    print(chgcar_fn, "Outputs Match: ", matches)
+
+
+if __name__ == "__main__":
+    main()
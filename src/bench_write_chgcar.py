@@ -0,0 +1,97 @@
+import filecmp
+import math
+import os
+import sys
+import tempfile
+from time import perf_counter
+import numpy as np
+from pymatgen.io.vasp.outputs import Chgcar
+
+from utils import chgcar, io2
+
+"""
+sys.argv[1] = chgcar file
+sys.argv[2] = number of repeats (default 3)
+"""
+
+
+# Per-value write_data used before the bulk formatter, kept as the baseline
+def write_data_per_value(data: np.ndarray, fo):
+    line = ""
+    for i, num in enumerate(data):
+        if i % 5 == 0 and i > 0:
+            fo.write(f" {line[:-1]}\n")
+            line = ""
+
+        if num == 0:
+            base = 0
+            exponent = 0
+        else:
+            exponent = math.floor(math.log10(abs(num)))
+            base = num / (10 ** exponent)
+            base /= 10
+            exponent += 1
+
+
+        if base < 0:
+            base_str = f"{base:.11f}"
+            line += base_str[0]
+            line += base_str[2:]
+        else:
+            line += f"{base:.11f}"
+
+        if exponent < 0:
+            line += f"E-{-exponent:02d} "
+        else:
+            line += f"E+{exponent:02d} "
+
+    fo.write(f" {line[:-1]}\n")
+
+
+def time_write(write_func, output_fn: str, repeats: int):
+    durations = []
+    for _ in range(repeats):
+        time_start = perf_counter()
+        write_func(output_fn)
+        time_end = perf_counter()
+        durations.append(time_end - time_start)
+
+    return min(durations)
+
+
+def write_grids_func(write_data_func, charge: np.ndarray, mag: np.ndarray):
+    def write_grids(output_fn: str):
+        with open(output_fn, "w") as fo:
+            write_data_func(charge.reshape(-1), fo)
+            write_data_func(mag.reshape(-1), fo)
+
+    return write_grids
+
+
+def main():
+    chgcar_fn = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with tempfile.TemporaryDirectory(prefix="bench_write_") as tmp_dir:
+        dims, charge, mag = chgcar.parse_chgcar(chgcar_fn, os.path.join(tmp_dir, "no_data"))
+        vasp_cden = Chgcar.from_file(chgcar_fn)
+
+        outputs = {
+            "write_data per-value": (write_grids_func(write_data_per_value, charge, mag), os.path.join(tmp_dir, "per_value.txt")),
+            "write_data bulk": (write_grids_func(chgcar.write_data, charge, mag), os.path.join(tmp_dir, "bulk.txt")),
+            "pymatgen write_file": (vasp_cden.write_file, os.path.join(tmp_dir, "pymatgen.vasp")),
+            "write_chgcar_pymatgen": (lambda fn: chgcar.write_chgcar_pymatgen(vasp_cden, fn), os.path.join(tmp_dir, "bulk_pymatgen.vasp")),
+        }
+
+        print(chgcar_fn, "File Size: ", io2.get_file_size_mb(chgcar_fn), "MB")
+        for name, (write_func, output_fn) in outputs.items():
+            print(chgcar_fn, f"{name} Duration: ", time_write(write_func, output_fn, repeats), "s")
+
+        print(chgcar_fn, "write_data Outputs Match: ",
+              filecmp.cmp(outputs["write_data per-value"][1], outputs["write_data bulk"][1], shallow=False))
+        print(chgcar_fn, "write_file Outputs Match: ",
+              filecmp.cmp(outputs["pymatgen write_file"][1], outputs["write_chgcar_pymatgen"][1], shallow=False))
+
+
+if __name__ == "__main__":
+    main()
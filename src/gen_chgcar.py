@@ -0,0 +1,165 @@
+import math
+import sys
+from time import perf_counter
+import numpy as np
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+
+from utils import chgcar, io2
+
+"""
+sys.argv[1] = output folder
+sys.argv[2] = comma separated grid edge lengths, 32 to 600 (default 32,64,128), written as g{n}_chgcar.vasp
+sys.argv[3] = seed (default 0)
+sys.argv[4] = vacuum fraction along c (default 0)
+sys.argv[5] = spin polarized, 1 writes a magnetization block, which the compressors expect (default 1)
+
+Periodic densities: Gaussian cores on the atoms of a generated rock salt like structure plus a smooth valence
+background, the cell grows with the grid so the spacing stays near GRID_SPACING. Grids are evaluated and written
+one z slab at a time, so a 600^3 file needs about SLAB_VALUES floats of memory per block rather than the whole grid.
+"""
+
+GRID_SPACING = 0.1 # Angstrom
+ATOM_SPACING = 2.1 # Angstrom between neighbouring sites
+# symbol, valence electrons, magnetic moment, augmentation occupancies per atom
+SPECIES = [("Fe", 8.0, 2.2, 18), ("O", 6.0, 0.1, 8)]
+CORE_FRACTION = 0.6 # Electrons in the atom centred Gaussians, the rest is background
+CORE_SIGMA = 0.35 # Angstrom
+MAG_SIGMA = 0.6 # Angstrom
+CUTOFF_SIGMAS = 4
+VACUUM_WIDTH = 1.0 # Angstrom, decay length of the background into vacuum
+SLAB_VALUES = 2 * 1024 * 1024
+
+
+def generate_structure(n: int, rng: np.random.Generator, vacuum: float = 0.0):
+    a = n * GRID_SPACING
+    c = a / (1 - vacuum)
+    sites_per_axis = max(1, round(a / ATOM_SPACING))
+
+    species, coords = [], []
+    for i, j, k in np.ndindex(sites_per_axis, sites_per_axis, sites_per_axis):
+        species.append(SPECIES[(i + j + k) % len(SPECIES)][0])
+        jitter = rng.normal(0, 0.02, 3)
+        frac = (np.array([i, j, k]) + 0.5 + jitter) / sites_per_axis
+        frac[2] *= 1 - vacuum
+        coords.append(frac % 1)
+
+    # Grouped by species like VASP's POSCAR header, so every later pass sees the sites in file order
+    return Structure(Lattice.orthorhombic(a, a, c), species, coords).get_sorted_structure()
+
+
+def generate_data_aug(structure: Structure, moments: np.ndarray, rng: np.random.Generator, spin_polarized: bool):
+    # Occupancies decay along the channel index like real PAW occupancies, the magnetization block scales with the moment
+    aug_sizes = {symbol: size for symbol, _, _, size in SPECIES}
+    data_aug = {"total": {}}
+    if spin_polarized:
+        data_aug["diff"] = {}
+
+    for i, site in enumerate(structure, start=1):
+        size = aug_sizes[site.specie.symbol]
+        decay = np.exp(-np.arange(size) / 4)
+        data_aug["total"][i] = rng.normal(0, 0.05, size) * decay + decay * 0.5
+        if spin_polarized:
+            data_aug["diff"][i] = rng.normal(0, 0.01, size) * decay + decay * 0.1 * moments[i - 1]
+
+    return data_aug
+
+
+def _periodic_profile(center: float, sigma: float, n: int, length: float):
+    # 1D Gaussian along one axis with the periodic images folded in, returns the touched indices and weights
+    spacing = length / n
+    reach = int(math.ceil(CUTOFF_SIGMAS * sigma / spacing))
+    positions = np.arange(int(math.floor(center / spacing)) - reach, int(math.floor(center / spacing)) + reach + 2)
+    weights = np.exp(-0.5 * ((positions * spacing - center) / sigma) ** 2)
+    folded = np.bincount(positions % n, weights=weights, minlength=n)
+
+    indices = np.flatnonzero(folded)
+    return indices, folded[indices]
+
+
+def _atom_profiles(structure: Structure, dims: list[int], sigma: float):
+    lengths = structure.lattice.abc
+    return [[_periodic_profile(site.coords[axis], sigma, dims[axis], lengths[axis]) for axis in range(3)] for site in structure]
+
+
+def _background_axes(structure: Structure, dims: list[int], rng: np.random.Generator, vacuum: float):
+    # Low frequency periodic modulation per axis plus a tanh envelope that empties the vacuum region along c
+    axes = []
+    for axis in range(3):
+        frac = np.arange(dims[axis]) / dims[axis]
+        phase = rng.uniform(0, 2 * np.pi, 2)
+        axes.append(1 + 0.15 * np.cos(2 * np.pi * frac + phase[0]) + 0.05 * np.cos(4 * np.pi * frac + phase[1]))
+
+    if vacuum > 0:
+        frac = np.arange(dims[2]) / dims[2]
+        c = structure.lattice.c
+        distance = np.minimum(frac, 1 - vacuum - frac) * c
+        distance = np.where(frac > 1 - vacuum, -np.minimum(frac - (1 - vacuum), 1 - frac) * c, distance)
+        axes[2] = axes[2] * 0.5 * (1 + np.tanh(distance / VACUUM_WIDTH))
+
+    return axes
+
+
+def generate_slabs(dims: list[int], background_axes: list[np.ndarray], background_total: float, profiles: list, weights: np.ndarray):
+    # Yields (nx, ny, k) slabs of file values (density times volume, so the grid mean is the electron count)
+    n_values = dims[0] * dims[1] * dims[2]
+    bx, by, bz = background_axes
+    background_scale = background_total * n_values / (bx.sum() * by.sum() * bz.sum()) if background_total else 0
+    core_norms = [weight * n_values / (px[1].sum() * py[1].sum() * pz[1].sum()) for weight, (px, py, pz) in zip(weights, profiles)]
+
+    slab_planes = max(1, SLAB_VALUES // (dims[0] * dims[1]))
+    for k0 in range(0, dims[2], slab_planes):
+        k1 = min(k0 + slab_planes, dims[2])
+        slab = background_scale * bx[:, None, None] * by[None, :, None] * bz[None, None, k0:k1]
+
+        for norm, ((ix, wx), (iy, wy), (iz, wz)) in zip(core_norms, profiles):
+            in_slab = (iz >= k0) & (iz < k1)
+            if norm == 0 or not in_slab.any():
+                continue
+            block = norm * wx[:, None, None] * wy[None, :, None] * wz[in_slab][None, None, :]
+            slab[np.ix_(ix, iy, iz[in_slab] - k0)] += block
+
+        yield slab
+
+
+def generate_chgcar(output_fn: str, n: int, seed: int = 0, vacuum: float = 0.0, spin_polarized: bool = True):
+    rng = np.random.default_rng(seed)
+    structure = generate_structure(n, rng, vacuum)
+    dims = [n, n, n]
+
+    electrons = np.array([{symbol: valence for symbol, valence, _, _ in SPECIES}[site.specie.symbol] for site in structure])
+    moments = np.array([{symbol: moment for symbol, _, moment, _ in SPECIES}[site.specie.symbol] for site in structure])
+    moments = moments * rng.choice([-1, 1], len(moments)) * rng.uniform(0.8, 1.2, len(moments))
+
+    background_axes = _background_axes(structure, dims, rng, vacuum)
+    grids = {"total": generate_slabs(dims, background_axes, (1 - CORE_FRACTION) * electrons.sum(), _atom_profiles(structure, dims, CORE_SIGMA), CORE_FRACTION * electrons)}
+    if spin_polarized:
+        grids["diff"] = generate_slabs(dims, background_axes, 0, _atom_profiles(structure, dims, MAG_SIGMA), moments)
+
+    data_aug = generate_data_aug(structure, moments, rng, spin_polarized)
+    chgcar.write_chgcar_slabs(structure, dims, grids, data_aug, output_fn, comment=f"synthetic {n}x{n}x{n} seed {seed}")
+
+    return structure, dims
+
+
+def main():
+    folder = sys.argv[1]
+    sizes = [int(n) for n in sys.argv[2].split(",")] if len(sys.argv) > 2 else [32, 64, 128]
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    vacuum = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    spin_polarized = sys.argv[5] != "0" if len(sys.argv) > 5 else True
+
+    if not io2.check_dir(folder):
+        print("Invalid directory")
+        sys.exit(1)
+
+    for n in sizes:
+        output_fn = f"{folder.rstrip('/')}/g{n}_chgcar.vasp"
+        time_start = perf_counter()
+        structure, dims = generate_chgcar(output_fn, n, seed, vacuum, spin_polarized)
+        time_end = perf_counter()
+        print(output_fn, "Atoms: ", len(structure), "File Size: ", io2.get_file_size_mb(output_fn), "MB", "Duration: ", time_end - time_start, "s")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,7 @@ import vtk
 from vtk.util import numpy_support
 
 
-from utils import chgcar, io2
+from utils import chgcar, io2, trace
 
 """
 sys.argv[1] = chgcar_folder
@@ -19,6 +19,8 @@ sys.argv[4] = # of layers
 sys.argv[5] = learning rate
 TODO: Add other params here
 TODO: May have to fork and make basic changes to neurcomp (add option to not send in volume for net_decompress.py)
+
+Charge and mag are trained independently, CHGCAR_SPIN_BASIS does not apply (see utils/spin_basis.py)
 """
 
 NEURCOMP_DIR = "./lib/neurcomp/"
@@ -35,7 +37,8 @@ def train_func(fn: str):
             "--n_layers", str(sys.argv[4])]
 
     time_start = perf_counter()
-    subprocess.run(cmd)
+    with trace.span("neurcomp_train", volume=fn):
+        subprocess.run(cmd)
     time_end = perf_counter()
 
     return network_fn, config_fn, time_end - time_start
@@ -50,7 +53,8 @@ def compress_func(network_fn: str, config_fn: str):
         "--compressed", compressed_fn]
 
     time_start = perf_counter()
-    subprocess.run(cmd)
+    with trace.span("neurcomp_compress", network=network_fn):
+        subprocess.run(cmd)
     time_end = perf_counter()
 
     compressed_fs = io2.get_file_size_mb(compressed_fn)
@@ -74,23 +78,42 @@ def decompress_func(compressed_fn: str, dims: list[int], volume_fn: str = None):
         cmd.append(volume_fn)
 
     time_start = perf_counter()
-    subprocess.run(cmd)
+    with trace.span("neurcomp_decompress", compressed=compressed_fn):
+        subprocess.run(cmd)
     time_end = perf_counter()
 
     return decompressed_fn + ".npy", time_end - time_start
 
 
+def store_compressed(chgcar_fn: str, charge_compressed_fn: str, mag_compressed_fn: str, structure, data_aug, dims):
+    params = {"compression_ratio": float(sys.argv[3]), "n_layers": int(sys.argv[4]), "lr": float(sys.argv[5] if sys.argv[5] else 5e-5)}
+    components = []
+    for section, compressed_fn in [("charge", charge_compressed_fn), ("mag", mag_compressed_fn)]:
+        with open(compressed_fn, "rb") as f:
+            components.append({"name": section, "kind": "bytes", "payload": f.read(), "params": params})
+    chgcar.store_structure_aug_dims_pymatgen(chgcar_fn, structure, data_aug, dims, "neurcomp", components)
+    io2.delete_files([charge_compressed_fn, mag_compressed_fn])
+
+    charge_fs = chgcar.get_component_size_mb(chgcar_fn, "neurcomp", "charge")
+    mag_fs = chgcar.get_component_size_mb(chgcar_fn, "neurcomp", "mag")
+
+    return charge_fs, mag_fs
+
+
 def retrieve_compressed(file: str):
-    if "_neurcomp_compressed" not in file:
+    if not file.endswith("_neurcomp.chgz"):
         return None
     chgcar_fn = file.split("_")[0] + "_chgcar"
-    files_required = [f"{chgcar_fn}_charge_neurcomp_compressed", f"{chgcar_fn}_mag_neurcomp_compressed", f"{chgcar_fn}_structure.cif", f"{chgcar_fn}_data_aug.txt"]
-    # TODO: Prevent repeating reading all files for a particular VASP, only do it once
-    if not io2.check_files(files_required):
+    if not io2.check_files([chgcar.container_file(chgcar_fn, "neurcomp")]):
         print(f"{file}: Missing files for decompression")
         return None
 
-    structure, lattice, data_aug, dims = chgcar.retrieve_structure_aug_dims_pymatgen(chgcar_fn)
+    structure, lattice, data_aug, dims, components = chgcar.retrieve_compressed_pymatgen(chgcar_fn, "neurcomp", ["charge", "mag"])
+
+    # net_decompress.py only reads files, so the components are written back out for it
+    for section in ["charge", "mag"]:
+        with open(f"{chgcar_fn}_{section}_neurcomp_compressed", "wb") as f:
+            f.write(components[section])
 
     return chgcar_fn, dims, structure, lattice, data_aug
 
@@ -127,7 +150,7 @@ def compress_file_helper(file: str, file_no_ext: str):
     charge_compressed_fn, charge_fs, charge_compress_duration = compress_func(charge_network_fn, charge_config_fn)
     mag_compressed_fn, mag_fs, mag_compress_duration = compress_func(mag_network_fn, mag_config_fn)
 
-    chgcar.store_structure_aug_dims_pymatgen(file_no_ext, structure, data_aug, dims)
+    charge_fs, mag_fs = store_compressed(file_no_ext, charge_compressed_fn, mag_compressed_fn, structure, data_aug, dims)
 
     total_train_duration = charge_train_duration + mag_train_duration
     total_compress_duration = charge_compress_duration + mag_compress_duration
@@ -147,6 +170,7 @@ def decompress_file_helper(file: str):
     # decompress_mag_fn, decompress_mag_duration = decompress_func(f"{chgcar_fn}_mag_neurcomp_compressed", dims, f"{chgcar_fn}_mag.npy")
 
     charge_array, mag_array = np.load(decompress_charge_fn), np.load(decompress_mag_fn)
+    io2.delete_files([f"{chgcar_fn}_charge_neurcomp_compressed", f"{chgcar_fn}_mag_neurcomp_compressed"])
 
     charge_pgrid, mag_pgrid = PGrid(charge_array, lattice), PGrid(mag_array, lattice)
 
@@ -1,7 +1,9 @@
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import gzip
+import functools
 import json
+import math
+import os
 import sys
 from time import perf_counter
 import numpy as np
@@ -10,74 +12,213 @@ from pymatgen.core.structure import Structure
 from pymatgen.io.cif import CifParser
 from pymatgen.io.vasp.outputs import Chgcar
 from pyrho.charge_density import ChargeDensity, PGrid
+import scipy.fft
 
-from utils import chgcar, io, io2
+from utils import chgcar, container, grid_analysis, io, io2, metrics_store, trace
 
 """
 sys.argv[1] = chgcar_folder
-sys.argv[2] = compress/decompress
+sys.argv[2] = compress/compress_pipeline/decompress/remake/remake_no_file
 sys.argv[3] = dims_divisor
 sys.argv[4] = smear_std
+sys.argv[5] = smooth/fourier (default smooth)
+sys.argv[6] = fourier coefficient dtype, float64/float32/float16 (default float32)
+
+smooth keeps pyrho's smeared, downsampled real-space grid and upsamples it with a forward and inverse FFT on decompression.
+fourier keeps the rfftn coefficients with |k| below half the downsampled dims directly, scaled by the largest one so float16
+cannot overflow, and decompression is one zero-padded irfftn to the original dims. smear_std is unused in fourier mode.
+
+Environment:
+CHGCAR_FFT_WORKERS = threads per decompression FFT (default all cpus)
 """
 
+FFT_WORKERS = int(os.environ.get("CHGCAR_FFT_WORKERS", -1))
+PADDING_CACHE_SIZE = 32
+
+def parse_params(args: list[str]):
+    # sys.argv[3:] as the params dict the compress and store functions take, mode and dtype only in fourier mode
+    params = {"dims_divisor": int(args[0]), "smear_std": float(args[1])}
+    if len(args) > 2 and args[2] == "fourier":
+        params.update({"mode": "fourier", "dtype": args[3] if len(args) > 3 else "float32"})
+    return params
+
+
+def get_params():
+    return parse_params(sys.argv[3:])
+
+
+def compress_grid(grid: PGrid, params: dict = None):
+    params = params or get_params()
+    descriptor = grid_analysis.analyze_grid(grid.grid_data)
+    if descriptor is not None:
+        return descriptor
+
+    compressed_dims = [max(1, dim // params["dims_divisor"]) for dim in grid.grid_shape]
+    if params.get("mode") == "fourier":
+        compressed = fourier_truncate(grid.grid_data, compressed_dims, params["dtype"])
+    else:
+        # pyrho smooths in float64, the stored grid keeps the parsed precision
+        compressed = grid.lossy_smooth_compression(compressed_dims, params["smear_std"]).astype(grid.grid_data.dtype, copy=False)
+
+    # pyrho has no bound of its own, the rms error it makes on this grid is the bound a description may use, like tthresh
+    error = math.sqrt(float(np.mean(np.square(decompress_grids([compressed], grid.grid_shape)[0] - grid.grid_data))))
+    descriptor = grid_analysis.analyze_grid(grid.grid_data, error)
+    return compressed if descriptor is None else descriptor
+
+def fourier_truncate(data: np.ndarray, compressed_dims: list[int], dtype: str):
+    # Symmetric |k| <= (m - 1) // 2 per axis, rfftn already holds only k >= 0 on the last one
+    with trace.span("pyrho_rfft"):
+        coeffs = np.fft.rfftn(data, norm="forward")
+    kept = np.ix_(
+        _kept_frequencies(data.shape[0], 2 * ((compressed_dims[0] - 1) // 2) + 1),
+        _kept_frequencies(data.shape[1], 2 * ((compressed_dims[1] - 1) // 2) + 1),
+        np.arange(min((compressed_dims[2] - 1) // 2, (data.shape[2] - 1) // 2) + 1),
+    )
+    truncated = np.stack([coeffs[kept].real, coeffs[kept].imag])
+
+    scale = float(np.max(np.abs(truncated))) or 1.0
+    return {"coeffs": (truncated / scale).astype(dtype), "scale": scale, "mode": "fourier", "dtype": data.dtype.str}
+
+def fourier_reconstruct(compressed: list[dict], dims: list[int]):
+    # Stored coefficients are the rfftn of an odd sized grid, so they pad like one
+    coeffs = np.stack([grid["coeffs"].astype(np.float64) * grid["scale"] for grid in compressed])
+    coeffs = coeffs[:, 0] + 1j * coeffs[:, 1]
+    with trace.span("pyrho_irfft", grids=len(compressed)):
+        grids = _pad_irfftn(coeffs, (coeffs.shape[1], coeffs.shape[2], 2 * coeffs.shape[3] - 1), dims)
+    return grids.astype(compressed[0]["dtype"], copy=False)
+
+def upsample_grids(grids: list[np.ndarray], dims: list[int]):
+    # Fourier interpolation of same shaped grids straight onto dims in one batched transform,
+    # with the identity supercell there is nothing left for pyrho's real-space regridding to do
+    with trace.span("pyrho_upsample", grids=len(grids), up_sample=dims[0] // grids[0].shape[0]):
+        spectrum = scipy.fft.rfftn(np.stack(grids), axes=(1, 2, 3), norm="forward", workers=FFT_WORKERS)
+        return _pad_irfftn(spectrum, grids[0].shape, dims)
+
+def _pad_irfftn(spectrum: np.ndarray, grid_shape: tuple, dims: list[int]):
+    # spectrum is a batch of rfftn halves of grids shaped grid_shape, zero padded to dims before the inverse
+    dest, src, weights = _padding_maps(tuple(grid_shape), tuple(int(dim) for dim in dims))
+    # float32 grids stay single precision through the transforms
+    padded = np.zeros((spectrum.shape[0], dims[0], dims[1], dims[2] // 2 + 1), dtype=np.result_type(spectrum.dtype, np.complex64))
+    padded[(slice(None), *dest)] = spectrum[(slice(None), *src)] * weights
+    return scipy.fft.irfftn(padded, s=dims, axes=(1, 2, 3), norm="forward", workers=FFT_WORKERS)
+
+@functools.lru_cache(maxsize=PADDING_CACHE_SIZE)
+def _padding_maps(grid_shape: tuple, dims: tuple):
+    # Files sharing grid and output dims reuse the same index maps and Nyquist weights
+    maps = [_axis_map(grid_shape[0], dims[0]), _axis_map(grid_shape[1], dims[1]), _last_axis_map(grid_shape[2], dims[2])]
+    dest = np.ix_(*[axis_dest for axis_dest, _, _ in maps])
+    src = np.ix_(*[axis_src for _, axis_src, _ in maps])
+    weights = functools.reduce(np.multiply, np.ix_(*[axis_weights for _, _, axis_weights in maps]))
+    return dest, src, weights
+
+def _axis_map(m: int, n: int):
+    # An even grid's Nyquist frequency is split evenly between +m/2 and -m/2 of the finer grid, like pyrho's real part
+    positive, negative = (m + 1) // 2, m // 2
+    src = list(range(positive)) + list(range(m - negative, m))
+    dest = list(range(positive)) + list(range(n - negative, n))
+    weights = [1.0] * m
+    if m % 2 == 0 and n > m:
+        src.append(m // 2)
+        dest.append(m // 2)
+        weights[positive] = 0.5
+        weights.append(0.5)
+    return np.array(dest), np.array(src), np.array(weights)
+
+def _last_axis_map(m: int, n: int):
+    # rfftn halves, irfftn mirrors the split Nyquist half onto -m/2 itself
+    indices = np.arange(m // 2 + 1)
+    weights = np.ones(m // 2 + 1)
+    if m % 2 == 0 and n > m:
+        weights[-1] = 0.5
+    return indices, indices, weights
+
+def _kept_frequencies(dim: int, kept: int):
+    # kept is odd, DC and kept // 2 positive frequencies, then kept // 2 negative ones at the end of the axis
+    half = min(kept // 2, (dim - 1) // 2)
+    return np.concatenate([np.arange(half + 1), np.arange(dim - half, dim)])
+
+
 # TODO: Time using timeit.timeit not resource.getrusage
-def compress_func(charge: PGrid, mag: PGrid, dims: list[int]):
+def compress_func(charge: PGrid, mag: PGrid, dims: list[int], params: dict = None):
 
     time_start = perf_counter()
+    params = params or get_params()
 
-    dims = charge.grid_shape
-    compressed_dims = [dim // int(sys.argv[3]) for dim in dims]
-
-    charge_compressed = charge.lossy_smooth_compression(compressed_dims, float(sys.argv[4]))
-    mag_compressed = mag.lossy_smooth_compression(compressed_dims, float(sys.argv[4]))
+    with trace.span("pyrho_compress", component="charge", mode=params.get("mode", "smooth")):
+        charge_compressed = compress_grid(charge, params)
+    with trace.span("pyrho_compress", component="mag", mode=params.get("mode", "smooth")):
+        mag_compressed = compress_grid(mag, params)
 
     time_end = perf_counter()
 
     return charge_compressed, mag_compressed, time_end - time_start
 
 
-def store_compressed(chgcar_fn: str, charge, mag, structure, data_aug, dims):
-    # np.savez_compressed(f"{chgcar_fn}_compressed.npz", charge=charge, mag=mag, dims=dims)
-    with gzip.GzipFile(f"{chgcar_fn}_pyrho_compressed_charge.npy.gz", "w") as fc:
-        np.save(fc, charge)
-    with gzip.GzipFile(f"{chgcar_fn}_pyrho_compressed_mag.npy.gz", "w") as fm:
-        np.save(fm, mag)
+def compress_section(file_no_ext: str, section: str, grid: PGrid, dims: list[int]):
+    time_start = perf_counter()
+
+    params = get_params()
+    with trace.span("pyrho_compress", component=section, mode=params.get("mode", "smooth")):
+        compressed = compress_grid(grid, params)
+
+    time_end = perf_counter()
+
+    return compressed, time_end - time_start
+
 
-    charge_fs = io2.get_file_size_mb(f"{chgcar_fn}_pyrho_compressed_charge.npy.gz")
-    mag_fs = io2.get_file_size_mb(f"{chgcar_fn}_pyrho_compressed_mag.npy.gz")
+def store_compressed(chgcar_fn: str, charge, mag, structure, data_aug, dims, params: dict = None):
+    params = params or get_params()
+    components = []
+    for section, compressed in [("charge", charge), ("mag", mag)]:
+        if grid_analysis.is_trivial(compressed):
+            components += grid_analysis.container_components(section, compressed, params)
+        elif isinstance(compressed, dict):
+            components.append({"name": section, "kind": "ndarray", "payload": compressed["coeffs"], "encoding": "auto",
+                               "params": {**params, "scale": compressed["scale"], "grid_dtype": compressed["dtype"]}})
+        else:
+            components.append({"name": section, "kind": "ndarray", "payload": compressed, "encoding": "auto", "params": params})
+    chgcar.store_structure_aug_dims_pymatgen(chgcar_fn, structure, data_aug, dims, "pyrho", components)
 
-    chgcar.store_structure_aug_dims_pymatgen(chgcar_fn, structure, data_aug, dims)
+    charge_fs = chgcar.get_component_group_size_mb(chgcar_fn, "pyrho", "charge")
+    mag_fs = chgcar.get_component_group_size_mb(chgcar_fn, "pyrho", "mag")
 
     return charge_fs, mag_fs
 
 def retrieve_compressed(file: str):
     chgcar_fn = io2.get_only_file_name(file)
-    files_required = [f"{chgcar_fn}_pyrho_compressed_charge.npy.gz", f"{chgcar_fn}_pyrho_compressed_mag.npy.gz", f"{chgcar_fn}_dims.txt", f"{chgcar_fn}_structure.cif", f"{chgcar_fn}_data_aug.txt"]
-    if not io2.check_files(files_required):
+    if not io2.check_files([chgcar.container_file(chgcar_fn, "pyrho")]):
         print(f"{file}: Missing files for decompression")
         return None
 
-    with gzip.GzipFile(f"{chgcar_fn}_pyrho_compressed_charge.npy.gz", "r") as fc:
-        charge_compressed = np.load(fc)
-    with gzip.GzipFile(f"{chgcar_fn}_pyrho_compressed_mag.npy.gz", "r") as fm:
-        mag_compressed = np.load(fm)
+    toc = container.read_toc(chgcar.container_file(chgcar_fn, "pyrho"))
+    names = [name for section in ["charge", "mag"] for name in grid_analysis.component_names(toc, section, [section])]
+    structure, lattice, data_aug, dims, components = chgcar.retrieve_compressed_pymatgen(chgcar_fn, "pyrho", names)
+
+    compressed = []
+    for section in ["charge", "mag"]:
+        params = container.get_section_entry(toc, section).get("params", {})
+        descriptor = grid_analysis.from_container(toc, components, section)
+        if descriptor is not None:
+            compressed.append(descriptor)
+        elif params.get("mode") == "fourier":
+            # Containers written before grid_dtype was recorded held float64 grids
+            compressed.append({"coeffs": components[section], "scale": params["scale"], "mode": "fourier", "dtype": params.get("grid_dtype", "<f8")})
+        else:
+            compressed.append(components[section])
 
-    structure, lattice, data_aug, dims = chgcar.retrieve_structure_aug_dims_pymatgen(chgcar_fn)
+    return chgcar_fn, compressed[0], compressed[1], dims, structure, lattice, data_aug
 
-    return chgcar_fn, charge_compressed, mag_compressed, dims, structure, lattice, data_aug
 
+def decompress_grids(compressed: list, dims: list[int]):
+    # Described grids are rebuilt directly, the rest share one batched transform
+    def decompress(rest):
+        return fourier_reconstruct(rest, dims) if isinstance(rest[0], dict) else upsample_grids(rest, dims)
+    return grid_analysis.decompress_grids(compressed, dims, decompress)
 
-def decompress_func(data: np.ndarray, lattice: np.ndarray, dims: list[int]):
+def decompress_func(data, lattice: np.ndarray, dims: list[int]):
     time_start = perf_counter()
 
-    pgrid = PGrid(data, lattice)
-    up_sample_ratio = dims[0] // data.shape[0]
-    pgrid_upscale = pgrid.get_transformed(
-        sc_mat=np.eye(3),
-        grid_out=dims,
-        up_sample=up_sample_ratio
-        # up_sample=1
-    )
+    pgrid_upscale = PGrid(decompress_grids([data], dims)[0], lattice)
 
     time_end = perf_counter()
 
@@ -87,9 +228,9 @@ def remake_chgcar(chgcar_fn: str, charge_pgrid: PGrid, mag_pgrid: PGrid, structu
 
     cgden = ChargeDensity(pgrids={"total": charge_pgrid, "diff": mag_pgrid}, structure=structure)
 
-    chgcar = cgden.to_Chgcar()
-    chgcar.data_aug = data_aug
-    chgcar.write_file(f"{chgcar_fn}_pyrho.vasp")
+    vasp_cden = cgden.to_Chgcar()
+    vasp_cden.data_aug = data_aug
+    chgcar.write_chgcar_pymatgen(vasp_cden, f"{chgcar_fn}_pyrho.vasp")
 
 def compress_data(file: str, file_no_ext: str):
     structure, charge, mag, data_aug, dims, _ = chgcar.parse_chgcar_pymatgen(file)
@@ -107,10 +248,15 @@ def compress_file_helper(file: str, file_no_ext: str):
     return file_no_ext, charge, mag, compress_duration, fs, compressed_charge_fs, compressed_mag_fs
 
 def decompress_data(file_no_ext, charge, mag, lattice, dims):
-    decompress_charge, decompress_charge_duration = decompress_func(charge, lattice, dims)
-    decompress_mag, decompress_mag_duration = decompress_func(mag, lattice, dims)
+    # Charge and mag share lattice and dims, so they go through one batched transform
+    time_start = perf_counter()
 
-    return file_no_ext, decompress_charge, decompress_mag, decompress_charge_duration + decompress_mag_duration
+    with trace.span("pyrho_decompress", component="charge+mag"):
+        decompress_charge, decompress_mag = decompress_grids([charge, mag], dims)
+
+    time_end = perf_counter()
+
+    return file_no_ext, PGrid(decompress_charge, lattice), PGrid(decompress_mag, lattice), time_end - time_start
 
 def decompress_file_helper(file: str):
     if retrieve_compressed(file) is None:
@@ -138,6 +284,11 @@ def main():
             print(file_no_ext, "Charge Original File Size: ", file_metrics["orig_file_size"], "MB")
             print(file_no_ext, "Charge Compressed Data Size: ", file_metrics["compressed_data_size"], "MB")
 
+    if method == "compress_pipeline":
+        orig_values, all_metrics, stage_metrics = io2.compress_dir_pipeline(files, compress_section, store_compressed)
+        print(json.dumps(all_metrics, sort_keys=True, indent=4))
+        print(json.dumps(stage_metrics, sort_keys=True, indent=4))
+
     if method == "decompress":
         decompressed_values, all_metrics = io2.decompress_dir(files, decompress_file_helper, "pyrho")
         for file_no_ext, file_metrics in all_metrics.items():
@@ -151,7 +302,9 @@ def main():
         decompressed_values, decompress_metrics = io2.decompress_dir(files, decompress_file_helper, "pyrho")
 
         all_metrics = chgcar.generate_metrics(orig_values, decompressed_values, compress_metrics, decompress_metrics)
-        chgcar.write_metrics_to_file("metrics.json", all_metrics, f"pyrho_{sys.argv[3]}_{sys.argv[4]}")
+        params = get_params()
+        entry_name = f"pyrho_{sys.argv[3]}_{sys.argv[4]}" + (f"_fourier_{params['dtype']}" if params.get("mode") == "fourier" else "")
+        metrics_store.record_metrics(all_metrics, "pyrho", params, entry_name)
 
     if method == "remake_no_file":
         print("Starting compression...")
@@ -0,0 +1,107 @@
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import pandas as pd
+
+from autotune import CODEC_MODULES, run_trial
+from utils import chgcar, io2, metrics_store
+
+"""
+sys.argv[1] = chgcar_folder
+sys.argv[2] = matrix json file, {codec: [[param, ...], ...]} where each param list is that codec's sys.argv[3:] (same as bench_suite)
+              e.g. {"pyrho": [["2", "0.1"], ["4", "0.1"]], "sz3": [["0.001"], ["0.0001"]], "tthresh": [["-e", "0.01"]]}
+sys.argv[3] = workers (default cpu count)
+sys.argv[4] = consolidated metrics csv file (optional)
+
+Every CHGCAR is parsed once in this process, then forked workers run all (file, codec, params) combinations against
+the inherited grids, which the children share copy-on-write and never write. Each combination's metrics are recorded in
+the metrics store under the entry its codec's remake would use (e.g. pyrho_2_0.1), and printed as one table.
+"""
+
+_parsed = {}
+
+
+def codec_params(codec: str, params: list[str]):
+    # Same params and entry names the codecs' remake paths record
+    if codec == "pyrho" and len(params) > 2 and params[2] == "fourier":
+        dtype = params[3] if len(params) > 3 else "float32"
+        return {"dims_divisor": int(params[0]), "smear_std": float(params[1]), "mode": "fourier", "dtype": dtype}, f"pyrho_{params[0]}_{params[1]}_fourier_{dtype}"
+    if codec == "pyrho":
+        return {"dims_divisor": int(params[0]), "smear_std": float(params[1])}, f"pyrho_{params[0]}_{params[1]}"
+    if codec == "sz3":
+        return {"rel_error": float(params[0]), "brick_size": int(params[1]) if len(params) > 1 else 0}, f"sz3_{params[0]}"
+    return {"target": params[0], "value": float(params[1])}, f"tthresh_{params[0][1:]}_{params[1]}"
+
+
+def run_combination(file: str, codec: str, params: list[str], index: int):
+    module = importlib.import_module(CODEC_MODULES[codec])
+    file_no_ext = file.split(".")[0]
+
+    # Containers are named per combination so concurrent ones on the same file never collide
+    combination_no_ext = f"{file_no_ext}_sweep{index}"
+    try:
+        metrics, _ = run_trial(module, codec, combination_no_ext, _parsed[file], module.parse_params(params))
+    finally:
+        container_fn = chgcar.container_file(combination_no_ext, codec)
+        if io2.check_files([container_fn]):
+            io2.delete_files([container_fn])
+
+    return file_no_ext, metrics
+
+
+def run_matrix(files: list[str], matrix: dict, workers: int):
+    for file in files:
+        _parsed[file] = chgcar.parse_chgcar_pymatgen(file)
+        chgcar.pop_container_metrics(file.split(".")[0])
+
+    combinations = [(file, codec, params) for codec, param_lists in matrix.items() for params in param_lists for file in files]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = [executor.submit(run_combination, file, codec, params, index) for index, (file, codec, params) in enumerate(combinations)]
+
+        results = {}
+        for (file, codec, params), future in zip(combinations, futures):
+            try:
+                file_no_ext, metrics = future.result()
+            except Exception as e:
+                print(f"{file} {codec} {params}: {e}")
+                continue
+            results.setdefault((codec, tuple(params)), {})[file_no_ext] = metrics
+
+    return results
+
+
+def main():
+    folder = sys.argv[1]
+    with open(sys.argv[2]) as f:
+        matrix = json.load(f)
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    output_file = sys.argv[4] if len(sys.argv) > 4 else None
+
+    if not io2.check_dir(folder):
+        print("Invalid directory")
+        sys.exit(1)
+    unknown = [codec for codec in matrix if codec not in CODEC_MODULES]
+    if unknown:
+        print(f"No sweep for {', '.join(unknown)}, choose from {', '.join(CODEC_MODULES)}")
+        sys.exit(1)
+
+    files = sorted(file for file in io2.get_files_in_dir(folder) if file.endswith(".vasp") and not any(file.endswith(f"_{codec}.vasp") for codec in CODEC_MODULES))
+    results = run_matrix(files, matrix, workers)
+
+    rows = []
+    for (codec, params), all_metrics in results.items():
+        store_params, entry_name = codec_params(codec, list(params))
+        metrics_store.record_metrics(all_metrics, codec, store_params, entry_name)
+        rows += [{"codec": codec, "params": " ".join(params), "file": file_no_ext, **metrics} for file_no_ext, metrics in all_metrics.items()]
+
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    if output_file:
+        df.to_csv(output_file, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,264 @@
-import gzip
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import json
 import sys
+import threading
 from time import perf_counter
 import numpy as np
 from pyrho.charge_density import ChargeDensity, PGrid
 
 from lib.sz3.tools.pysz import pysz
-from utils import chgcar, io2
+from utils import chgcar, container, grid_analysis, io2, metrics_store, spin_basis, trace
 
 """
 sys.argv[1] = chgcar_folder
-sys.argv[2] = compress/decompress/remake/remake_no_file
+sys.argv[2] = compress/compress_pipeline/decompress/remake/remake_no_file
 sys.argv[3] = relative target accuracy
+sys.argv[4] = brick edge length (optional, default 0 = whole grid as one brick)
+sys.argv[5] = brick workers (optional, default cpu count)
+
+CHGCAR_SPIN_BASIS picks the basis charge and mag are coded in (see utils/spin_basis.py), the relative bound still holds
+on the original charge and mag. compress_pipeline codes them independently
+
+read_region(path, component, slices) reads part of one component from a stored {chgcar}_sz3.chgz
 """
 
 SZPATH = "./lib/sz3/build/tools/sz3c/libSZ3c.dylib"
-SZ3 = pysz.SZ(SZPATH)
+SZ3_ABS = 0
+BRICK_INDEX_COLUMNS = 8 # x, y, z start, x, y, z shape, payload offset, payload length
 
-# sz = pysz.SZ(SZPATH)
+_sz3_local = threading.local()
 
-def compress_func(charge: np.ndarray, mag: np.ndarray):
-    time_start = perf_counter()
 
-    charge_compressed_data, _ = SZ3.compress(charge, 1, 1e-9, float(sys.argv[3]), 1e-9)
-    mag_compressed_data, _ = SZ3.compress(mag, 1, 1e-9, float(sys.argv[3]), 1e-9)
+def init_sz3():
+    # Executor initializer, loads the SZ3 library once per worker thread
+    _sz3_local.sz3 = pysz.SZ(SZPATH)
+
+def get_sz3():
+    if not hasattr(_sz3_local, "sz3"):
+        init_sz3()
+    return _sz3_local.sz3
+
+
+def parse_params(args: list[str]):
+    # sys.argv[3:] as the params dict the compress, store and decompress functions take
+    return {
+        "rel_error": float(args[0]),
+        "brick_size": int(args[1]) if len(args) > 1 and args[1] else 0,
+        "brick_workers": int(args[2]) if len(args) > 2 and args[2] else None,
+    }
+
+
+def get_params():
+    return parse_params(sys.argv[3:])
+
+
+def brick_slices(dims: list[int], brick_size: int):
+    if brick_size <= 0:
+        return [tuple(slice(0, dim) for dim in dims)]
+
+    starts = [range(0, dim, brick_size) for dim in dims]
+    return [tuple(slice(start, min(start + brick_size, dim)) for start, dim in zip(brick_start, dims)) for brick_start in itertools.product(*starts)]
+
+
+def compress_bricked(data: np.ndarray, rel_error: float, brick_size: int = 0, workers: int = None, abs_error: float = None):
+    # The relative bound is turned into one absolute bound over the whole grid so every brick honours the same error
+    abs_error = rel_error * float(data.max() - data.min()) if abs_error is None else abs_error
+    slices = brick_slices(data.shape, brick_size)
+
+    def compress_brick(brick_slice):
+        compressed, _ = get_sz3().compress(np.ascontiguousarray(data[brick_slice]), SZ3_ABS, abs_error, 0, 0)
+        return compressed
+
+    with ThreadPoolExecutor(workers) as executor:
+        bricks = list(executor.map(compress_brick, slices))
+
+    index = np.empty((len(slices), BRICK_INDEX_COLUMNS), dtype=np.int64)
+    offset = 0
+    for i, (brick_slice, brick) in enumerate(zip(slices, bricks)):
+        index[i, :3] = [s.start for s in brick_slice]
+        index[i, 3:6] = [s.stop - s.start for s in brick_slice]
+        index[i, 6:] = offset, brick.nbytes
+        offset += brick.nbytes
+
+    return {"data": np.concatenate([brick.view(np.uint8).reshape(-1) for brick in bricks]), "bricks": index, "dtype": data.dtype.str}
+
+
+def decompress_bricked(compressed: dict, dims: list[int], workers: int = None):
+    data, index, dtype = compressed["data"], compressed["bricks"], np.dtype(compressed["dtype"])
+    output = np.empty(dims, dtype=dtype)
+
+    def decompress_brick(row):
+        start, shape, (offset, length) = row[:3], row[3:6], row[6:]
+        brick = get_sz3().decompress(data[offset:offset + length], [int(dim) for dim in shape], dtype)
+        output[tuple(slice(s, s + n) for s, n in zip(start, shape))] = brick.reshape(shape)
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(decompress_brick, index))
+
+    return output
+
+
+def read_region(path: str, component: str, slices: tuple):
+    # Decodes only the bricks overlapping slices, indices outside the cell wrap around periodically
+    toc = container.read_toc(path)
+    dims = container.read_section(path, "dims", toc)
+    squeeze_axes = tuple(axis for axis, s in enumerate(slices) if isinstance(s, (int, np.integer)))
+    positions = [_region_positions(s, dim) for s, dim in zip(slices, dims)]
+
+    basis = spin_basis.from_container({name: container.read_section(path, name, toc) for name in spin_basis.component_names(toc, "mag")}, "mag")
+    if basis["basis"] == "independent" or (basis["basis"] == "predict" and component == "charge"):
+        output = _read_component_region(path, toc, dims, component, positions)
+    else:
+        charge, mag = spin_basis.inverse(*[_read_component_region(path, toc, dims, section, positions) for section in ["charge", "mag"]], basis, positions)
+        output = charge if component == "charge" else mag
+
+    return output.squeeze(axis=squeeze_axes) if squeeze_axes else output
+
+
+def _read_component_region(path: str, toc: dict, dims: list[int], component: str, positions: list[np.ndarray]):
+    names = grid_analysis.component_names(toc, component, [])
+    if names:
+        sections = {name: container.read_section(path, name, toc) for name in names}
+        return grid_analysis.reconstruct(grid_analysis.from_container(toc, sections, component), dims)[np.ix_(*positions)]
+
+    index = container.read_section(path, f"{component}_bricks", toc)
+    dtype = np.dtype(container.get_section_entry(toc, component)["params"]["dtype"])
+    brick_starts = [np.unique(index[:, axis]) for axis in range(3)]
+    rows = {tuple(row[:3]): row for row in index}
+
+    # For every axis, group the requested positions by the brick they fall into
+    axis_groups = []
+    for axis in range(3):
+        brick_ids = np.searchsorted(brick_starts[axis], positions[axis], side="right") - 1
+        axis_groups.append([(brick_starts[axis][b], np.flatnonzero(brick_ids == b)) for b in np.unique(brick_ids)])
+
+    output = np.empty([len(p) for p in positions], dtype=dtype)
+    with open(path, "rb") as f:
+        for groups in itertools.product(*axis_groups):
+            row = rows[tuple(int(start) for start, _ in groups)]
+            start, shape, (offset, length) = row[:3], row[3:6], row[6:]
+            payload = np.frombuffer(container.read_section_bytes(f, toc, component, int(offset), int(length)), dtype=np.uint8)
+            brick = get_sz3().decompress(payload, [int(dim) for dim in shape], dtype).reshape(shape)
+
+            out_index = [out_positions for _, out_positions in groups]
+            brick_index = [positions[axis][out_positions] - start[axis] for axis, out_positions in enumerate(out_index)]
+            output[np.ix_(*out_index)] = brick[np.ix_(*brick_index)]
+
+    return output
+
+
+def _region_positions(s, dim: int):
+    if isinstance(s, (int, np.integer)):
+        return np.array([s % dim])
+
+    start = 0 if s.start is None else s.start
+    stop = dim if s.stop is None else s.stop
+    step = 1 if s.step is None else s.step
+    if step <= 0:
+        raise ValueError("read_region only supports positive slice steps")
+
+    return np.arange(start, stop, step) % dim
+
+
+def compress_grid(grid: np.ndarray, abs_error: float = None, params: dict = None):
+    params = params or get_params()
+    # Values within the bound of zero may be described as zero, sz3 would not keep them any closer
+    bound = params["rel_error"] * float(grid.max() - grid.min()) if abs_error is None else abs_error
+    descriptor = grid_analysis.analyze_grid(grid, bound)
+    if descriptor is not None:
+        return descriptor
+    return compress_bricked(grid, params["rel_error"], params["brick_size"], params["brick_workers"], abs_error)
+
+def decompress_grid(compressed: dict, dims: list[int], params: dict = None):
+    if grid_analysis.is_trivial(compressed):
+        return grid_analysis.reconstruct(compressed, dims)
+    return decompress_bricked(compressed, dims, (params or get_params())["brick_workers"])
+
+
+def compress_func(charge: np.ndarray, mag: np.ndarray, params: dict = None):
+    time_start = perf_counter()
+    params = params or get_params()
+
+    # Bounds come from the original grids, spin_basis hands the codec whichever grids its basis needs
+    def compress(grids, bounds, names):
+        compressed = []
+        for grid, bound, name in zip(grids, bounds, names):
+            with trace.span("sz3_compress", component=name):
+                compressed.append(compress_grid(grid, bound, params))
+        return compressed
+
+    bounds = [params["rel_error"] * float(grid.max() - grid.min()) for grid in [charge, mag]]
+    charge_compressed_data, mag_compressed_data = spin_basis.encode(
+        charge, mag, bounds, compress, lambda compressed: decompress_grid(compressed, charge.shape, params),
+        lambda grid, decompressed: float(np.max(np.abs(decompressed - grid))),
+    )
 
     time_end = perf_counter()
 
     return charge_compressed_data, mag_compressed_data, time_end - time_start
 
 
-def store_compressed(chgcar_fn: str, charge, mag, structure, data_aug, dims):
-    with gzip.GzipFile(f"{chgcar_fn}_sz3_compressed_charge.npy.gz", "w") as fc:
-        np.save(fc, charge)
-    with gzip.GzipFile(f"{chgcar_fn}_sz3_compressed_mag.npy.gz", "w") as fm:
-        np.save(fm, mag)
+def compress_section(file_no_ext: str, section: str, grid: PGrid, dims: list[int]):
+    time_start = perf_counter()
+    with trace.span("sz3_compress", component=section):
+        compressed_data = compress_grid(grid.grid_data)
+    time_end = perf_counter()
+
+    return compressed_data, time_end - time_start
+
 
-    charge_fs = io2.get_file_size_mb(f"{chgcar_fn}_sz3_compressed_charge.npy.gz")
-    mag_fs = io2.get_file_size_mb(f"{chgcar_fn}_sz3_compressed_mag.npy.gz")
+def store_compressed(chgcar_fn: str, charge, mag, structure, data_aug, dims, params: dict = None):
+    params = params or get_params()
+    mag, basis = spin_basis.split(mag)
+    components = spin_basis.container_components("mag", basis)
+    for section, compressed in [("charge", charge), ("mag", mag)]:
+        section_params = {"rel_error": params["rel_error"], "brick_size": params["brick_size"], "dtype": compressed["dtype"]}
+        if grid_analysis.is_trivial(compressed):
+            components += grid_analysis.container_components(section, compressed, section_params)
+            continue
+        # Left raw so read_region can seek straight to single bricks, seekable keeps it raw under CHGCAR_LOSSLESS too
+        components.append({"name": section, "kind": "ndarray", "payload": compressed["data"], "params": section_params, "seekable": True})
+        components.append({"name": f"{section}_bricks", "kind": "ndarray", "payload": compressed["bricks"]})
+    chgcar.store_structure_aug_dims_pymatgen(chgcar_fn, structure, data_aug, dims, "sz3", components)
+    chgcar.record_container_metrics(chgcar_fn, {"spin_basis": basis["basis"]})
 
-    chgcar.store_structure_aug_dims_pymatgen(chgcar_fn, structure, data_aug, dims)
+    charge_fs = chgcar.get_component_group_size_mb(chgcar_fn, "sz3", "charge")
+    mag_fs = chgcar.get_component_group_size_mb(chgcar_fn, "sz3", "mag")
 
     return charge_fs, mag_fs
 
 
 def retrieve_compressed(file: str):
     chgcar_fn = io2.get_only_file_name(file)
-    files_required = [f"{chgcar_fn}_sz3_compressed_charge.npy.gz", f"{chgcar_fn}_sz3_compressed_mag.npy.gz", f"{chgcar_fn}_dims.txt", f"{chgcar_fn}_structure.cif", f"{chgcar_fn}_data_aug.txt"]
-    if not io2.check_files(files_required):
+    if not io2.check_files([chgcar.container_file(chgcar_fn, "sz3")]):
         print(f"{file}: Missing files for decompression")
         return None
 
-    with gzip.GzipFile(f"{chgcar_fn}_sz3_compressed_charge.npy.gz", "r") as fc:
-        charge_compressed = np.load(fc)
-    with gzip.GzipFile(f"{chgcar_fn}_sz3_compressed_mag.npy.gz", "r") as fm:
-        mag_compressed = np.load(fm)
-
-    structure, lattice, data_aug, dims = chgcar.retrieve_structure_aug_dims_pymatgen(chgcar_fn)
+    toc = container.read_toc(chgcar.container_file(chgcar_fn, "sz3"))
+    names = [name for section in ["charge", "mag"] for name in grid_analysis.component_names(toc, section, [section, f"{section}_bricks"])]
+    names += spin_basis.component_names(toc, "mag")
+    structure, lattice, data_aug, dims, components = chgcar.retrieve_compressed_pymatgen(chgcar_fn, "sz3", names)
+    charge_compressed, mag_compressed = [
+        grid_analysis.from_container(toc, components, section)
+        or {"data": components[section], "bricks": components[f"{section}_bricks"], "dtype": container.get_section_entry(toc, section)["params"]["dtype"]}
+        for section in ["charge", "mag"]
+    ]
+    mag_compressed = spin_basis.join(mag_compressed, spin_basis.from_container(components, "mag"))
 
     return chgcar_fn, charge_compressed, mag_compressed, dims, structure, lattice, data_aug
 
 
-def decompress_func(charge: np.ndarray, mag: np.ndarray, dims: list[int]):
+def decompress_func(charge: dict, mag: dict, dims: list[int], params: dict = None):
     time_start = perf_counter()
 
-    charge_decompressed_data = SZ3.decompress(charge, dims, np.float32)
-    mag_decompressed_data = SZ3.decompress(mag, dims, np.float32)
+    mag, basis = spin_basis.split(mag)
+    with trace.span("sz3_decompress", component="charge"):
+        charge_decompressed_data = decompress_grid(charge, dims, params)
+    with trace.span("sz3_decompress", component="mag"):
+        mag_decompressed_data = decompress_grid(mag, dims, params)
+    with trace.span("spin_basis_inverse", basis=basis["basis"]):
+        charge_decompressed_data, mag_decompressed_data = spin_basis.inverse(charge_decompressed_data, mag_decompressed_data, basis)
 
     time_end = perf_counter()
 
@@ -92,10 +285,11 @@ def compress_file_helper(file: str, file_no_ext: str):
     return file_no_ext, charge_pgrid, mag_pgrid, compress_duration, fs, charge_fs, mag_fs
 
 
-def decompress_data(file_no_ext, charge, mag, lattice, dims):
-    decompress_charge, decompress_mag, decompress_duration = decompress_func(charge, mag, dims)
+def decompress_data(file_no_ext, charge, mag, lattice, dims, params: dict = None):
+    decompress_charge, decompress_mag, decompress_duration = decompress_func(charge, mag, dims, params)
 
-    decompressed_charge_pgrid, decompressed_mag_pgrid = PGrid(decompress_charge, lattice), PGrid(decompress_mag, lattice)
+    with trace.span("pgrid"):
+        decompressed_charge_pgrid, decompressed_mag_pgrid = PGrid(decompress_charge, lattice), PGrid(decompress_mag, lattice)
 
     return file_no_ext, decompressed_charge_pgrid, decompressed_mag_pgrid, decompress_duration
 
@@ -108,7 +302,8 @@ def decompress_file_helper(file: str):
 
     decompress_charge, decompress_mag, decompress_duration = decompress_func(charge_compressed, mag_compressed, dims)
 
-    decompress_charge_pgrid, decompress_mag_pgrid = PGrid(decompress_charge, lattice), PGrid(decompress_mag, lattice)
+    with trace.span("pgrid"):
+        decompress_charge_pgrid, decompress_mag_pgrid = PGrid(decompress_charge, lattice), PGrid(decompress_mag, lattice)
 
     return chgcar_fn, structure, data_aug, decompress_charge_pgrid, decompress_mag_pgrid, decompress_duration
 
@@ -123,29 +318,35 @@ def main():
     files = io2.get_files_in_dir(folder)
 
     if method == "compress":
-        orig_values, all_metrics = io2.compress_dir(files, compress_file_helper, "sz3")
+        orig_values, all_metrics = io2.compress_dir(files, compress_file_helper, "sz3", initializer=init_sz3)
+        print(json.dumps(all_metrics, sort_keys=True, indent=4))
+
+    elif method == "compress_pipeline":
+        orig_values, all_metrics, stage_metrics = io2.compress_dir_pipeline(files, compress_section, store_compressed)
         print(json.dumps(all_metrics, sort_keys=True, indent=4))
+        print(json.dumps(stage_metrics, sort_keys=True, indent=4))
 
     elif method == "decompress":
-        decompressed_values, all_metrics = io2.decompress_dir(files, decompress_file_helper, "sz3")
+        decompressed_values, all_metrics = io2.decompress_dir(files, decompress_file_helper, "sz3", initializer=init_sz3)
         print(json.dumps(all_metrics, sort_keys=True, indent=4))
 
     elif method == "remake":
         print("Starting compression...")
-        orig_values, compress_metrics = io2.compress_dir(files, compress_file_helper, "sz3")
+        orig_values, compress_metrics = io2.compress_dir(files, compress_file_helper, "sz3", initializer=init_sz3)
         print("Starting decompression...")
-        decompressed_values, decompress_metrics = io2.decompress_dir(files, decompress_file_helper, "sz3")
+        decompressed_values, decompress_metrics = io2.decompress_dir(files, decompress_file_helper, "sz3", initializer=init_sz3)
 
         # TODO: Check the dict keys here
         all_metrics = chgcar.generate_metrics(orig_values, decompressed_values, compress_metrics, decompress_metrics)
         # print(json.dumps(all_metrics, sort_keys=True, indent=4))
-        chgcar.write_metrics_to_file("metrics.json", all_metrics, f"sz3_{sys.argv[3]}")
+        params = get_params()
+        metrics_store.record_metrics(all_metrics, "sz3", {"rel_error": params["rel_error"], "brick_size": params["brick_size"]}, f"sz3_{sys.argv[3]}")
 
     elif method == "remake_no_file":
         print("Starting compression...")
-        orig_values, compressed_values, compress_metrics = io2.compress_dir(files, compress_data, "sz3", write=False)
+        orig_values, compressed_values, compress_metrics = io2.compress_dir(files, compress_data, "sz3", write=False, initializer=init_sz3)
         print("Starting decompression...")
-        decompressed_values, decompress_metrics = io2.decompress_dir_no_file(compressed_values, decompress_data)
+        decompressed_values, decompress_metrics = io2.decompress_dir_no_file(compressed_values, decompress_data, initializer=init_sz3)
 
         all_metrics = chgcar.generate_metrics(orig_values, decompressed_values, compress_metrics, decompress_metrics)
         print(json.dumps(all_metrics, sort_keys=True, indent=4))
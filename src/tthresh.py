@@ -1,16 +1,50 @@
+import atexit
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import json
-import resource
+import math
+import os
+import shutil
 import sys
 import subprocess
+import tempfile
 from time import perf_counter
+import uuid
+import numpy as np
 
 from pymatgen.io.vasp.outputs import Chgcar
 from pyrho.charge_density import ChargeDensity, PGrid
 
-from utils import chgcar, io, io2
+from utils import chgcar, container, grid_analysis, io, io2, metrics_store, spin_basis, trace
+
+"""
+sys.argv[1] = chgcar_folder
+sys.argv[2] = compress/compress_pipeline/decompress/remake/remake_no_file
+sys.argv[3] = error target flag (-e/-r/-p)
+sys.argv[4] = error target value
+sys.argv[5] = staging (optional, keeps one tmpfs staging directory and thread pool for the whole run, every grid still
+               runs its own tthresh process on staged files)
+
+CHGCAR_SPIN_BASIS picks the basis charge and mag are coded in (see utils/spin_basis.py), the target still holds on the
+original charge and mag. compress_pipeline codes them independently
+"""
 
 TTHRESH_BIN = "./lib/tthresh/build/tthresh"
+# tthresh -t names, grids of any other dtype are staged as doubles
+TTHRESH_TYPES = {"float32": "float", "float64": "double"}
+# Grids are staged on tmpfs rather than next to the CHGCARs, so they never touch the disk
+STAGING_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+_staging = None
+
+def parse_params(args: list[str]):
+    # sys.argv[3:] as the params dict the compress and store functions take
+    return {"target": args[0], "value": float(args[1])}
+
+
+def get_params():
+    return parse_params(sys.argv[3:])
+
 
 def main():
     folder = sys.argv[1]
@@ -23,6 +57,9 @@ def main():
 
     files = io2.get_files_in_dir(folder)
 
+    if len(sys.argv) > 5 and sys.argv[5] == "staging":
+        start_staging()
+
     if method == "compress":
         orig_values, all_metrics = io2.compress_dir(files, compress_file_helper, "tthresh", write=True)
         for file_no_ext, file_metrics in all_metrics.items():
@@ -30,6 +67,11 @@ def main():
             print(file_no_ext, "Charge Original File Size: ", file_metrics["orig_file_size"], "MB")
             print(file_no_ext, "Charge Compressed Data Size: ", file_metrics["compressed_data_size"], "MB")
 
+    if method == "compress_pipeline":
+        orig_values, all_metrics, stage_metrics = io2.compress_dir_pipeline(files, compress_section, store_compressed)
+        print(json.dumps(all_metrics, sort_keys=True, indent=4))
+        print(json.dumps(stage_metrics, sort_keys=True, indent=4))
+
     if method == "decompress":
         # decompressed_values = io.decompress_dir(files, decompress_func)
         # for file_name, (charge, mag) in decompressed_values.items():
@@ -40,18 +82,18 @@ def main():
 
     if method == "remake":
         print("Starting compression...")
-        orig_values, compress_metrics = io2.compress_dir(files, compress_file_helper, "pyrho")
+        orig_values, compress_metrics = io2.compress_dir(files, compress_file_helper, "tthresh")
         print("Starting decompression...")
-        decompressed_values, decompress_metrics = io2.decompress_dir(files, decompress_file_helper, "pyrho")
+        decompressed_values, decompress_metrics = io2.decompress_dir(files, decompress_file_helper, "tthresh")
 
         all_metrics = chgcar.generate_metrics(orig_values, decompressed_values, compress_metrics, decompress_metrics)
-        chgcar.write_metrics_to_file("metrics.json", all_metrics, f"tthresh_{sys.argv[3][1:]}_{sys.argv[4]}")
+        metrics_store.record_metrics(all_metrics, "tthresh", get_params(), f"tthresh_{sys.argv[3][1:]}_{sys.argv[4]}")
 
     if method == "remake_no_file":
         print("Starting compression...")
-        orig_values, _, compress_metrics = io2.compress_dir(files, compress_data, "pyrho", write=False)
+        orig_values, compressed_values, compress_metrics = io2.compress_dir(files, compress_data, "tthresh", write=False)
         print("Starting decompression...")
-        decompressed_values, decompress_metrics = io2.decompress_dir_no_file(orig_values, decompress_data, has_data=False)
+        decompressed_values, decompress_metrics = io2.decompress_dir_no_file(compressed_values, decompress_data)
 
         all_metrics = chgcar.generate_metrics(orig_values, decompressed_values, compress_metrics, decompress_metrics)
         print(json.dumps(all_metrics, sort_keys=True, indent=4))
@@ -59,44 +101,230 @@ def main():
 def compress_data(file: str, file_no_ext: str):
     structure, charge_pgrid, mag_pgrid, data_aug, dims, _ = chgcar.parse_chgcar_pymatgen(file)
 
-    charge = charge_pgrid.grid_data
-    mag = mag_pgrid.grid_data
-
-    chgcar.data_to_raw(charge, dims, f"{file_no_ext}_tthresh_charge.raw")
-    chgcar.data_to_raw(mag, dims, f"{file_no_ext}_tthresh_mag.raw")
+    (charge_compressed, charge_compress_duration), (mag_compressed, mag_compress_duration) = compress_pair(charge_pgrid.grid_data, mag_pgrid.grid_data, dims)
 
-    charge_compress_duration = compress_func(file_no_ext, "charge", dims)
-    mag_compress_duration = compress_func(file_no_ext, "mag", dims)
-
-    return file_no_ext, structure, charge_pgrid, mag_pgrid, data_aug, dims, None, None, charge_compress_duration + mag_compress_duration
+    return file_no_ext, structure, charge_pgrid, mag_pgrid, data_aug, dims, charge_compressed, mag_compressed, charge_compress_duration + mag_compress_duration
 
 def compress_file_helper(file: str, file_no_ext: str):
     structure, charge_pgrid, mag_pgrid, data_aug, dims, fs = chgcar.parse_chgcar_pymatgen(file)
 
-    charge = charge_pgrid.grid_data
-    mag = mag_pgrid.grid_data
+    (charge_compressed, charge_compress_duration), (mag_compressed, mag_compress_duration) = compress_pair(charge_pgrid.grid_data, mag_pgrid.grid_data, dims)
+
+    charge_fs, mag_fs = store_compressed(file_no_ext, charge_compressed, mag_compressed, structure, data_aug, dims)
+
+    return file_no_ext, charge_pgrid, mag_pgrid, charge_compress_duration + mag_compress_duration, fs, charge_fs, mag_fs
+
+def compress_section(file_no_ext: str, section: str, grid: PGrid, dims: list[int]):
+    return compress_grids([grid.grid_data], dims)[0]
+
+def store_compressed(file_no_ext: str, charge: dict, mag: dict, structure, data_aug, dims, params: dict = None):
+    params = params or get_params()
+    mag, basis = spin_basis.split(mag)
+    components = spin_basis.container_components("mag", basis)
+    for section, compressed in [("charge", charge), ("mag", mag)]:
+        if grid_analysis.is_trivial(compressed):
+            components += grid_analysis.container_components(section, compressed, params)
+        else:
+            components.append({"name": section, "kind": "bytes", "payload": compressed["data"], "params": {**params, "dtype": compressed["dtype"]}})
+    chgcar.store_structure_aug_dims_pymatgen(file_no_ext, structure, data_aug, dims, "tthresh", components)
+    chgcar.record_container_metrics(file_no_ext, {"spin_basis": basis["basis"]})
+
+    charge_fs = chgcar.get_component_group_size_mb(file_no_ext, "tthresh", "charge")
+    mag_fs = chgcar.get_component_group_size_mb(file_no_ext, "tthresh", "mag")
+
+    return charge_fs, mag_fs
+
+# In-memory backend, grids go through a tmpfs staging directory that is always cleaned up
+def start_staging():
+    # Run-wide staging: one staging directory and thread pool reused by every compress/decompress call. tthresh opens its
+    # -i/-c/-o arguments as regular files, so each grid is still one tthresh process reading and writing tmpfs files
+    global _staging
+    if _staging is None:
+        _staging = (ThreadPoolExecutor(2), tempfile.mkdtemp(prefix="tthresh_", dir=STAGING_DIR))
+        atexit.register(stop_staging)
+    return _staging
+
+def stop_staging():
+    global _staging
+    if _staging is not None:
+        executor, staging_dir = _staging
+        executor.shutdown()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        _staging = None
+
+def compress_grids(grids: list[np.ndarray], dims: list[int], targets: list[tuple] = None, names: list[str] = None):
+    # Charge and mag run as concurrent tthresh processes, returns [({"data": compressed bytes, "dtype": grid dtype}, duration)],
+    # grids grid_analysis can describe skip tthresh and come back as their descriptor.
+    # targets are per grid (flag, value) pairs (default sys.argv[3:5], None where the grid is all zeros), names label the
+    # trace spans
+    targets = targets or [(get_params()["target"], get_params()["value"])] * len(grids)
+    names = names or [None] * len(grids)
+    # A value within the rms bound of zero adds at most the bound to the rms error when it is described as zero
+    descriptors = [grid_analysis.analyze_grid(grid, rms_bound(grid, target) if target else 0.0) for grid, target in zip(grids, targets)]
+    staged = iter(_run_staged(
+        lambda item, dims, staging_dir: compress_grid(item[0], dims, staging_dir, item[1], item[2]),
+        [(grid, target, name) for grid, target, name, descriptor in zip(grids, targets, names, descriptors) if descriptor is None],
+        dims,
+    ))
+    return [(descriptor, 0.0) if descriptor is not None else next(staged) for descriptor in descriptors]
+
+def decompress_grids(compressed: list[dict], dims: list[int]):
+    staged = iter(_run_staged(decompress_grid, [payload for payload in compressed if not grid_analysis.is_trivial(payload)], dims))
+    return [(grid_analysis.reconstruct(payload, dims), 0.0) if grid_analysis.is_trivial(payload) else next(staged) for payload in compressed]
+
+def compress_pair(charge: np.ndarray, mag: np.ndarray, dims: list[int], params: dict = None):
+    # compress_grids for charge and mag through spin_basis, the tthresh target becomes an rms bound on each original grid
+    # and every grid the basis hands over gets the target matching its share of it
+    params = params or get_params()
+    target = (params["target"], params["value"])
+    durations = []
+
+    def compress(grids, bounds, names):
+        compressed = compress_grids(grids, dims, [rms_target(grid, bound, target[0]) for grid, bound in zip(grids, bounds)], names)
+        durations.extend(duration for _, duration in compressed)
+        return [payload for payload, _ in compressed]
+
+    def decompress(payload):
+        (grid, duration), = decompress_grids([payload], dims)
+        durations.append(duration)
+        return grid
+
+    bounds = [rms_bound(grid, target) for grid in [charge, mag]]
+    charge_compressed, mag_compressed = spin_basis.encode(charge, mag, bounds, compress, decompress, lambda grid, decompressed: _rms(decompressed - grid))
+    return [(charge_compressed, durations[0]), (mag_compressed, sum(durations[1:]))]
+
+def decompress_pair(charge: dict, mag: dict, dims: list[int]):
+    mag, basis = spin_basis.split(mag)
+    (charge_grid, charge_duration), (mag_grid, mag_duration) = decompress_grids([charge, mag], dims)
+    charge_grid, mag_grid = spin_basis.inverse(charge_grid, mag_grid, basis)
+    return [(charge_grid, charge_duration), (mag_grid, mag_duration)]
+
+def rms_bound(grid: np.ndarray, target: tuple = None):
+    # tthresh -e bounds ||error|| / ||grid||, -r the rmse, -p the psnr against (max - min) / 2
+    flag, value = target or (get_params()["target"], get_params()["value"])
+    if flag == "-e":
+        return value * _rms(grid)
+    if flag == "-r":
+        return value
+    return float(grid.max() - grid.min()) / (2 * 10 ** (value / 20))
+
+def rms_target(grid: np.ndarray, bound: float, flag: str = None):
+    # Inverse of rms_bound for grid, None where grid_analysis will describe the grid anyway
+    flag = flag or get_params()["target"]
+    if flag == "-r":
+        return flag, bound
+    scale = _rms(grid) if flag == "-e" else float(grid.max() - grid.min()) / 2
+    if scale == 0:
+        return None
+    if flag == "-e":
+        return flag, bound / scale
+    return flag, 20 * math.log10(scale / bound) if bound > 0 else math.inf
+
+def _rms(grid: np.ndarray):
+    return math.sqrt(float(np.mean(np.square(grid, dtype=np.float64))))
+
+def _run_staged(func, items: list, dims: list[int]):
+    if not items:
+        return []
+    if _staging is not None:
+        executor, staging_dir = _staging
+        futures = [executor.submit(trace.bind_file(func), item, dims, staging_dir) for item in items]
+        return [future.result() for future in futures]
+
+    with tempfile.TemporaryDirectory(prefix="tthresh_", dir=STAGING_DIR) as staging_dir:
+        with ThreadPoolExecutor(len(items)) as executor:
+            futures = [executor.submit(trace.bind_file(func), item, dims, staging_dir) for item in items]
+            return [future.result() for future in futures]
+
+def compress_grid(grid: np.ndarray, dims: list[int], staging_dir: str, target: tuple = None, component: str = None):
+    name = os.path.join(staging_dir, uuid.uuid4().hex)
+    raw_fn, compressed_fn = f"{name}.raw", f"{name}_compressed.raw"
+    try:
+        with trace.span("tthresh_stage_in"):
+            grid = np.ascontiguousarray(grid, dtype=grid.dtype if grid.dtype.name in TTHRESH_TYPES else np.float64)
+            grid.tofile(raw_fn)
+
+        time_start = perf_counter()
+        with trace.span("tthresh_compress", component=component):
+            subprocess.run(get_tthresh_compress_files_cmd(raw_fn, compressed_fn, dims, grid.dtype, target), check=True)
+        time_end = perf_counter()
+
+        with trace.span("tthresh_stage_out"):
+            with open(compressed_fn, "rb") as f:
+                compressed = {"data": f.read(), "dtype": grid.dtype.str}
+    finally:
+        _remove_staged([raw_fn, compressed_fn])
+
+    return compressed, time_end - time_start
+
+def decompress_grid(compressed: dict, dims: list[int], staging_dir: str):
+    name = os.path.join(staging_dir, uuid.uuid4().hex)
+    compressed_fn, decompressed_fn = f"{name}_compressed.raw", f"{name}_decompressed.raw"
+    try:
+        with trace.span("tthresh_stage_in"):
+            with open(compressed_fn, "wb") as f:
+                f.write(compressed["data"])
+
+        time_start = perf_counter()
+        with trace.span("tthresh_decompress"):
+            subprocess.run(get_tthresh_decompress_files_cmd(compressed_fn, decompressed_fn), check=True)
+        time_end = perf_counter()
+
+        with trace.span("tthresh_stage_out"):
+            # tthresh decompresses to the type it was given
+            decompressed = np.fromfile(decompressed_fn, dtype=compressed["dtype"]).reshape(dims)
+    finally:
+        _remove_staged([compressed_fn, decompressed_fn])
+
+    return decompressed, time_end - time_start
+
+def _remove_staged(files: list[str]):
+    for f in files:
+        if os.path.exists(f):
+            os.remove(f)
 
-    chgcar.data_to_raw(charge, dims, f"{file_no_ext}_tthresh_charge.raw")
-    chgcar.data_to_raw(mag, dims, f"{file_no_ext}_tthresh_mag.raw")
+def decompress_data(file_no_ext, charge, mag, lattice, dims):
+    (decompress_charge, decompress_charge_duration), (decompress_mag, decompress_mag_duration) = decompress_pair(charge, mag, dims)
 
-    charge_compress_duration = compress_func(file_no_ext, "charge", dims)
-    mag_compress_duration = compress_func(file_no_ext, "mag", dims)
+    decompressed_charge_pgrid, decompressed_mag_pgrid = PGrid(decompress_charge, lattice), PGrid(decompress_mag, lattice)
+
+    return file_no_ext, decompressed_charge_pgrid, decompressed_mag_pgrid, decompress_charge_duration + decompress_mag_duration
 
-    io2.delete_files([f"{file_no_ext}_tthresh_charge.raw", f"{file_no_ext}_tthresh_mag.raw"])
+def decompress_file_helper(file: str):
+    chgcar_fn = io2.get_only_file_name(file)
+    if not io2.check_files([chgcar.container_file(chgcar_fn, "tthresh")]):
+        print(f"{file}: Missing files for decompression")
+        return None
 
-    charge_fs = io2.get_file_size_mb(f"{file_no_ext}_tthresh_charge_compressed.raw")
-    mag_fs = io2.get_file_size_mb(f"{file_no_ext}_tthresh_mag_compressed.raw")
+    toc = container.read_toc(chgcar.container_file(chgcar_fn, "tthresh"))
+    names = [name for section in ["charge", "mag"] for name in grid_analysis.component_names(toc, section, [section])]
+    names += spin_basis.component_names(toc, "mag")
+    structure, lattice, data_aug, dims, components = chgcar.retrieve_compressed_pymatgen(chgcar_fn, "tthresh", names)
+    # Containers written before the dtype was recorded held doubles
+    charge_compressed, mag_compressed = [
+        grid_analysis.from_container(toc, components, section)
+        or {"data": components[section], "dtype": container.get_section_entry(toc, section)["params"].get("dtype", "<f8")}
+        for section in ["charge", "mag"]
+    ]
+    mag_compressed = spin_basis.join(mag_compressed, spin_basis.from_container(components, "mag"))
 
-    chgcar.store_structure_aug_dims_pymatgen(file_no_ext, structure, data_aug, dims)
+    (decompress_charge, decompress_charge_duration), (decompress_mag, decompress_mag_duration) = decompress_pair(charge_compressed, mag_compressed, dims)
 
-    return file_no_ext, charge_pgrid, mag_pgrid, charge_compress_duration + mag_compress_duration, fs, charge_fs, mag_fs
+    charge_pgrid, mag_pgrid = PGrid(decompress_charge, lattice), PGrid(decompress_mag, lattice)
 
+    return chgcar_fn, structure, data_aug, charge_pgrid, mag_pgrid, decompress_charge_duration + decompress_mag_duration
+
+
+# File-based backend, kept as the baseline for bench_tthresh.py
 def compress_func(chgcar_fn: str, section: str, dims: list[int]):
     time_start = perf_counter()
     cmd = get_tthresh_compress_cmd(chgcar_fn, section, dims)
     res = subprocess.run(cmd)
     time_end = perf_counter()
 
+    # The compressed file carries the raw header so its decompressed output can be read shaped
+    chgcar.copy_raw_header(f"{chgcar_fn}_tthresh_{section}.raw", f"{chgcar_fn}_tthresh_{section}_compressed.raw")
+
     return time_end - time_start
 
 
@@ -108,57 +336,32 @@ def decompress_func(compressed_fn: str):
     subprocess.run(cmd)
     time_end = perf_counter()
 
-    return time_end - time_start
-
-def decompress_data(file_no_ext, charge, mag, lattice, dims):
-    decompress_charge_duration = decompress_func(f"{file_no_ext}_tthresh_charge_compressed.raw")
-    decompress_mag_duration = decompress_func(f"{file_no_ext}_tthresh_mag_compressed.raw")
-
-    decompress_charge = chgcar.raw_to_data(f"{file_no_ext}_tthresh_charge_compressed_decompressed.raw")
-    decompress_mag = chgcar.raw_to_data(f"{file_no_ext}_tthresh_mag_compressed_decompressed.raw")
+    chgcar.copy_raw_header(compressed_fn, f"{file_no_ext}_decompressed.raw")
 
-    decompress_charge = decompress_charge.reshape(dims)
-    decompress_mag = decompress_mag.reshape(dims)
-
-    decompressed_charge_pgrid, decompressed_mag_pgrid = PGrid(decompress_charge, lattice), PGrid(decompress_mag, lattice)
-
-    return file_no_ext, decompressed_charge_pgrid, decompressed_mag_pgrid, decompress_charge_duration + decompress_mag_duration
-
-def decompress_file_helper(file: str):
-    chgcar_fn = io2.get_only_file_name(file)
-    files_required = [f"{chgcar_fn}_tthresh_charge_compressed.raw", f"{chgcar_fn}_tthresh_mag_compressed.raw", f"{chgcar_fn}_structure.cif", f"{chgcar_fn}_data_aug.txt", f"{chgcar_fn}_dims.txt"]
-    if not io2.check_files(files_required):
-        print(f"{file}: Missing files for decompression")
-        return None
-
-    decompress_charge_duration = decompress_func(f"{chgcar_fn}_tthresh_charge_compressed.raw")
-    decompress_mag_duration = decompress_func(f"{chgcar_fn}_tthresh_mag_compressed.raw")
-
-    decompress_charge = chgcar.raw_to_data(f"{chgcar_fn}_tthresh_charge_compressed_decompressed.raw")
-    decompress_mag = chgcar.raw_to_data(f"{chgcar_fn}_tthresh_mag_compressed_decompressed.raw")
-    structure, lattice, data_aug, dims = chgcar.retrieve_structure_aug_dims_pymatgen(chgcar_fn)
-
-    decompress_charge = decompress_charge.reshape(dims)
-    decompress_mag = decompress_mag.reshape(dims)
-
-    charge_pgrid, mag_pgrid = PGrid(decompress_charge, lattice), PGrid(decompress_mag, lattice)
+    return time_end - time_start
 
-    return chgcar_fn, structure, data_aug, charge_pgrid, mag_pgrid, decompress_charge_duration + decompress_mag_duration
+def get_tthresh_compress_cmd(chgcar_fn: str, section: str, dims: list[int]):
+    raw_fn = f"{chgcar_fn}_tthresh_{section}.raw"
+    header = chgcar.read_raw_header(raw_fn)
+    return get_tthresh_compress_files_cmd(raw_fn, f"{chgcar_fn}_tthresh_{section}_compressed.raw", dims, header[0] if header else np.float64)
 
+def get_tthresh_decompress_cmd(compressed_fn: str):
+    return get_tthresh_decompress_files_cmd(f"{compressed_fn}.raw", f"{compressed_fn}_decompressed.raw")
 
-def get_tthresh_compress_cmd(chgcar_fn: str, section: str, dims: list[int]):
+def get_tthresh_compress_files_cmd(input_fn: str, compressed_fn: str, dims: list[int], dtype=np.float64, target: tuple = None):
+    flag, value = target or (get_params()["target"], get_params()["value"])
     cmd =  [TTHRESH_BIN,
-                    "-i", f"{chgcar_fn}_tthresh_{section}.raw",
-                    "-t", "double",
+                    "-i", input_fn,
+                    "-t", TTHRESH_TYPES[np.dtype(dtype).name],
                     "-s", str(dims[0]), str(dims[1]), str(dims[2]),
-                    sys.argv[3], sys.argv[4],
-                    "-c", f"{chgcar_fn}_tthresh_{section}_compressed.raw"]
+                    flag, str(value),
+                    "-c", compressed_fn]
     return cmd
 
-def get_tthresh_decompress_cmd(compressed_fn: str):
+def get_tthresh_decompress_files_cmd(compressed_fn: str, decompressed_fn: str):
     cmd =  [TTHRESH_BIN,
-                    "-c", f"{compressed_fn}.raw",
-                    "-o", f"{compressed_fn}_decompressed.raw"]
+                    "-c", compressed_fn,
+                    "-o", decompressed_fn]
     return cmd
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import pickle
+import threading
+
+"""
+Environment:
+CHGCAR_CACHE_DIR = cache directory (default .chgcar_cache, empty string disables the cache)
+CHGCAR_CACHE_MAX_MB = size cap before least recently used entries are evicted (default 4096)
+CHGCAR_CACHE_HASH = 1 to also key entries on a sha256 of the file contents (default 0)
+"""
+
+CACHE_DIR = os.environ.get("CHGCAR_CACHE_DIR", ".chgcar_cache")
+CACHE_MAX_MB = float(os.environ.get("CHGCAR_CACHE_MAX_MB", 4096))
+CACHE_HASH = os.environ.get("CHGCAR_CACHE_HASH", "0") == "1"
+HASH_CHUNK_BYTES = 4 * 1024 * 1024
+# Bumped whenever the parse result changes shape, entries of older formats just miss
+FORMAT_VERSION = 2
+
+_lock = threading.Lock()
+_status = {}
+
+
+def cached(fn: str, parse_func):
+    # parse_func(fn) only runs on a miss, its result is pickled under a key of path, size, mtime (and hash)
+    if not CACHE_DIR:
+        return parse_func(fn)
+
+    path_key, entry_file = _entry_file(fn)
+    try:
+        with open(entry_file, "rb") as f:
+            result = pickle.load(f)
+        os.utime(entry_file)
+        _set_status(fn, "hit")
+        return result
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        pass
+
+    result = parse_func(fn)
+    _set_status(fn, "miss")
+    _store(path_key, entry_file, result)
+    return result
+
+
+def cache_status(fn: str):
+    with _lock:
+        return _status.get(os.path.abspath(fn))
+
+
+def clear_cache():
+    if os.path.isdir(CACHE_DIR):
+        for entry in os.listdir(CACHE_DIR):
+            os.remove(os.path.join(CACHE_DIR, entry))
+
+
+def _set_status(fn: str, status: str):
+    with _lock:
+        _status[os.path.abspath(fn)] = status
+
+
+def _entry_file(fn: str):
+    path = os.path.abspath(fn)
+    stat = os.stat(path)
+    path_key = hashlib.sha1(path.encode()).hexdigest()[:16]
+    state = f"{FORMAT_VERSION}:{stat.st_size}:{stat.st_mtime_ns}"
+    if CACHE_HASH:
+        state += f":{_content_hash(path)}"
+    state_key = hashlib.sha1(state.encode()).hexdigest()[:16]
+
+    return path_key, os.path.join(CACHE_DIR, f"{path_key}_{state_key}.pkl")
+
+
+def _content_hash(path: str):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_BYTES):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _store(path_key: str, entry_file: str, result):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # Write then rename so concurrent readers never see a partial entry
+    tmp_file = f"{entry_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, entry_file)
+
+    with _lock:
+        # Entries for an older version of the same file can never hit again
+        for entry in os.listdir(CACHE_DIR):
+            if entry.startswith(f"{path_key}_") and entry.endswith(".pkl") and os.path.join(CACHE_DIR, entry) != entry_file:
+                _remove(os.path.join(CACHE_DIR, entry))
+        _evict()
+
+
+def _evict():
+    entries = []
+    for entry in os.listdir(CACHE_DIR):
+        if not entry.endswith(".pkl"):
+            continue
+        try:
+            stat = os.stat(os.path.join(CACHE_DIR, entry))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    max_bytes = CACHE_MAX_MB * 1024 * 1024
+    for _, size, entry in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        _remove(os.path.join(CACHE_DIR, entry))
+        total_bytes -= size
+
+
+def _remove(entry_file: str):
+    try:
+        os.remove(entry_file)
+    except FileNotFoundError:
+        pass
@@ -1,65 +1,214 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import numpy as np
 from pymatgen.core.structure import Structure
 
 from pymatgen.io.cif import CifParser
+from pymatgen.io.vasp.inputs import Poscar
 from pymatgen.io.vasp.outputs import Chgcar
 from pyrho.charge_density import ChargeDensity, PGrid
 
 import math
+import mmap
+import os
+import threading
 
-from utils import io2
+from utils import cache, container, io2, memory, trace
 
 
 # CHGCAR Stuff
-def parse_chgcar(chgcar_fn, no_data_fn):
-
-    charge, mag = [], []
-    dims = None
-    is_charge, is_mag = False, False
-
-    with open(chgcar_fn, "r") as fi:
-
-        lines = fi.read().splitlines()
-        fo = open(no_data_fn, "w")
-
-        i = 0
-        while i < len(lines):
-            if not is_charge and not is_mag:
-                fo.write(lines[i] + "\n")
-
-            if not charge and not lines[i].strip():
-                dims = lines[i + 1]
-                is_charge = True
-                fo.write(lines[i + 1] + "\n")
-                i += 1
-            elif is_charge and "augmentation" not in lines[i]:
-                line_nums = lines[i].strip().split(" ")
-                for num in line_nums:
-                    charge.append(float(num))
-            elif is_charge and "augmentation" in lines[i]:
-                fo.write(lines[i] + "\n")
-                is_charge = False
-            elif not mag and dims == lines[i]:
-                is_mag = True
-            elif is_mag and "augmentation" not in lines[i]:
-                line_nums = lines[i].strip().split(" ")
-                for num in line_nums:
-                    mag.append(float(num))
-            elif is_mag and "augmentation" in lines[i]:
-                fo.write(lines[i] + "\n")
-                is_mag = False
+PARSE_CHUNK_BYTES = 1024 * 1024
 
-            i += 1
 
-        fo.close()
+def parse_chgcar(chgcar_fn, no_data_fn):
 
-    dims = [int(dim) for dim in dims.strip().split()]
+    with open(chgcar_fn, "rb") as fi, mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+        # Header ends at the first blank line, the grid dims follow it
+        blank = _find_blank_line(mm)
+        dims_start = mm.find(b"\n", blank) + 1
+        dims_end = mm.find(b"\n", dims_start)
+        dims_line = mm[dims_start:dims_end]
+        dims = [int(dim) for dim in dims_line.split()]
+
+        charge_start = dims_end + 1
+        charge_end = _find_block_end(mm, charge_start, dims)
+        charge = _parse_block(fi, mm, charge_start, charge_end, dims)
+
+        # Magnetization block starts after the next line identical to dims
+        data_spans = [(charge_start, charge_end)]
+        mag = np.empty(0)
+        mag_dims = mm.find(b"\n" + dims_line + b"\n", charge_end)
+        if charge_end < len(mm) and mag_dims != -1:
+            mag_start = mag_dims + len(dims_line) + 2
+            mag_end = _find_block_end(mm, mag_start, dims)
+            mag = _parse_block(fi, mm, mag_start, mag_end, dims)
+            data_spans.append((mag_start, mag_end))
+
+        # no_data keeps every line except the grid values
+        with open(no_data_fn, "wb") as fo:
+            pos = 0
+            for span_start, span_end in data_spans:
+                fo.write(mm[pos:span_start])
+                pos = span_end
+            fo.write(mm[pos:])
+            if mm[-1:] != b"\n":
+                fo.write(b"\n")
 
     return dims, charge, mag
 
 
+def _find_blank_line(mm: mmap.mmap):
+    pos = 0
+    while pos < len(mm):
+        line_end = mm.find(b"\n", pos)
+        if line_end == -1:
+            break
+        if not mm[pos:line_end].strip():
+            return pos
+        pos = line_end + 1
+
+    raise ValueError("Could not find grid dimensions in CHGCAR")
+
+
+def _find_block_end(mm: mmap.mmap, start: int, dims: list[int]):
+    # A fixed width block ends a known number of lines after its start, only other layouts scan for the augmentation line
+    line_len = mm.find(b"\n", start) + 1 - start
+    n_fields, rem = divmod(line_len - 1, _FIELD_WIDTH)
+    if n_fields and not rem:
+        full_lines, partial = divmod(dims[0] * dims[1] * dims[2], n_fields)
+        end = start + full_lines * line_len
+        if partial:
+            end = mm.find(b"\n", end) + 1 or len(mm)
+        if end == len(mm) or (mm[end - 1:end] == b"\n" and mm[end:end + 12] == b"augmentation"):
+            return end
+
+    aug = mm.find(b"augmentation", start)
+    if aug == -1:
+        return len(mm)
+    return mm.rfind(b"\n", start, aug) + 1
+
+
+def _parse_block(fi, mm: mmap.mmap, start: int, end: int, dims: list[int]):
+    # Decode line-aligned chunks straight into the output, no per-value Python floats
+    data = np.empty(dims[0] * dims[1] * dims[2], dtype=np.float64)
+    chunk = np.empty(PARSE_CHUNK_BYTES, dtype=np.uint8)
+    filled = 0
+
+    pos = start
+    while pos < end:
+        chunk_end = min(pos + PARSE_CHUNK_BYTES, end)
+        if chunk_end < end:
+            chunk_end = mm.rfind(b"\n", pos, chunk_end) + 1 or chunk_end
+
+        fi.seek(pos)
+        n_bytes = fi.readinto(memoryview(chunk)[:chunk_end - pos])
+        values = _decode_fixed_width(chunk[:n_bytes])
+        if values is None:
+            values = np.fromstring(chunk[:n_bytes].tobytes(), dtype=np.float64, sep=" ")
+        if filled + len(values) > len(data):
+            raise ValueError(f"Grid block has more values than dims {dims}")
+        data[filled:filled + len(values)] = values
+        filled += len(values)
+        pos = chunk_end
+
+    if filled != len(data):
+        raise ValueError(f"Grid block has {filled} values, expected {len(data)}")
+
+    # File order is kept, reshaped the same way data_to_raw does
+    return data.reshape(dims)
+
+
+_FIELD_WIDTH = 18
+_SIGNED_POW10 = np.concatenate([10.0 ** np.arange(23), -10.0 ** np.arange(23)])
+_ASCII_ZEROS = np.uint64(0x3030303030303030)
+_EXP_MARK = np.uint64(0x0000FFFF00000000)
+
+
+def _decode_fixed_width(buf: np.ndarray):
+    # VASP writes grid lines as " 0.dddddddddddE+ee" or " -.dddddddddddE+ee" fields of equal
+    # width. Each field is read as three unaligned little-endian uint64 words (at offsets 0, 3
+    # and 10) and decoded with SWAR digit arithmetic. Returns None if the chunk is not in that
+    # layout, in which case the generic text parser is used instead.
+    line_len = buf[:1024].tobytes().find(b"\n") + 1
+    n_fields, rem = divmod(line_len - 1, _FIELD_WIDTH)
+    if n_fields == 0 or rem:
+        return None
+
+    n_lines = len(buf) // line_len
+    if not np.all(buf[line_len - 1:n_lines * line_len:line_len] == ord("\n")):
+        return None
+
+    def word(offset: int):
+        return np.ndarray(shape=(n_lines, n_fields), dtype="<u8", buffer=buf, offset=offset, strides=(line_len, _FIELD_WIDTH))
+
+    # " 0." or " -." prefix
+    prefix = word(0) & np.uint64(0xFFFFFF)
+    negative = prefix == np.uint64(0x2E2D20)
+    if not np.all(negative | (prefix == np.uint64(0x2E3020))):
+        return None
+
+    # Mantissa digits 1-8, then digits 9-11 and the exponent with "E+" masked to "00"
+    high = word(3).copy()
+    tail = word(10).copy()
+    exp_mark = tail & _EXP_MARK
+    exp_negative = exp_mark == np.uint64(0x00002D4500000000)
+    if not np.all(exp_negative | (exp_mark == np.uint64(0x00002B4500000000))):
+        return None
+    tail ^= exp_mark
+    tail |= _ASCII_ZEROS & _EXP_MARK
+    high -= _ASCII_ZEROS
+    tail -= _ASCII_ZEROS
+    if not (_all_digits(high) and _all_digits(tail)):
+        return None
+
+    scratch = np.empty_like(high)
+    for shift, mask in ((8, 0x00FF00FF00FF00FF), (16, 0x0000FFFF0000FFFF), (32, 0x00000000FFFFFFFF)):
+        np.right_shift(high, np.uint64(shift), out=scratch)
+        high *= np.uint64(10 ** (shift // 8))
+        high += scratch
+        high &= np.uint64(mask)
+
+    # Remaining mantissa digits are tail bytes 1-3, exponent digits are bytes 6-7
+    high *= np.uint64(1000)
+    for byte, weight in ((1, 100), (2, 10), (3, 1)):
+        np.right_shift(tail, np.uint64(8 * byte), out=scratch)
+        scratch &= np.uint64(0xFF)
+        scratch *= np.uint64(weight)
+        high += scratch
+    power = ((tail >> np.uint64(48)) & np.uint64(0xFF)).view(np.int64)
+    power *= 10
+    power += (tail >> np.uint64(56)).view(np.int64)
+    np.negative(power, out=power, where=exp_negative)
+    power -= 11
+    if np.any(np.abs(power) >= 23):
+        return None
+
+    # 11 digit mantissas and powers of ten up to 1e22 are exact in float64, so a single
+    # multiply or divide gives the same correctly rounded value as strtod
+    values = high.astype(np.float64)
+    divide = power < 0
+    np.abs(power, out=power)
+    np.add(power, 23, out=power, where=negative)
+    scale = _SIGNED_POW10[power]
+    np.divide(values, scale, out=values, where=divide)
+    np.multiply(values, scale, out=values, where=~divide)
+    values = values.reshape(-1)
+
+    rest = buf[n_lines * line_len:]
+    if len(rest):
+        values = np.concatenate([values, np.fromstring(rest.tobytes(), dtype=np.float64, sep=" ")])
+
+    return values
+
+
+def _all_digits(words: np.ndarray):
+    # Words have had "0" subtracted from every byte, a byte outside 0-9 either borrowed
+    # (high bit set) or overflows its high bit when 0x76 is added
+    return not np.any(((words + np.uint64(0x7676767676767676)) | words) & np.uint64(0x8080808080808080))
+
+
 def remake_chgcar(no_data_fn: str, charge: np.ndarray, mag: np.ndarray, output_fn: str):
 
     fi = open(no_data_fn, "r")
@@ -99,96 +248,483 @@ def remake_chgcar(no_data_fn: str, charge: np.ndarray, mag: np.ndarray, output_f
     fo.close()
 
 
-def write_data(data: np.ndarray, fo):
-    line = ""
-    for i, num in enumerate(data):
-        if i % 5 == 0 and i > 0:
-            fo.write(f" {line[:-1]}\n")
-            line = ""
-
-        if num == 0:
-            base = 0
-            exponent = 0
-        else:
-            exponent = math.floor(math.log10(abs(num)))
-            base = num / (10 ** exponent)
-            base /= 10
-            exponent += 1
-
+WRITE_CHUNK_VALUES = 5 * 64 * 1024
 
-        if base < 0:
-            base_str = f"{base:.11f}"
-            line += base_str[0]
-            line += base_str[2:]
-        else:
-            line += f"{base:.11f}"
 
-        if exponent < 0:
-            line += f"E-{-exponent:02d} "
+def write_data(data: np.ndarray, fo):
+    data = np.asarray(data, dtype=np.float64).reshape(-1)
+    if len(data) == 0:
+        fo.write(" \n")
+        return
+
+    for start in range(0, len(data), WRITE_CHUNK_VALUES):
+        fo.write(format_data(data[start:start + WRITE_CHUNK_VALUES]))
+
+
+def format_data(values: np.ndarray, fortran_rounding: bool = False, trailing_space: bool = False):
+    # Formats values five per line in the VASP 0.dddddddddddE+ee layout.
+    # fortran_rounding=False matches write_data's log10 scaling, True matches pymatgen's
+    # write_file. trailing_space adds the two spaces pymatgen leaves on a short last line.
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    fields, irregular = _format_fields(values, fortran_rounding)
+    format_value = _format_value_fortran if fortran_rounding else _format_value_log10
+
+    # Values the vectorized path is not sure about are formatted one at a time
+    overrides = {i: format_value(values[i]) for i in np.flatnonzero(irregular)}
+    if any(len(text) != _FIELD_WIDTH - 1 for text in overrides.values()):
+        texts = [fields[i, 1:].tobytes().decode() for i in range(len(values))]
+        for i, text in overrides.items():
+            texts[i] = text
+        lines = [" " + " ".join(texts[i:i + 5]) for i in range(0, len(texts), 5)]
+        if trailing_space and len(texts) % 5:
+            lines[-1] += "  "
+        return "\n".join(lines) + "\n"
+
+    for i, text in overrides.items():
+        fields[i, 1:] = np.frombuffer(text.encode(), dtype=np.uint8)
+
+    n_full = len(values) // 5
+    lines = np.empty((n_full, 5 * _FIELD_WIDTH + 1), dtype=np.uint8)
+    lines[:, :-1] = fields[:n_full * 5].reshape(n_full, 5 * _FIELD_WIDTH)
+    lines[:, -1] = ord("\n")
+    text = lines.tobytes()
+
+    if n_full * 5 < len(values):
+        text += fields[n_full * 5:].tobytes() + (b"  \n" if trailing_space else b"\n")
+
+    return text.decode("ascii")
+
+
+_POW10_MIN_EXP = -330
+_POW10_LOOKUP = np.array([10 ** exp if exp < 0 else float(10 ** exp) for exp in range(_POW10_MIN_EXP, 309)])
+
+
+def _format_fields(values: np.ndarray, fortran_rounding: bool):
+    # Returns an (n, 18) byte array of " 0.dddddddddddE+ee" fields and a mask of values
+    # that need the exact scalar formatter (near rounding ties or powers of ten, 3 digit
+    # exponents, inf/nan). Scaling uses the same IEEE operations as the scalar formatters.
+    magnitude = np.abs(values)
+    zero = magnitude == 0
+
+    with np.errstate(all="ignore"):
+        log = np.log10(magnitude)
+        irregular = ~zero & (~np.isfinite(log) | (np.abs(log - np.round(log)) < 1e-9))
+        exponent = np.where(zero | irregular, 0, np.floor(log)).astype(np.int64)
+        irregular |= (exponent < _POW10_MIN_EXP + 11) | (exponent > 300)
+        exponent[irregular] = 0
+
+        if fortran_rounding:
+            scaled = magnitude / _POW10_LOOKUP[exponent - 10 - _POW10_MIN_EXP]
         else:
-            line += f"E+{exponent:02d} "
-
-    fo.write(f" {line[:-1]}\n")
+            scaled = np.abs(values / _POW10_LOOKUP[exponent - _POW10_MIN_EXP] / 10) * 1e11
+        scaled[irregular] = 0
+
+    digits = np.rint(scaled)
+    irregular |= np.abs(scaled - np.floor(scaled) - 0.5) < 1e-4
+    irregular |= digits >= 1e11
+    exponent += 1
+    if fortran_rounding:
+        irregular |= ~zero & (digits < 1e10)
+        irregular |= zero & np.signbit(values)
+    else:
+        exponent[zero] = 0
+    irregular |= np.abs(exponent) > 99
+    digits[irregular] = 0
+    digits = digits.astype(np.int64)
+
+    fields = np.empty((len(values), _FIELD_WIDTH), dtype=np.uint8)
+    fields[:, 0] = ord(" ")
+    fields[:, 1] = np.where(values < 0, ord("-"), ord("0"))
+    fields[:, 2] = ord(".")
+    # Digits are peeled off two uint32 halves, cheaper than 11 int64 divisions
+    high, low = np.divmod(digits, 100000)
+    high, low = high.astype(np.uint32), low.astype(np.uint32)
+    for part, columns in ((low, range(13, 8, -1)), (high, range(8, 2, -1))):
+        for column in columns:
+            quotient = part // np.uint32(10)
+            fields[:, column] = part - quotient * np.uint32(10) + np.uint32(ord("0"))
+            part = quotient
+    fields[:, 14] = ord("E")
+    fields[:, 15] = np.where(exponent < 0, ord("-"), ord("+"))
+    fields[:, 16] = np.abs(exponent) // 10 + ord("0")
+    fields[:, 17] = np.abs(exponent) % 10 + ord("0")
+
+    return fields, irregular
+
+
+def _format_value_log10(num: float):
+    # Scalar formatting used by write_data before it was vectorized, takes np.float64 values
+    if num == 0:
+        base = 0
+        exponent = 0
+    else:
+        exponent = math.floor(math.log10(abs(num)))
+        base = num / (10 ** exponent)
+        base /= 10
+        exponent += 1
+
+    if base < 0:
+        base_str = f"{base:.11f}"
+        text = base_str[0] + base_str[2:]
+    else:
+        text = f"{base:.11f}"
+
+    if exponent < 0:
+        return text + f"E-{-exponent:02d}"
+    return text + f"E+{exponent:02d}"
+
+
+def _format_value_fortran(flt: float):
+    # Same as the format_fortran_float helper in pymatgen's VolumetricData.write_file
+    # Checked on the string so -0.0 takes the signed branch instead of failing like pymatgen does
+    flt_str = f"{flt:.10E}"
+    if flt_str[0] != "-":
+        return f"0.{flt_str[0]}{flt_str[2:12]}E{int(flt_str[13:]) + 1:+03}"
+    return f"-.{flt_str[1]}{flt_str[3:13]}E{int(flt_str[14:]) + 1:+03}"
 
 
 # Data Files
 def data_to_raw(data: list[int], dims: list[int], output_file=None):
-    arr_1d = np.array(data)
+    arr = np.asarray(data)
+    if not np.issubdtype(arr.dtype, np.floating):
+        arr = arr.astype(np.float64)
 
     if output_file:
-        with open(output_file, "wb") as fo:
-            arr_3d = arr_1d.reshape(dims)
-            fo.write(arr_3d.tobytes())
+        raw = np.memmap(output_file, dtype=arr.dtype, mode="w+", shape=tuple(dims))
+        raw[:] = arr.reshape(dims)
+        raw.flush()
+        del raw
+        write_raw_header(output_file, arr.dtype, dims)
 
     # TODO: Modify if 3D data needed
-    return arr_1d
+    return arr.reshape(-1)
+
+
+def raw_to_data(raw_file: str, dtype=np.float64, shape=None):
+    # Zero-copy read-only view, dtype and shape come from the header when there is one
+    header = read_raw_header(raw_file)
+    if header is not None:
+        dtype, shape = header
+
+    return np.memmap(raw_file, dtype=dtype, mode="r", shape=shape)
+
+
+def raw_header_file(raw_file: str):
+    return f"{raw_file}.json"
+
+
+def write_raw_header(raw_file: str, dtype, shape: list[int]):
+    # Sidecar instead of an in-file header so raw files stay readable by tthresh
+    header = {"dtype": np.dtype(dtype).str, "shape": [int(dim) for dim in shape], "order": "C"}
+    with open(raw_header_file(raw_file), "w") as f:
+        json.dump(header, f)
+
+
+def read_raw_header(raw_file: str):
+    try:
+        with open(raw_header_file(raw_file), "r") as f:
+            header = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    return np.dtype(header["dtype"]), tuple(header["shape"])
+
+
+def copy_raw_header(src_raw_file: str, dst_raw_file: str):
+    header = read_raw_header(src_raw_file)
+    if header is not None:
+        write_raw_header(dst_raw_file, *header)
 
 
-def raw_to_data(raw_file: str):
-    with open(raw_file, "rb") as fi:
-        arr = np.frombuffer(fi.read())
-        return arr
+def delete_raw_files(raw_files: list[str]):
+    # Header sidecars go with their raw files
+    for raw_file in raw_files:
+        for fn in [raw_file, raw_header_file(raw_file)]:
+            if os.path.exists(fn):
+                os.remove(fn)
 
 # Pymatgen Methods
+# Lossless stage for compressor components (see utils/lossless.py), overrides each compressor's default when set,
+# except on components stored with "seekable": True
+LOSSLESS_ENCODING = os.environ.get("CHGCAR_LOSSLESS")
+# CHGCAR_DTYPE, grid precision from the parse through the codecs and containers to reconstruction, float64 or float32
+GRID_DTYPE = np.dtype(os.environ.get("CHGCAR_DTYPE", "float64"))
+_container_metrics = {}
+_container_metrics_lock = threading.Lock()
+
 def parse_chgcar_pymatgen(chgcar_fn: str):
-    vasp_cden = Chgcar.from_file(chgcar_fn)
-    cden = ChargeDensity.from_file(chgcar_fn)
+    with trace.span("parse"):
+        structure, charge, mag, data_aug, dims = cache.cached(chgcar_fn, _parse_chgcar_pymatgen)
+    if charge.grid_data.dtype != GRID_DTYPE:
+        with trace.span("convert_dtype", dtype=GRID_DTYPE.name):
+            charge, mag, precision_metrics = convert_grids(structure, charge, mag, GRID_DTYPE)
+        record_container_metrics(chgcar_fn.split(".")[0], precision_metrics)
+    fs = io2.get_file_size_mb(chgcar_fn)
+    record_container_metrics(chgcar_fn.split(".")[0], {"parsed_arrays_mb": memory.arrays_mb(charge.grid_data, mag.grid_data)})
+
+    return structure, charge, mag, data_aug, dims, fs
+
+def convert_grids(structure: Structure, charge: PGrid, mag: PGrid, dtype):
+    # Converted once after the parse, the error of the conversion alone is reported as {section}_precision_*
+    converted = [PGrid(grid.grid_data.astype(dtype), grid.lattice) for grid in (charge, mag)]
+    voxel_volume = structure.volume / charge.grid_data.size
+    metrics = grid_error_metrics({
+        "charge_precision": (charge.grid_data, converted[0].grid_data, voxel_volume),
+        "mag_precision": (mag.grid_data, converted[1].grid_data, voxel_volume),
+    })
+    metrics["dtype"] = np.dtype(dtype).name
+
+    return converted[0], converted[1], metrics
+
+def read_chgcar_dims(chgcar_fn: str):
+    # Grid dims from the line after the blank line that ends the positions, without reading any grid data
+    with open(chgcar_fn, "r") as f:
+        for line in f:
+            if not line.strip():
+                return [int(dim) for dim in f.readline().split()[:3]]
+    raise ValueError(f"{chgcar_fn}: no grid dimensions line")
+
+def _parse_chgcar_pymatgen(chgcar_fn: str):
+    # Single parse, the pyrho grids wrap the Chgcar arrays and data_aug is read off the same object
+    with trace.span("chgcar_from_file"):
+        vasp_cden = Chgcar.from_file(chgcar_fn)
+    with trace.span("charge_density_from_pmg"):
+        cden = ChargeDensity.from_pmg(vasp_cden)
 
     structure: Structure = cden.structure
     charge = cden.pgrids["total"]
-    mag = cden.pgrids["diff"]
-    data_aug = vasp_cden.as_dict()["data_aug"]
+    # Non-spin-polarized CHGCARs have no diff block, their mag grid is zero (and described rather than compressed).
+    # The structure carries that through the containers to the remake, which then writes no diff block either
+    structure.properties["spin_polarized"] = "diff" in cden.pgrids
+    mag = cden.pgrids["diff"] if "diff" in cden.pgrids else PGrid(np.zeros(charge.grid_shape), charge.lattice)
+    data_aug = vasp_cden.data_aug
     dims = cden.grid_shape
 
-    fs = io2.get_file_size_mb(chgcar_fn)
+    return structure, charge, mag, data_aug, dims
+
+
+def store_structure_aug_dims_pymatgen(file_no_ext: str, structure: Structure, data_aug, dims: list[int], codec: str = None, components: list[dict] = None):
+    # With a codec everything goes into one {file_no_ext}_{codec}.chgz, components are container sections
+    if codec is not None:
+        with trace.span("structure_to_cif"):
+            cif = structure.to(fmt="cif")
+        with trace.span("encode_data_aug"):
+            encoded_data_aug = encode_data_aug(data_aug)
+        sections = [
+            {"name": "structure", "kind": "text", "payload": cif},
+            {"name": "data_aug", "kind": "json", "payload": encoded_data_aug, "encoding": "gzip"},
+            {"name": "dims", "kind": "json", "payload": [int(dim) for dim in dims]},
+            {"name": "spin_polarized", "kind": "json", "payload": bool(structure.properties.get("spin_polarized", True))},
+        ]
+        for component in components or []:
+            # Seekable components pin their encoding, byte ranges into them are only valid raw
+            encoding = component.get("encoding", "raw") if component.get("seekable") else LOSSLESS_ENCODING or component.get("encoding", "raw")
+            sections.append({"codec": codec, "dims": [int(dim) for dim in dims], **component, "encoding": encoding})
+        with trace.span("write_container", codec=codec):
+            stats = container.write_container(container_file(file_no_ext, codec), sections)
+
+        lossless_metrics = {}
+        for component in components or []:
+            name, component_stats = component["name"], stats[component["name"]]
+            lossless_metrics[f"{name}_lossless"] = component_stats["encoding"]
+            lossless_metrics[f"{name}_lossless_encode_duration"] = component_stats["encode_duration"]
+            lossless_metrics[f"{name}_lossless_bytes_saved"] = component_stats["raw_bytes"] - component_stats["stored_bytes"]
+        record_container_metrics(file_no_ext, lossless_metrics)
+        return
 
-    return structure, charge, mag, data_aug, dims, fs
-
-
-def store_structure_aug_dims_pymatgen(file_no_ext: str, structure: Structure, data_aug, dims: list[int]):
     with open(f"{file_no_ext}_structure.cif", "w") as f:
         f.write(structure.to(fmt="cif"))
-    open(f"{file_no_ext}_data_aug.txt", "w").write(json.dumps(data_aug))
+    open(f"{file_no_ext}_data_aug.txt", "w").write(json.dumps(encode_data_aug(data_aug)))
     open(f"{file_no_ext}_dims.txt", "w").write(json.dumps(dims))
 
-def retrieve_structure_aug_dims_pymatgen(file_no_ext: str):
+def retrieve_structure_aug_dims_pymatgen(file_no_ext: str, codec: str = None):
+    if codec is not None:
+        structure, lattice, data_aug, dims, _ = retrieve_compressed_pymatgen(file_no_ext, codec)
+        return structure, lattice, data_aug, dims
+
     parser = CifParser(f"{file_no_ext}_structure.cif")
     structure = parser.parse_structures()[0]
     lattice = structure.lattice.matrix
-    data_aug = json.loads(open(f"{file_no_ext}_data_aug.txt").read())
+    data_aug = decode_data_aug(json.loads(open(f"{file_no_ext}_data_aug.txt").read()))
     with open(f"{file_no_ext}_dims.txt", "r") as fd:
         dims = json.load(fd)
 
     return structure, lattice, data_aug, dims
 
+def retrieve_compressed_pymatgen(file_no_ext: str, codec: str, names: list[str] = ()):
+    # Metadata and the named components from a single open of the container
+    decode_durations = {}
+    with trace.span("read_container", codec=codec):
+        sections = container.read_sections(container_file(file_no_ext, codec), ["structure", "data_aug", "dims", "spin_polarized", *names], decode_durations)
+    with trace.span("structure_from_cif"):
+        structure = Structure.from_str(sections["structure"], fmt="cif")
+    # Containers without the flag remake with a diff block, as they did before it was stored
+    structure.properties["spin_polarized"] = sections.get("spin_polarized", True)
+    components = {name: sections[name] for name in names}
+    record_container_metrics(file_no_ext, {f"{name}_lossless_decode_duration": decode_durations[name] for name in names})
+
+    return structure, structure.lattice.matrix, decode_data_aug(sections["data_aug"]), sections["dims"], components
+
+def retrieve_component(file_no_ext: str, codec: str, name: str):
+    return container.read_section(container_file(file_no_ext, codec), name)
+
+def record_container_metrics(file_no_ext: str, metrics: dict):
+    with _container_metrics_lock:
+        _container_metrics.setdefault(file_no_ext, {}).update(metrics)
+
+def pop_container_metrics(file_no_ext: str):
+    # Lossless stage metrics gathered while storing or retrieving file_no_ext, picked up by io2 per file
+    with _container_metrics_lock:
+        return _container_metrics.pop(file_no_ext, {})
+
+def container_file(file_no_ext: str, codec: str):
+    return f"{file_no_ext}_{codec}.chgz"
+
+def get_component_group_size_mb(file_no_ext: str, codec: str, name: str):
+    # A component together with its side sections, e.g. charge plus charge_bricks or charge_index
+    toc = container.read_toc(container_file(file_no_ext, codec))
+    return sum(entry["length"] for entry in toc["sections"] if entry["name"] == name or entry["name"].startswith(f"{name}_")) / (1024 * 1024)
+
+def get_component_size_mb(file_no_ext: str, codec: str, name: str):
+    toc = container.read_toc(container_file(file_no_ext, codec))
+    return container.get_section_entry(toc, name)["length"] / (1024 * 1024)
+
+def encode_data_aug(data_aug):
+    # Older pymatgen keeps the augmentation lines as strings, newer parses them to {section: {atom: array}}
+    if not isinstance(data_aug, dict):
+        return data_aug
+
+    encoded = {}
+    for data_key, aug_data in data_aug.items():
+        if isinstance(aug_data, dict):
+            encoded[data_key] = {"atoms": {str(atom): _encode_aug_values(values) for atom, values in aug_data.items()}}
+        else:
+            encoded[data_key] = aug_data
+    return encoded
+
+def decode_data_aug(data_aug):
+    if not isinstance(data_aug, dict):
+        return data_aug
+
+    decoded = {}
+    for data_key, aug_data in data_aug.items():
+        if isinstance(aug_data, dict) and "atoms" in aug_data:
+            decoded[data_key] = {int(atom): _decode_aug_values(values) for atom, values in aug_data["atoms"].items()}
+        else:
+            decoded[data_key] = aug_data
+    return decoded
+
+def _encode_aug_values(values):
+    values = np.asarray(values)
+    if np.iscomplexobj(values):
+        return {"real": values.real.tolist(), "imag": values.imag.tolist()}
+    return values.tolist()
+
+def _decode_aug_values(values):
+    if isinstance(values, dict):
+        return np.array(values["real"]) + 1j * np.array(values["imag"])
+    return np.array(values)
+
+@trace.traced("remake_chgcar")
 def remake_chgcar_pymatgen(charge_pgrid: PGrid, mag_pgrid: PGrid, structure: Structure, data_aug):
-    cgden = ChargeDensity(pgrids={"total": charge_pgrid, "diff": mag_pgrid}, structure=structure)
+    # Non-spin-polarized CHGCARs, flagged at parse time, get no diff block back
+    pgrids = {"total": charge_pgrid, "diff": mag_pgrid}
+    if not structure.properties.get("spin_polarized", True):
+        pgrids = {"total": charge_pgrid}
+    cgden = ChargeDensity(pgrids=pgrids, structure=structure)
 
     chgcar = cgden.to_Chgcar()
     chgcar.data_aug = data_aug
     return chgcar
 
-def generate_metrics(orig_data, decompressed_data, compress_metrics, decompress_metrics):
+@trace.traced("write_chgcar")
+def write_chgcar_pymatgen(vasp_cden: Chgcar, output_fn: str):
+    # Same bytes as Chgcar.write_file, with the grids formatted in bulk
+    comment = getattr(vasp_cden, "name", Poscar(vasp_cden.structure).comment)
+
+    data_keys = ("spin_up", "spin_down") if {"spin_up", "spin_down"}.issubset(vasp_cden.data) else ("total",)
+    if vasp_cden.is_soc:
+        data_keys = ("total", "diff_x", "diff_y", "diff_z")
+    elif vasp_cden.is_spin_polarized and data_keys == ("total",):
+        data_keys = ("total", "diff")
+
+    grids = {data_key: _grid_slabs(vasp_cden.data[data_key]) for data_key in data_keys}
+    write_chgcar_slabs(vasp_cden.structure, vasp_cden.dim, grids, vasp_cden.data_aug, output_fn, comment)
+
+
+def write_chgcar_slabs(structure: Structure, dims: list[int], grids: dict, data_aug, output_fn: str, comment: str = None):
+    # grids maps data keys (total, diff, ...) to iterables of (nx, ny, k) slabs along z, in file order,
+    # so a grid never has to be whole in memory
+    poscar = Poscar(structure)
+    comment = poscar.comment if comment is None else comment
+
+    with open(output_fn, "w") as fo:
+        lines = f"{comment}\n"
+        lines += "   1.00000000000000\n"
+        for vec in structure.lattice.matrix:
+            lines += f" {vec[0]:12.6f}{vec[1]:12.6f}{vec[2]:12.6f}\n"
+        lines += "".join(f"{s:5}" for s in poscar.site_symbols) + "\n"
+        lines += "".join(f"{x:6}" for x in poscar.natoms) + "\n"
+        lines += "Direct\n"
+        for site in structure:
+            a, b, c = site.frac_coords
+            lines += f"{a:10.6f}{b:10.6f}{c:10.6f}\n"
+        lines += " \n"
+        fo.write(lines)
+
+        for data_key, slabs in grids.items():
+            fo.write(f"   {dims[0]}   {dims[1]}   {dims[2]}\n")
+            _write_slabs_fortran_order(slabs, fo)
+            _write_aug(data_aug, data_key, fo)
+
+
+def _grid_slabs(grid: np.ndarray):
+    values_per_slab = grid.shape[0] * grid.shape[1]
+    slabs_per_chunk = max(1, WRITE_CHUNK_VALUES // values_per_slab)
+    for k in range(0, grid.shape[2], slabs_per_chunk):
+        yield grid[:, :, k:k + slabs_per_chunk]
+
+
+def _write_slabs_fortran_order(slabs, fo):
+    # x runs fastest in the file, slabs along z are flattened in Fortran order
+    carry = np.empty(0)
+    for slab in slabs:
+        values = np.concatenate([carry, np.ravel(slab, order="F")])
+        n_full = len(values) // 5 * 5
+        for start in range(0, n_full, WRITE_CHUNK_VALUES):
+            fo.write(format_data(values[start:min(start + WRITE_CHUNK_VALUES, n_full)], fortran_rounding=True))
+        carry = values[n_full:]
+
+    if len(carry):
+        fo.write(format_data(carry, fortran_rounding=True, trailing_space=True))
+
+
+def _write_aug(data_aug, data_key: str, fo):
+    if data_aug is None:
+        return
+
+    aug_data = data_aug.get(data_key, {})
+    if isinstance(aug_data, (list, tuple)):
+        for line in aug_data:
+            text = str(line)
+            fo.write(text if text.endswith("\n") else f"{text}\n")
+        return
+
+    if not isinstance(aug_data, dict):
+        return
+
+    for key in sorted(aug_data):
+        values = np.asarray(aug_data[key])
+        if np.iscomplexobj(values):
+            fo.write(f"augmentation occupancies   {key} {values.size:3d}\n")
+            fo.write(format_data(values.real, fortran_rounding=True, trailing_space=True))
+            fo.write(f"augmentation occupancies (imaginary part)   {key} {values.size:3d}\n")
+            fo.write(format_data(values.imag, fortran_rounding=True, trailing_space=True))
+        else:
+            fo.write(f"augmentation occupancies   {key} {values.size:3d}\n")
+            fo.write(format_data(values, fortran_rounding=True, trailing_space=True))
+
+def generate_metrics(orig_data, decompressed_data, compress_metrics, decompress_metrics, workers: int = None):
     all_metrics = defaultdict(dict)
     for file_no_ext in compress_metrics.keys():
         for k, v in compress_metrics[file_no_ext].items():
@@ -198,38 +734,85 @@ def generate_metrics(orig_data, decompressed_data, compress_metrics, decompress_
 
     for file_no_ext in orig_data.keys():
         orig, decompressed = orig_data[file_no_ext], decompressed_data[file_no_ext]
-        all_metrics[file_no_ext]["charge_mae"] = mae(orig[0].grid_data, decompressed[0].grid_data)
-        all_metrics[file_no_ext]["mag_mae"] = mae(orig[1].grid_data, decompressed[1].grid_data)
-        all_metrics[file_no_ext]["charge_avg_percentage_diff"] = mean_percentage_diff(orig[0].grid_data, decompressed[0].grid_data)
-        all_metrics[file_no_ext]["mag_avg_percentage_diff"] = mean_percentage_diff(orig[1].grid_data, decompressed[1].grid_data)
+        sections = {
+            name: (o.grid_data, d.grid_data, abs(np.linalg.det(o.lattice)) / o.grid_data.size)
+            for name, o, d in zip(("charge", "mag"), orig, decompressed)
+        }
+        with trace.span("error_metrics", file=file_no_ext):
+            all_metrics[file_no_ext].update(grid_error_metrics(sections, workers))
 
     return all_metrics
 
-def write_metrics_to_file(output_file, new_metrics, entry_name):
-    try:
-        f = open(output_file, "r")
-    except FileNotFoundError:
-        f = open(output_file, "w")
-        f.close()
-        f = open(output_file, "r")
-
-    try:
-        metrics_file_json = json.load(f)
-    except json.JSONDecodeError:
-        metrics_file_json = {}
-    f.close()
-
-    metrics_file_json[entry_name] = new_metrics
-    with open(output_file, "w") as f:
-        json.dump(metrics_file_json, f, sort_keys=True, indent=4)
-
 # Math
+METRICS_CHUNK_VALUES = 1024 * 1024
+# n, sum |d|, sum d^2, max |d|, sum |a|, sum a^2, sum a, sum p, min a, max a
+_N, _SUM_ABS, _SUM_SQ, _MAX_ABS, _SUM_ABS_ACTUAL, _SUM_SQ_ACTUAL, _SUM_ACTUAL, _SUM_PREDICTED, _MIN_ACTUAL, _MAX_ACTUAL = range(10)
+
+def grid_error_metrics(sections: dict, workers: int = None):
+    # sections maps a name (charge/mag) to (actual, predicted, voxel_volume). One pass over fixed size chunks,
+    # so the extra memory is a few chunks whatever the grid size, and chunks of every section share one pool.
+    tasks = [(name, actual, predicted, chunk) for name, (actual, predicted, _) in sections.items() for chunk in _metric_chunks(actual.shape)]
+    if workers and workers > 1:
+        with ThreadPoolExecutor(workers) as executor:
+            partials = list(executor.map(lambda task: _chunk_error_sums(*task[1:]), tasks))
+    else:
+        partials = [_chunk_error_sums(*task[1:]) for task in tasks]
+
+    totals = {}
+    for (name, _, _, _), partial in zip(tasks, partials):
+        if name not in totals:
+            totals[name] = partial
+            continue
+        total = totals[name]
+        total[:_MAX_ABS] += partial[:_MAX_ABS]
+        total[_MAX_ABS] = max(total[_MAX_ABS], partial[_MAX_ABS])
+        total[_SUM_ABS_ACTUAL:_MIN_ACTUAL] += partial[_SUM_ABS_ACTUAL:_MIN_ACTUAL]
+        total[_MIN_ACTUAL] = min(total[_MIN_ACTUAL], partial[_MIN_ACTUAL])
+        total[_MAX_ACTUAL] = max(total[_MAX_ACTUAL], partial[_MAX_ACTUAL])
+
+    metrics = {}
+    for name, total in totals.items():
+        voxel_volume = sections[name][2]
+        rmse = math.sqrt(total[_SUM_SQ] / total[_N])
+        value_range = total[_MAX_ACTUAL] - total[_MIN_ACTUAL]
+        metrics[f"{name}_mae"] = total[_SUM_ABS] / total[_N]
+        metrics[f"{name}_rmse"] = rmse
+        metrics[f"{name}_max_abs_error"] = total[_MAX_ABS]
+        metrics[f"{name}_psnr"] = 20 * math.log10(value_range / rmse) if rmse > 0 and value_range > 0 else math.inf
+        metrics[f"{name}_rel_l2"] = _ratio(math.sqrt(total[_SUM_SQ]), math.sqrt(total[_SUM_SQ_ACTUAL]))
+        metrics[f"{name}_avg_percentage_diff"] = _ratio(total[_SUM_ABS], total[_SUM_ABS_ACTUAL]) * 100
+        metrics[f"{name}_integrated_charge_error"] = (total[_SUM_PREDICTED] - total[_SUM_ACTUAL]) * voxel_volume
+
+    return {k: float(v) for k, v in metrics.items()}
+
+def _metric_chunks(shape: tuple):
+    # Slices along the first axis, views for any memory layout so no chunk copies more than it covers
+    if len(shape) == 0:
+        return [()]
+    values_per_row = max(1, math.prod(shape[1:]))
+    rows_per_chunk = max(1, METRICS_CHUNK_VALUES // values_per_row)
+    return [slice(start, start + rows_per_chunk) for start in range(0, shape[0], rows_per_chunk)]
+
+def _chunk_error_sums(actual: np.ndarray, predicted: np.ndarray, chunk):
+    a = np.asarray(actual[chunk], dtype=np.float64)
+    diff = np.asarray(predicted[chunk], dtype=np.float64) - a
+    sum_predicted = float(np.sum(diff)) + float(np.sum(a))
+    sum_sq = float(np.dot(diff.ravel(), diff.ravel()))
+    np.abs(diff, out=diff)
+
+    return np.array([diff.size, np.sum(diff), sum_sq, np.max(diff, initial=0.0), np.sum(np.abs(a)), np.dot(a.ravel(), a.ravel()),
+                     np.sum(a), sum_predicted, np.min(a, initial=np.inf), np.max(a, initial=-np.inf)], dtype=np.float64)
+
+def _ratio(numerator: float, denominator: float):
+    if denominator == 0:
+        return 0.0 if numerator == 0 else math.inf
+    return numerator / denominator
+
 def mae(actual: np.ndarray, predicted: np.ndarray):
-    return np.average(np.absolute((actual.astype("float") - predicted.astype("float"))))
+    return grid_error_metrics({"grid": (actual, predicted, 1.0)})["grid_mae"]
 
 def mean_percentage_diff(actual: np.ndarray, predicted: np.ndarray):
-    actual, predicted = actual.astype("float"), predicted.astype("float")
-    return np.sum(np.abs(actual - predicted))/np.sum(np.abs(actual))*100
+    return grid_error_metrics({"grid": (actual, predicted, 1.0)})["grid_avg_percentage_diff"]
 
 # Random
 def gen_df(values, name="orig"):
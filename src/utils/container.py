@@ -0,0 +1,181 @@
+import json
+import os
+import struct
+from time import perf_counter
+import uuid
+import zlib
+import numpy as np
+
+from utils import lossless, trace
+
+"""
+.chgz layout, all integers little endian:
+header   magic "CHGZ", version u16, flags u16 (reserved), toc length u64, toc crc32 u32
+toc      json {"version", "sections": [{"name", "kind", "encoding", "codec", "params", "dims", "dtype", "shape", "offset", "length", "crc32"}]}
+payloads in toc order, offsets are absolute so any section is one seek away
+
+kind is ndarray/bytes/json/text, encoding is any lossless.py encoding (auto is resolved before writing),
+itemsize is kept for shuffled encodings and crc32 is over the stored (encoded) bytes
+"""
+
+MAGIC = b"CHGZ"
+VERSION = 1
+HEADER = struct.Struct("<4sHHQI")
+
+
+def write_container(fn: str, sections: list[dict]):
+    # sections are dicts with name, kind and payload plus optional encoding/codec/params/dims
+    # Returns {name: {"encoding", "encode_duration", "raw_bytes", "stored_bytes"}} for the lossless stage
+    entries, payloads, stats = [], [], {}
+    for section in sections:
+        entry, payload, stats[section["name"]] = _encode_section(section)
+        entries.append(entry)
+        payloads.append(payload)
+
+    # Offsets depend on the toc length, which depends on the offsets, so settle them iteratively
+    offset_base = HEADER.size
+    while True:
+        offset = offset_base
+        for entry, payload in zip(entries, payloads):
+            entry["offset"], entry["length"] = offset, len(payload)
+            offset += len(payload)
+        toc = json.dumps({"version": VERSION, "sections": entries}, separators=(",", ":")).encode()
+        if HEADER.size + len(toc) == offset_base:
+            break
+        offset_base = HEADER.size + len(toc)
+
+    # Write then rename so readers never see a partial container, the uuid keeps threads writing the same container apart
+    tmp_fn = f"{fn}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_fn, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, 0, len(toc), zlib.crc32(toc)))
+            f.write(toc)
+            for payload in payloads:
+                f.write(payload)
+        os.replace(tmp_fn, fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+    return stats
+
+
+def read_toc(fn: str):
+    with open(fn, "rb") as f:
+        return _read_toc(f)
+
+
+def read_section(fn: str, name: str, toc=None, stats=None):
+    with open(fn, "rb") as f:
+        toc = toc or _read_toc(f)
+        entry = get_section_entry(toc, name)
+        f.seek(entry["offset"])
+        payload = f.read(entry["length"])
+
+    return _decode_section(entry, payload, stats)
+
+
+def read_section_bytes(f, toc: dict, name: str, start: int, length: int):
+    # Byte range of a raw section from an already open container, the section checksum only covers whole reads
+    entry = get_section_entry(toc, name)
+    if entry["encoding"] != "raw":
+        raise ValueError(f"Container section {name} is {entry['encoding']} encoded, byte ranges need raw")
+    if start < 0 or start + length > entry["length"]:
+        raise ValueError(f"Byte range outside container section {name}")
+
+    f.seek(entry["offset"] + start)
+    return f.read(length)
+
+
+def read_sections(fn: str, names=None, stats=None):
+    # stats, when given, collects {name: decode_duration}
+    with open(fn, "rb") as f:
+        toc = _read_toc(f)
+        sections = {}
+        for entry in toc["sections"]:
+            if names is not None and entry["name"] not in names:
+                continue
+            f.seek(entry["offset"])
+            sections[entry["name"]] = _decode_section(entry, f.read(entry["length"]), stats)
+
+    return sections
+
+
+def get_section_entry(toc: dict, name: str):
+    for entry in toc["sections"]:
+        if entry["name"] == name:
+            return entry
+    raise KeyError(f"No section {name} in container")
+
+
+def _read_toc(f):
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError("Truncated container header")
+    magic, version, _, toc_length, toc_crc = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("Not a chgz container")
+    if version > VERSION:
+        raise ValueError(f"Unsupported container version {version}")
+
+    toc = f.read(toc_length)
+    if zlib.crc32(toc) != toc_crc:
+        raise ValueError("Container table of contents checksum mismatch")
+
+    return json.loads(toc)
+
+
+def _encode_section(section: dict):
+    kind = section["kind"]
+    entry = {"name": section["name"], "kind": kind}
+    for key in ("codec", "params", "dims"):
+        if section.get(key) is not None:
+            entry[key] = section[key]
+
+    payload = section["payload"]
+    itemsize = 1
+    if kind == "ndarray":
+        payload = np.ascontiguousarray(payload)
+        entry["dtype"], entry["shape"] = payload.dtype.str, list(payload.shape)
+        itemsize = payload.dtype.itemsize
+        payload = payload.tobytes()
+    elif kind == "json":
+        payload = json.dumps(payload).encode()
+    elif kind == "text":
+        payload = payload.encode()
+    elif kind == "bytes":
+        payload = bytes(payload)
+    else:
+        raise ValueError(f"Unknown section kind: {kind}")
+
+    raw_bytes = len(payload)
+    time_start = perf_counter()
+    with trace.span("lossless_encode", component=section["name"]):
+        payload, entry["encoding"] = lossless.encode(payload, section.get("encoding", "raw"), itemsize)
+    encode_duration = perf_counter() - time_start
+    if entry["encoding"].startswith("shuffle"):
+        entry["itemsize"] = itemsize
+    entry["crc32"] = zlib.crc32(payload)
+
+    stats = {"encoding": entry["encoding"], "encode_duration": encode_duration, "raw_bytes": raw_bytes, "stored_bytes": len(payload)}
+    return entry, payload, stats
+
+
+def _decode_section(entry: dict, payload: bytes, stats=None):
+    if len(payload) != entry["length"] or zlib.crc32(payload) != entry["crc32"]:
+        raise ValueError(f"Container section {entry['name']} checksum mismatch")
+
+    time_start = perf_counter()
+    with trace.span("lossless_decode", component=entry["name"]):
+        payload = lossless.decode(payload, entry["encoding"], entry.get("itemsize", 1))
+    if stats is not None:
+        stats[entry["name"]] = perf_counter() - time_start
+
+    kind = entry["kind"]
+    if kind == "ndarray":
+        return np.frombuffer(payload, dtype=entry["dtype"]).reshape(entry["shape"])
+    if kind == "json":
+        return json.loads(payload)
+    if kind == "text":
+        return payload.decode()
+    return payload
@@ -0,0 +1,93 @@
+import os
+import numpy as np
+
+from utils import container
+
+"""
+Pre-compression analysis that keeps zero, constant and mostly-zero grids (the mag grid of non-magnetic runs) away from the codecs
+
+Environment:
+CHGCAR_TRIVIAL_ABS_ERROR = absolute error allowed when describing a grid without a codec bound, |value| at or below it counts as
+    zero (default 0, exact). The codecs pass their own effective absolute bound instead
+CHGCAR_SPARSE_MAX_FRACTION = largest fraction of values above the bound still stored as index/value pairs (default 0.05)
+
+A described grid is a dict with a "trivial" key in place of the codec payload:
+    {"trivial": "constant", "value": v, "dtype": str}
+    {"trivial": "sparse", "index": flat int64 indices, "values": values at those indices, "dtype": str}
+and is rebuilt by reconstruct without the codec. Constants are stored as one json section, sparse grids as the
+values section plus a {section}_index section.
+"""
+
+TRIVIAL_ABS_ERROR = float(os.environ.get("CHGCAR_TRIVIAL_ABS_ERROR", 0))
+SPARSE_MAX_FRACTION = float(os.environ.get("CHGCAR_SPARSE_MAX_FRACTION", 0.05))
+ANALYSIS_CHUNK_VALUES = 1024 * 1024
+
+
+def analyze_grid(grid: np.ndarray, abs_error: float = None):
+    # Returns a descriptor, or None when the grid needs the codec
+    abs_error = TRIVIAL_ABS_ERROR if abs_error is None else abs_error
+    low, high = float(grid.min()), float(grid.max())
+    if high - low <= 2 * abs_error:
+        value = 0.0 if max(abs(low), abs(high)) <= abs_error else (low + high) / 2
+        return {"trivial": "constant", "value": value, "dtype": grid.dtype.str}
+
+    # Chunked so a dense grid bails out after its first chunk without a full size temporary
+    flat = grid.reshape(-1)
+    limit = SPARSE_MAX_FRACTION * flat.size
+    indices, count = [], 0
+    for start in range(0, flat.size, ANALYSIS_CHUNK_VALUES):
+        chunk_index = np.flatnonzero(np.abs(flat[start:start + ANALYSIS_CHUNK_VALUES]) > abs_error) + start
+        count += chunk_index.size
+        if count > limit:
+            return None
+        indices.append(chunk_index)
+    index = np.concatenate(indices)
+    return {"trivial": "sparse", "index": index, "values": flat[index], "dtype": grid.dtype.str}
+
+def is_trivial(compressed):
+    return isinstance(compressed, dict) and "trivial" in compressed
+
+
+def reconstruct(descriptor: dict, dims: list[int]):
+    dtype = np.dtype(descriptor["dtype"])
+    if descriptor["trivial"] == "constant":
+        return np.full(dims, descriptor["value"], dtype=dtype)
+
+    grid = np.zeros(int(np.prod(dims)), dtype=dtype)
+    grid[descriptor["index"]] = descriptor["values"]
+    return grid.reshape(dims)
+
+def decompress_grids(compressed: list, dims: list[int], decompress):
+    # Described grids are rebuilt here, decompress(list of the rest) returns their grids in order
+    rest = [payload for payload in compressed if not is_trivial(payload)]
+    decompressed = iter(decompress(rest) if rest else [])
+    return [reconstruct(payload, dims) if is_trivial(payload) else next(decompressed) for payload in compressed]
+
+
+def container_components(section: str, descriptor: dict, params: dict = None):
+    params = params or {}
+    if descriptor["trivial"] == "constant":
+        return [{"name": section, "kind": "json", "payload": descriptor, "params": {**params, "trivial": "constant"}}]
+    return [
+        {"name": section, "kind": "ndarray", "payload": descriptor["values"], "encoding": "auto", "params": {**params, "trivial": "sparse"}},
+        {"name": f"{section}_index", "kind": "ndarray", "payload": descriptor["index"], "encoding": "auto"},
+    ]
+
+def component_names(toc: dict, section: str, codec_names: list[str]):
+    # Sections to read for one component, codec_names when it went through the codec
+    trivial = container.get_section_entry(toc, section).get("params", {}).get("trivial")
+    if trivial == "constant":
+        return [section]
+    if trivial == "sparse":
+        return [section, f"{section}_index"]
+    return codec_names
+
+def from_container(toc: dict, sections: dict, section: str):
+    # Descriptor for a described component out of its read sections, None otherwise
+    trivial = container.get_section_entry(toc, section).get("params", {}).get("trivial")
+    if trivial == "constant":
+        return sections[section]
+    if trivial == "sparse":
+        values = sections[section]
+        return {"trivial": "sparse", "index": sections[f"{section}_index"], "values": values, "dtype": values.dtype.str}
+    return None
@@ -1,17 +1,40 @@
 from collections import defaultdict
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+import glob
+import mmap
 import pathlib
+from queue import Queue
+import threading
+from time import perf_counter
+import uuid
+import numpy as np
+from pyrho.charge_density import PGrid
 
-from utils import chgcar
+from utils import cache, chgcar, container, memory, trace
 
-def compress_dir(files: list[str], compress_file_func, compressor_name: str, write = True):
+"""
+Environment:
+CHGCAR_EXECUTOR = threads/processes/serial (default threads)
+CHGCAR_WORKERS = number of workers (default cpu count)
+CHGCAR_MEMORY_BUDGET_MB = caps the workers of compress_dir/decompress_dir by the projected memory of the files (see memory.py)
+"""
+
+EXECUTOR_BACKEND = os.environ.get("CHGCAR_EXECUTOR", "threads")
+EXECUTOR_WORKERS = int(os.environ.get("CHGCAR_WORKERS", 0)) or None
+SHARED_MEMORY_DIR = "/dev/shm"
+SHARED_MEMORY_MIN_BYTES = 1024 * 1024
+PIPELINE_SECTIONS = ("charge", "mag")
+_STAGE_DONE = object()
+
+def compress_dir(files: list[str], compress_file_func, compressor_name: str, write = True, backend=None, max_workers=None, initializer=None):
 
     orig_values = {}
     compressed_values = {}
     metrics = defaultdict(dict)
+    max_workers = _budget_workers([file for file in files if file.endswith(".vasp")], compressor_name, "compress", max_workers)
 
-    with ThreadPoolExecutor() as executor:
+    with get_executor(backend, max_workers, initializer) as executor:
         compress_file_futures = []
         for file in files:
             file_no_ext = file.split(".")[0]
@@ -20,18 +43,20 @@ def compress_dir(files: list[str], compress_file_func, compressor_name: str, wri
             if file_no_ext in orig_values or extension != "vasp":
                 continue
 
-            future_compress_file = executor.submit(compress_file_func, file, file_no_ext)
+            future_compress_file = executor.submit(_compress_file, compress_file_func, file, file_no_ext)
             compress_file_futures.append(future_compress_file)
 
         for future in as_completed(compress_file_futures):
+            result, parse_cache_status, container_metrics, trace_events = future.result()
+            trace.add_events(trace_events)
             if write:
-                file_no_ext, charge, mag, compress_duration, orig_fs, charge_fs, mag_fs = future.result()
+                file_no_ext, charge, mag, compress_duration, orig_fs, charge_fs, mag_fs = result
                 metrics[file_no_ext]["orig_file_size"] = orig_fs
                 metrics[file_no_ext]["compressed_data_size"] = charge_fs + mag_fs
                 # TODO: Add proper compression ratio metric with all files included
                 orig_values[file_no_ext] = [charge, mag]
             else:
-                file_no_ext, structure, charge, mag, _, dims, charge_compressed, mag_compressed, compress_duration = future.result()
+                file_no_ext, structure, charge, mag, _, dims, charge_compressed, mag_compressed, compress_duration = result
                 if len(charge_compressed) > 0 and len(mag_compressed) > 0:
                     compressed_values[file_no_ext] = [charge_compressed, mag_compressed, structure.lattice.matrix, dims]
                     orig_values[file_no_ext] = [charge, mag]
@@ -39,6 +64,12 @@ def compress_dir(files: list[str], compress_file_func, compressor_name: str, wri
                     orig_values[file_no_ext] = [charge, mag, dims]
 
             metrics[file_no_ext]["compress_duration"] = compress_duration
+            if isinstance(executor, SharedMemoryProcessPoolExecutor):
+                metrics[file_no_ext]["shared_grids"] = is_shared(charge, mag)
+            if parse_cache_status:
+                metrics[file_no_ext]["parse_cache"] = parse_cache_status
+            metrics[file_no_ext].update(container_metrics)
+            metrics[file_no_ext].update(trace.summarize(trace_events))
             # TODO: Add file size metrics, mandate compression duration for both charge and mag
 
     if write:
@@ -46,37 +77,36 @@ def compress_dir(files: list[str], compress_file_func, compressor_name: str, wri
     else:
         return orig_values, compressed_values, metrics
 
-def decompress_dir(files: list[str], decompress_file_func, compressor_name: str):
+def decompress_dir(files: list[str], decompress_file_func, compressor_name: str, backend=None, max_workers=None, initializer=None):
     decompressed_values = {}
     metrics = defaultdict(dict)
-    with ThreadPoolExecutor() as executor:
+    max_workers = _budget_decompress_workers(files, compressor_name, max_workers)
+    with get_executor(backend, max_workers, initializer) as executor:
         decompress_file_futures = []
         for file in files:
             file_no_ext = file.split(".")[0]
-            future_decompress_file = executor.submit(decompress_file_func, file)
+            future_decompress_file = executor.submit(_decompress_file, decompress_file_func, file, compressor_name)
             decompress_file_futures.append(future_decompress_file)
 
         for future in as_completed(decompress_file_futures):
-            if future.result():
-                file_no_ext, structure, data_aug, charge, mag, decompress_duration = future.result()
-
-                cgden = chgcar.remake_chgcar_pymatgen(
-                    charge,
-                    mag,
-                    structure,
-                    data_aug
-                )
-                cgden.write_file(f"{file_no_ext}_{compressor_name}.vasp")
+            result, container_metrics, trace_events = future.result()
+            trace.add_events(trace_events)
+            if result:
+                file_no_ext, structure, data_aug, charge, mag, decompress_duration = result
 
                 decompressed_values[file_no_ext] = [charge, mag]
                 metrics[file_no_ext]["decompress_duration"] = decompress_duration
+                if isinstance(executor, SharedMemoryProcessPoolExecutor):
+                    metrics[file_no_ext]["shared_grids"] = is_shared(charge, mag)
+                metrics[file_no_ext].update(container_metrics)
+                metrics[file_no_ext].update(trace.summarize(trace_events))
 
         return decompressed_values, metrics
 
-def decompress_dir_no_file(compressed_values, decompress_func, has_data = True):
+def decompress_dir_no_file(compressed_values, decompress_func, has_data = True, backend=None, max_workers=None, initializer=None):
     decompressed_values = {}
     metrics = defaultdict(dict)
-    with ThreadPoolExecutor() as executor:
+    with get_executor(backend, max_workers, initializer) as executor:
         decompress_file_futures = []
         for file_no_ext, values in compressed_values.items():
             if has_data:
@@ -95,6 +125,267 @@ def decompress_dir_no_file(compressed_values, decompress_func, has_data = True):
 
         return decompressed_values, metrics
 
+def compress_dir_pipeline(files: list[str], compress_section_func, store_func, parse_func=None, parse_workers=1, compress_workers=2, store_workers=1, queue_size=2):
+    # parse -> compress (charge and mag as separate tasks) -> store, each stage with its own threads and a bounded queue in front
+    # compress_section_func(file_no_ext, section, pgrid, dims) -> compressed, duration
+    # store_func(file_no_ext, charge_compressed, mag_compressed, structure, data_aug, dims) -> charge_fs, mag_fs
+    parse_func = parse_func or chgcar.parse_chgcar_pymatgen
+    orig_values = {}
+    metrics = defaultdict(dict)
+    sections_done = defaultdict(dict)
+    lock = threading.Lock()
+
+    def parse_stage(file):
+        file_no_ext = file.split(".")[0]
+        with trace.span("pipeline_parse", file=file_no_ext):
+            parsed = parse_func(file)
+        parse_cache_status = cache.cache_status(file)
+        if parse_cache_status:
+            with lock:
+                metrics[file_no_ext]["parse_cache"] = parse_cache_status
+        return [(file_no_ext, section, parsed) for section in PIPELINE_SECTIONS]
+
+    def compress_stage(item):
+        file_no_ext, section, parsed = item
+        structure, charge, mag, data_aug, dims, fs = parsed
+        with trace.span("pipeline_compress", file=file_no_ext, component=section):
+            compressed, duration = compress_section_func(file_no_ext, section, charge if section == "charge" else mag, dims)
+        with lock:
+            sections_done[file_no_ext][section] = (compressed, duration)
+            if len(sections_done[file_no_ext]) < len(PIPELINE_SECTIONS):
+                return []
+            return [(file_no_ext, parsed, sections_done.pop(file_no_ext))]
+
+    def store_stage(item):
+        file_no_ext, (structure, charge, mag, data_aug, dims, fs), sections = item
+        (charge_compressed, charge_duration), (mag_compressed, mag_duration) = sections["charge"], sections["mag"]
+        with trace.span("pipeline_store", file=file_no_ext):
+            charge_fs, mag_fs = store_func(file_no_ext, charge_compressed, mag_compressed, structure, data_aug, dims)
+        trace_events = trace.pop_file_events(file_no_ext)
+        trace.add_events(trace_events)
+        with lock:
+            metrics[file_no_ext].update(chgcar.pop_container_metrics(file_no_ext))
+            metrics[file_no_ext].update(trace.summarize(trace_events))
+            orig_values[file_no_ext] = [charge, mag]
+            metrics[file_no_ext]["orig_file_size"] = fs
+            metrics[file_no_ext]["compressed_data_size"] = charge_fs + mag_fs
+            metrics[file_no_ext]["compress_duration"] = charge_duration + mag_duration
+        return []
+
+    stages = [("parse", parse_stage, parse_workers), ("compress", compress_stage, compress_workers), ("store", store_stage, store_workers)]
+    queues = [Queue(maxsize=queue_size) for _ in stages] + [None]
+    busy = [[0.0] for _ in stages]
+    errors = []
+
+    time_start = perf_counter()
+    threads = []
+    for i, (_, stage_func, workers) in enumerate(stages):
+        stage_threads = [threading.Thread(target=_stage_worker, args=(stage_func, queues[i], queues[i + 1], busy[i], lock, errors)) for _ in range(workers)]
+        for thread in stage_threads:
+            thread.start()
+        threads.append(stage_threads)
+
+    for file in files:
+        if file.split(".")[1] == "vasp":
+            queues[0].put(file)
+    for i, (_, _, workers) in enumerate(stages):
+        for _ in range(workers):
+            queues[i].put(_STAGE_DONE)
+        for thread in threads[i]:
+            thread.join()
+    wall = perf_counter() - time_start
+
+    if errors:
+        raise errors[0]
+
+    stage_metrics = {"wall_duration": wall}
+    for (name, _, workers), stage_busy in zip(stages, busy):
+        stage_metrics[name] = {"workers": workers, "busy_duration": stage_busy[0], "utilization": stage_busy[0] / (workers * wall) if wall else 0.0}
+
+    return orig_values, metrics, stage_metrics
+
+def _stage_worker(stage_func, in_queue: Queue, out_queue: Queue, busy: list[float], lock, errors: list):
+    while True:
+        item = in_queue.get()
+        if item is _STAGE_DONE:
+            return
+        # After a failure the remaining items are drained so no stage blocks on a full queue
+        if errors:
+            continue
+
+        time_start = perf_counter()
+        try:
+            outputs = stage_func(item)
+        except Exception as e:
+            with lock:
+                errors.append(e)
+            outputs = []
+        with lock:
+            busy[0] += perf_counter() - time_start
+
+        # Time blocked on a full downstream queue is not counted as busy
+        for output in outputs:
+            out_queue.put(output)
+
+def _compress_file(compress_file_func, file: str, file_no_ext: str):
+    # The cache status, container metrics and trace events live in the worker, so they travel back with the result
+    with trace.span("compress_file", file=file_no_ext):
+        result = compress_file_func(file, file_no_ext)
+    return result, cache.cache_status(file), chgcar.pop_container_metrics(file_no_ext), trace.pop_file_events(file_no_ext)
+
+def _decompress_file(decompress_file_func, file: str, compressor_name: str):
+    # Remaking and writing the CHGCAR happens in the worker rather than serially in the caller
+    trace_file = get_only_file_name(file)
+    with trace.span("decompress_file", file=trace_file, source=os.path.basename(file)):
+        result = decompress_file_func(file)
+        if result:
+            file_no_ext, structure, data_aug, charge, mag, decompress_duration = result
+            cgden = chgcar.remake_chgcar_pymatgen(charge, mag, structure, data_aug)
+            chgcar.write_chgcar_pymatgen(cgden, f"{file_no_ext}_{compressor_name}.vasp")
+
+    if not result:
+        return result, {}, trace.pop_file_events(trace_file)
+    chgcar.record_container_metrics(file_no_ext, {"decompressed_arrays_mb": memory.arrays_mb(getattr(charge, "grid_data", charge), getattr(mag, "grid_data", mag))})
+    return result, chgcar.pop_container_metrics(file_no_ext), trace.pop_file_events(trace_file)
+
+def _budget_workers(files: list[str], compressor_name: str, stage: str, max_workers=None):
+    if not memory.MEMORY_BUDGET_MB:
+        return max_workers
+    return memory.max_workers_for_budget(files, compressor_name, stage, max_workers=max_workers or EXECUTOR_WORKERS)
+
+def _budget_decompress_workers(files: list[str], compressor_name: str, max_workers=None):
+    if not memory.MEMORY_BUDGET_MB:
+        return max_workers
+    inputs = _decompress_inputs(files, compressor_name)
+    return memory.max_workers_for_budget(list(inputs), compressor_name, "decompress", max_workers=max_workers or EXECUTOR_WORKERS, dims=list(inputs.values()))
+
+def _decompress_inputs(files: list[str], compressor_name: str):
+    # {chgcar: dims} once per CHGCAR however many of its .vasp, .chgz and remade files are listed, dims come from the
+    # source header or, without it, the container's dims section
+    inputs = {}
+    for file in files:
+        chgcar_fn = get_only_file_name(file)
+        if chgcar_fn in inputs:
+            continue
+        if os.path.exists(f"{chgcar_fn}.vasp"):
+            inputs[chgcar_fn] = chgcar.read_chgcar_dims(f"{chgcar_fn}.vasp")
+            continue
+        containers = [chgcar.container_file(chgcar_fn, compressor_name), *sorted(glob.glob(f"{glob.escape(chgcar_fn)}_*.chgz"))]
+        container_fn = next((fn for fn in containers if os.path.exists(fn)), None)
+        if container_fn is not None:
+            inputs[chgcar_fn] = container.read_section(container_fn, "dims")
+    return inputs
+
+# Executors
+def get_executor(backend=None, max_workers=None, initializer=None, initargs=()):
+    backend = backend or EXECUTOR_BACKEND
+    max_workers = max_workers or EXECUTOR_WORKERS
+
+    if backend == "threads":
+        return ThreadPoolExecutor(max_workers, initializer=initializer, initargs=initargs)
+    if backend == "processes":
+        return SharedMemoryProcessPoolExecutor(max_workers, initializer=initializer, initargs=initargs)
+    if backend == "serial":
+        return SerialExecutor(initializer, initargs)
+
+    raise ValueError(f"Unknown executor backend: {backend}")
+
+class SerialExecutor(Executor):
+    # Runs each task in the caller as it is submitted, for debugging and profiling
+    def __init__(self, initializer=None, initargs=()):
+        if initializer:
+            initializer(*initargs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+class SharedMemoryProcessPoolExecutor(ProcessPoolExecutor):
+    # Grids in the arguments and results of its tasks cross the process boundary through /dev/shm instead of being
+    # pickled into the pipe. Only what goes through this executor is wrapped, other pickling is left alone
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shared_prefix = f"chgcar_{os.getpid()}_{uuid.uuid4().hex}_"
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(_call_shared, self._shared_prefix, fn, _share(args, self._shared_prefix), _share(kwargs, self._shared_prefix))
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        super().shutdown(wait, cancel_futures=cancel_futures)
+        # Blocks are unlinked when they are received, what is left was never received (failed or broken workers).
+        # Without waiting a task may still be on its way to the block
+        if wait:
+            for path in glob.glob(os.path.join(SHARED_MEMORY_DIR, self._shared_prefix + "*")):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+class _SharedArray:
+    # Writes the array to /dev/shm only when it is pickled, so cancelled tasks never create a block
+    def __init__(self, arr: np.ndarray, prefix: str):
+        self.arr = arr
+        self.prefix = prefix
+
+    def __reduce__(self):
+        arr = self.arr
+        if arr.nbytes < SHARED_MEMORY_MIN_BYTES or arr.dtype.hasobject or not os.path.isdir(SHARED_MEMORY_DIR):
+            return np.asarray(arr).__reduce__()
+
+        name = self.prefix + uuid.uuid4().hex
+        with open(os.path.join(SHARED_MEMORY_DIR, name), "xb") as f:
+            f.write(memoryview(np.ascontiguousarray(arr)).cast("B"))
+
+        return _attach_shared_array, (name, arr.dtype.str, arr.shape)
+
+class _SharedPGrid:
+    # A PGrid is rebuilt around its shared grid on the other side, only the lattice is pickled
+    def __init__(self, pgrid: PGrid, prefix: str):
+        self.pgrid = pgrid
+        self.prefix = prefix
+
+    def __reduce__(self):
+        return PGrid, (_SharedArray(self.pgrid.grid_data, self.prefix), self.pgrid.lattice)
+
+def _share(value, prefix: str):
+    if isinstance(value, np.ndarray):
+        return _SharedArray(value, prefix)
+    if isinstance(value, PGrid):
+        return _SharedPGrid(value, prefix)
+    if type(value) in (list, tuple):
+        return type(value)(_share(item, prefix) for item in value)
+    if type(value) is dict:
+        return {key: _share(item, prefix) for key, item in value.items()}
+    return value
+
+def _call_shared(prefix: str, fn, args, kwargs):
+    return _share(fn(*args, **kwargs), prefix)
+
+def _attach_shared_array(name: str, dtype: str, shape: tuple):
+    # Maps the block without copying, the name is unlinked at once so the memory goes with the array
+    path = os.path.join(SHARED_MEMORY_DIR, name)
+    with open(path, "r+b") as f:
+        mm = mmap.mmap(f.fileno(), 0)
+    os.unlink(path)
+
+    return np.frombuffer(mm, dtype=dtype).reshape(shape)
+
+def is_shared(*grids):
+    # Whether every grid (ndarray or PGrid) is backed by a /dev/shm block, i.e. came through a shared memory executor
+    for grid in grids:
+        base = getattr(grid, "grid_data", grid)
+        while isinstance(base, np.ndarray):
+            base = base.base
+        if isinstance(base, memoryview):
+            base = base.obj
+        if not isinstance(base, mmap.mmap):
+            return False
+    return True
+
 # TODO: Implement
 def remake_chgcar_dir(files: list[str], decompressed_values):
 
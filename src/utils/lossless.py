@@ -0,0 +1,112 @@
+import gzip
+import lzma
+from time import perf_counter
+import zlib
+import numpy as np
+
+"""
+Lossless stage applied to container payloads, given as "name" or "name:level":
+raw (alias none), gzip, zlib:<level>, lzma:<preset>, shuffle_zlib:<level> and auto
+
+shuffle_zlib groups the n-th byte of every item together before deflating, which suits float grids
+auto samples the payload, tries AUTO_CANDIDATES and keeps the best (ratio - 1) per second of encode + decode
+"""
+
+AUTO_CANDIDATES = ["raw", "zlib:1", "zlib:6", "lzma:1", "shuffle_zlib:1", "shuffle_zlib:6"]
+AUTO_SAMPLE_CHUNKS = 4
+AUTO_SAMPLE_CHUNK_BYTES = 64 * 1024
+AUTO_MIN_SAVING = 0.01
+
+
+def encode(payload: bytes, encoding: str, itemsize: int = 1):
+    # Returns the encoded bytes and the concrete encoding used, auto resolves to one of the candidates
+    if _name(encoding) == "auto":
+        encoding = choose_encoding(payload, itemsize)
+
+    name, level = _name(encoding), _level(encoding)
+    if name == "raw":
+        return payload, "raw"
+    if name == "gzip":
+        return gzip.compress(payload, mtime=0), encoding
+    if name == "zlib":
+        return zlib.compress(payload, 6 if level is None else level), encoding
+    if name == "lzma":
+        return lzma.compress(payload, preset=6 if level is None else level), encoding
+    if name == "shuffle_zlib":
+        return zlib.compress(shuffle(payload, itemsize), 6 if level is None else level), encoding
+
+    raise ValueError(f"Unknown lossless encoding: {encoding}")
+
+
+def decode(payload: bytes, encoding: str, itemsize: int = 1):
+    name = _name(encoding)
+    if name == "raw":
+        return payload
+    if name == "gzip":
+        return gzip.decompress(payload)
+    if name == "zlib":
+        return zlib.decompress(payload)
+    if name == "lzma":
+        return lzma.decompress(payload)
+    if name == "shuffle_zlib":
+        return unshuffle(zlib.decompress(payload), itemsize)
+
+    raise ValueError(f"Unknown lossless encoding: {encoding}")
+
+
+def choose_encoding(payload: bytes, itemsize: int = 1):
+    sample = _sample(payload, itemsize)
+    if not sample:
+        return "raw"
+
+    best_encoding, best_score = "raw", 0.0
+    for encoding in AUTO_CANDIDATES[1:]:
+        time_start = perf_counter()
+        encoded, _ = encode(sample, encoding, itemsize)
+        decode(encoded, encoding, itemsize)
+        duration = perf_counter() - time_start
+
+        saving = len(sample) / len(encoded) - 1
+        if saving < AUTO_MIN_SAVING:
+            continue
+        score = saving / max(duration, 1e-9)
+        if score > best_score:
+            best_encoding, best_score = encoding, score
+
+    return best_encoding
+
+
+def shuffle(payload: bytes, itemsize: int):
+    if itemsize <= 1:
+        return payload
+    data = np.frombuffer(payload, dtype=np.uint8)
+    n = len(data) // itemsize * itemsize
+    return data[:n].reshape(-1, itemsize).T.tobytes() + data[n:].tobytes()
+
+
+def unshuffle(payload: bytes, itemsize: int):
+    if itemsize <= 1:
+        return payload
+    data = np.frombuffer(payload, dtype=np.uint8)
+    n = len(data) // itemsize * itemsize
+    return data[:n].reshape(itemsize, -1).T.tobytes() + data[n:].tobytes()
+
+
+def _sample(payload: bytes, itemsize: int):
+    # Evenly spaced, item aligned chunks so auto costs the same on any payload size
+    if len(payload) <= AUTO_SAMPLE_CHUNKS * AUTO_SAMPLE_CHUNK_BYTES:
+        return payload
+
+    chunk_bytes = AUTO_SAMPLE_CHUNK_BYTES // itemsize * itemsize
+    stride = (len(payload) - chunk_bytes) // (AUTO_SAMPLE_CHUNKS - 1) // itemsize * itemsize
+    return b"".join(payload[i * stride:i * stride + chunk_bytes] for i in range(AUTO_SAMPLE_CHUNKS))
+
+
+def _name(encoding: str):
+    name = encoding.split(":")[0]
+    return "raw" if name == "none" else name
+
+
+def _level(encoding: str):
+    parts = encoding.split(":")
+    return int(parts[1]) if len(parts) > 1 else None
@@ -0,0 +1,132 @@
+import os
+import resource
+import threading
+import tracemalloc
+
+"""
+Process memory probes for trace spans and a projected footprint from the CHGCAR header
+
+Environment:
+CHGCAR_MEMORY_BUDGET_MB = caps io2 workers so the projected peaks of the files in flight fit (default unset, no cap)
+
+Peaks come from the kernel high-water mark (VmHWM), which writing 5 to /proc/self/clear_refs resets. Every reset
+first folds the mark into all open measurements, so nested and concurrent spans each still see their own peak.
+tracemalloc peaks are handled the same way when tracemalloc is tracing.
+"""
+
+MEMORY_BUDGET_MB = float(os.environ.get("CHGCAR_MEMORY_BUDGET_MB", 0)) or None
+MB = 1024 * 1024
+
+# Projected peak rss over the process baseline per grid value (charge and mag values both counted) for one file,
+# compress includes the parse and the container write, decompress includes the remake and CHGCAR write.
+# pyrho and sz3 were measured on 0.5M to 4M value grids and scale linearly, tthresh and neurcomp follow their staging copies.
+ESTIMATE_BYTES_PER_VALUE = {
+    "compress": {"pyrho": 30, "sz3": 40, "tthresh": 32, "neurcomp": 24},
+    "decompress": {"pyrho": 120, "sz3": 36, "tthresh": 36, "neurcomp": 36},
+}
+ESTIMATE_BASE_MB = 200 # interpreter, numpy, pymatgen and pyrho once imported
+
+_lock = threading.Lock()
+_open = []
+_can_reset = None
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / MB
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak_rss():
+    # Linux 4.0+, without it peaks are the process high-water mark since start
+    global _can_reset
+    if _can_reset is False:
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        _can_reset = True
+    except OSError:
+        _can_reset = False
+    return _can_reset
+
+
+def begin():
+    # Returns a measurement handle for end(), [rss at start, peak rss folded in, tracemalloc start, tracemalloc peak folded in]
+    with _lock:
+        _fold_and_reset()
+        measurement = [rss_mb(), 0.0, None, 0.0]
+        if tracemalloc.is_tracing():
+            measurement[2] = tracemalloc.get_traced_memory()[0] / MB
+        _open.append(measurement)
+    return measurement
+
+def end(measurement: list):
+    with _lock:
+        peak = max(measurement[1], peak_rss_mb())
+        rss_end = rss_mb()
+        stats = {"rss_mb": rss_end, "rss_delta_mb": rss_end - measurement[0], "peak_rss_mb": peak, "peak_rss_delta_mb": peak - measurement[0]}
+        if measurement[2] is not None and tracemalloc.is_tracing():
+            current, traced_peak = tracemalloc.get_traced_memory()
+            stats["tracemalloc_peak_delta_mb"] = max(measurement[3], traced_peak / MB) - measurement[2]
+            stats["tracemalloc_delta_mb"] = current / MB - measurement[2]
+        # By identity, two open measurements can hold equal values
+        _open[:] = [m for m in _open if m is not measurement]
+    return stats
+
+def _fold_and_reset():
+    if _open:
+        peak = peak_rss_mb()
+        traced_peak = tracemalloc.get_traced_memory()[1] / MB if tracemalloc.is_tracing() else 0.0
+        for measurement in _open:
+            measurement[1] = max(measurement[1], peak)
+            measurement[3] = max(measurement[3], traced_peak)
+    reset_peak_rss()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+
+def arrays_mb(*arrays):
+    return sum(getattr(array, "nbytes", 0) for array in arrays) / MB
+
+
+def estimate_chgcar_memory_mb(chgcar_fn: str, codec: str = None, dims: list[int] = None):
+    # Projected peaks for one CHGCAR from the header dims alone, unknown codecs get the largest known estimate
+    from utils import chgcar
+    dims = dims or chgcar.read_chgcar_dims(chgcar_fn)
+    n_values = 2 * dims[0] * dims[1] * dims[2]
+
+    estimate = {"dims": [int(dim) for dim in dims], "grids_mb": chgcar.GRID_DTYPE.itemsize * n_values / MB}
+    for stage, per_codec in ESTIMATE_BYTES_PER_VALUE.items():
+        estimate[f"{stage}_mb"] = per_codec.get(codec, max(per_codec.values())) * n_values / MB
+    estimate["peak_mb"] = max(estimate["compress_mb"], estimate["decompress_mb"])
+    estimate["process_peak_mb"] = ESTIMATE_BASE_MB + estimate["peak_mb"]
+
+    return estimate
+
+def max_workers_for_budget(files: list[str], codec: str = None, stage: str = "compress", budget_mb: float = None, max_workers: int = None, dims: list = None):
+    # Workers such that the largest files running together stay inside the budget, at least one,
+    # dims (per file) stands in for the header of files that are not on disk
+    budget_mb = budget_mb or MEMORY_BUDGET_MB
+    max_workers = max_workers or os.cpu_count()
+    if not budget_mb or not files:
+        return max_workers
+
+    dims = dims or [None] * len(files)
+    peaks = sorted((estimate_chgcar_memory_mb(file, codec, file_dims)[f"{stage}_mb"] for file, file_dims in zip(files, dims)), reverse=True)
+    workers, total = 0, ESTIMATE_BASE_MB
+    for peak in peaks[:max_workers]:
+        if workers and total + peak > budget_mb:
+            break
+        total += peak
+        workers += 1
+
+    return max(1, workers)
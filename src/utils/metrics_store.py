@@ -0,0 +1,144 @@
+import json
+import os
+import sqlite3
+import sys
+import time
+import uuid
+
+"""
+Append-only metrics store, one SQLite row per (run, file) so recording a run never rewrites earlier history
+
+python -m utils.metrics_store exports the store to json:
+sys.argv[1] = output file (default metrics.json)
+sys.argv[2] = codec to export (optional, default all)
+
+Environment:
+CHGCAR_METRICS_DB = database file (default metrics.db)
+
+Rows hold the timestamp, a run id shared by every file of one record_metrics call, the entry name metrics.json used
+(e.g. pyrho_2_0.1), the codec, its params as sorted json, the file and that file's generate_metrics fields as json.
+WAL mode plus a busy timeout lets concurrent sweeps on one node append without overwriting each other.
+"""
+
+METRICS_DB = os.environ.get("CHGCAR_METRICS_DB", "metrics.db")
+BUSY_TIMEOUT = 60 # seconds
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp REAL NOT NULL,
+    run_id TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    codec TEXT NOT NULL,
+    params TEXT NOT NULL,
+    file TEXT NOT NULL,
+    metrics TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metrics_codec_params ON metrics (codec, params);
+CREATE INDEX IF NOT EXISTS metrics_file ON metrics (file);
+CREATE INDEX IF NOT EXISTS metrics_timestamp ON metrics (timestamp);
+CREATE INDEX IF NOT EXISTS metrics_entry ON metrics (entry);
+"""
+
+
+def connect(db_fn: str = None):
+    conn = sqlite3.connect(db_fn or METRICS_DB, timeout=BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def record_metrics(all_metrics: dict, codec: str, params: dict, entry_name: str = None, db_fn: str = None, timestamp: float = None):
+    # all_metrics is generate_metrics output, {file_no_ext: {metric: value}}, every file lands in one transaction
+    run_id = uuid.uuid4().hex
+    timestamp = time.time() if timestamp is None else timestamp
+    entry_name = entry_name or "_".join([codec, *[str(v) for v in params.values()]])
+    rows = [
+        (timestamp, run_id, entry_name, codec, _params_key(params), file_no_ext, json.dumps(file_metrics, sort_keys=True, default=_json_default))
+        for file_no_ext, file_metrics in all_metrics.items()
+    ]
+
+    conn = connect(db_fn)
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO metrics (timestamp, run_id, entry, codec, params, file, metrics) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    finally:
+        conn.close()
+
+    return run_id
+
+
+def query_metrics(codec: str = None, params: dict = None, file: str = None, entry: str = None, run_id: str = None,
+                  since: float = None, until: float = None, latest: bool = False, db_fn: str = None):
+    # params matches on the given keys only, latest keeps the newest row per (entry, file)
+    clauses, args = [], []
+    for column, value in [("codec", codec), ("file", file), ("entry", entry), ("run_id", run_id)]:
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            args.append(value)
+    for key, value in (params or {}).items():
+        clauses.append("json_extract(params, ?) = ?")
+        args += [f"$.{key}", value]
+    if since is not None:
+        clauses.append("timestamp >= ?")
+        args.append(since)
+    if until is not None:
+        clauses.append("timestamp < ?")
+        args.append(until)
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    query = f"SELECT * FROM metrics {where} ORDER BY timestamp, id"
+    if latest:
+        query = f"SELECT * FROM ({query}) GROUP BY entry, file HAVING id = MAX(id) ORDER BY timestamp, id"
+
+    conn = connect(db_fn)
+    try:
+        rows = conn.execute(query, args).fetchall()
+    finally:
+        conn.close()
+
+    return [
+        {"timestamp": row["timestamp"], "run_id": row["run_id"], "entry": row["entry"], "codec": row["codec"],
+         "params": json.loads(row["params"]), "file": row["file"], "metrics": json.loads(row["metrics"])}
+        for row in rows
+    ]
+
+
+def export_metrics(db_fn: str = None, **filters):
+    # Same {entry: {file_no_ext: metrics}} layout metrics.json had, the newest run wins per entry and file
+    exported = {}
+    for row in query_metrics(latest=True, db_fn=db_fn, **filters):
+        exported.setdefault(row["entry"], {})[row["file"]] = row["metrics"]
+    return exported
+
+
+def export_metrics_json(output_file: str, db_fn: str = None, **filters):
+    tmp_fn = f"{output_file}.{os.getpid()}.tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump(export_metrics(db_fn, **filters), f, sort_keys=True, indent=4)
+    os.replace(tmp_fn, output_file)
+
+
+def _params_key(params: dict):
+    return json.dumps(params, sort_keys=True, default=_json_default)
+
+
+def _json_default(value):
+    # numpy scalars from the metric functions
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def main():
+    output_file = sys.argv[1] if len(sys.argv) > 1 else "metrics.json"
+    codec = sys.argv[2] if len(sys.argv) > 2 else None
+
+    export_metrics_json(output_file, codec=codec)
+    print(f"Exported {METRICS_DB} to {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import os
+import numpy as np
+
+from utils import grid_analysis
+
+"""
+Joint coding of the charge (total) and mag (diff) grids, a basis change in front of the sz3 and tthresh codecs
+
+Environment:
+CHGCAR_SPIN_BASIS = independent/updown/predict/auto (default independent)
+    updown: the codec gets spin up (total + diff) / 2 and spin down (total - diff) / 2
+    predict: the codec gets charge and the residual of mag against a local linear fit a * charge + b (fitted per block,
+             interpolated between blocks) evaluated on the decompressed charge, so the decoder makes the same prediction
+    auto: per file, whichever of the three a strided sample estimates to take the fewest bits
+    every basis falls back to independent on a file with a zero bound or a mag grid grid_analysis describes
+CHGCAR_SPIN_BLOCK = edge length of the predict blocks (default 16)
+CHGCAR_SPIN_SAMPLE_STRIDE = stride of the auto sample along each axis (default 2)
+
+Bounds are per original grid in the codec's own norm (sz3 max abs error, tthresh rms), both obey the triangle inequality.
+total = up + down and diff = up - down both carry the up error plus the down error, so up is coded with half the smaller
+bound and down with what the realized up error leaves of it. The residual gets the mag bound as is, since mag minus the
+residual is exactly the decoder's prediction.
+The basis travels with the mag payload as {"payload": codec payload, "basis": descriptor} and is stored as the
+mag_basis (json) and mag_basis_coefficients sections, so it counts towards the mag size.
+
+pyrho and neurcomp code charge and mag independently: neither takes an error bound the basis could divide (pyrho has a
+dims divisor, neurcomp a compression ratio it trains towards), and predict would need a trained network's output before
+the mag grid is coded. compress_pipeline compresses charge and mag as separate section tasks, which updown and predict
+couple, so it stays independent as well.
+"""
+
+SPIN_BASIS = os.environ.get("CHGCAR_SPIN_BASIS", "independent")
+SPIN_BLOCK = int(os.environ.get("CHGCAR_SPIN_BLOCK", 16))
+SAMPLE_STRIDE = int(os.environ.get("CHGCAR_SPIN_SAMPLE_STRIDE", 2))
+# Names of the two grids each basis hands the codec, for traces
+COMPONENT_NAMES = {"independent": ["charge", "mag"], "updown": ["up", "down"], "predict": ["charge", "residual"]}
+COEFFICIENT_DTYPE = np.dtype(np.float32)
+
+
+def encode(charge: np.ndarray, mag: np.ndarray, bounds: list[float], compress, decompress, error, basis: str = None):
+    # compress(grids, bounds, names) returns their payloads, decompress(payload) a grid, error(grid, decompressed) their
+    # distance in the codec's norm, returns the charge and mag slot payloads
+    basis = basis or SPIN_BASIS
+    if basis != "independent" and not can_transform(mag, bounds):
+        basis = "independent"
+    if basis == "auto":
+        basis = choose_basis(charge, mag, bounds)
+    names = COMPONENT_NAMES[basis]
+
+    if basis == "updown":
+        up, down = to_updown(charge, mag)
+        bound = min(bounds)
+        first, = compress([up], [bound / 2], names[:1])
+        # The codec keeps up within half the bound, the max only guards against rounding
+        second, = compress([down], [max(bound - error(up, decompress(first)), bound / 2)], names[1:])
+        return first, join(second, {"basis": "updown"})
+
+    if basis == "predict":
+        coefficients = fit_prediction(charge, mag, SPIN_BLOCK)
+        first, = compress([charge], [bounds[0]], names[:1])
+        residual = mag - predict(decompress(first), coefficients, SPIN_BLOCK)
+        second, = compress([residual], [bounds[1]], names[1:])
+        return first, join(second, {"basis": "predict", "block": SPIN_BLOCK, "coefficients": coefficients})
+
+    first, second = compress([charge, mag], list(bounds), names)
+    return first, second
+
+def inverse(first: np.ndarray, second: np.ndarray, descriptor: dict, positions: list[np.ndarray] = None):
+    # positions are the per-axis grid indices first and second were read at, for partial reads
+    if descriptor["basis"] == "updown":
+        return first + second, first - second
+    if descriptor["basis"] == "predict":
+        return first, second + predict(first, descriptor["coefficients"], descriptor["block"], positions)
+    return first, second
+
+
+def to_updown(charge: np.ndarray, mag: np.ndarray):
+    return (charge + mag) / 2, (charge - mag) / 2
+
+
+def fit_prediction(charge: np.ndarray, mag: np.ndarray, block: int):
+    # Least squares mag ~ a * charge + b in every block, [blocks x, blocks y, blocks z, (a, b)]
+    charge, mag = charge.astype(np.float64), mag.astype(np.float64)
+    lengths = [np.diff(np.append(np.arange(0, dim, block), dim)) for dim in charge.shape]
+    count = lengths[0][:, None, None] * lengths[1][None, :, None] * lengths[2][None, None, :]
+
+    mean_charge, mean_mag = _block_sums(charge, block) / count, _block_sums(mag, block) / count
+    var_charge = _block_sums(charge * charge, block) / count - mean_charge ** 2
+    cov = _block_sums(charge * mag, block) / count - mean_charge * mean_mag
+    # Flat blocks carry no slope, their mag is left to the intercept
+    flat = var_charge <= 1e-12 * np.maximum(mean_charge ** 2, np.finfo(np.float64).tiny)
+    slope = np.divide(cov, var_charge, out=np.zeros_like(cov), where=~flat)
+
+    return np.stack([slope, mean_mag - slope * mean_charge], axis=-1).astype(COEFFICIENT_DTYPE)
+
+def predict(charge: np.ndarray, coefficients: np.ndarray, block: int, positions: list[np.ndarray] = None):
+    # The fits sit at the block centres and are interpolated periodically between them, so the residual has no seams
+    # at block edges. Built a block of x planes at a time to keep the expanded coefficients small
+    positions = positions or [np.arange(dim) for dim in charge.shape]
+
+    prediction = np.empty_like(charge)
+    for start in range(0, len(positions[0]), block):
+        rows = slice(start, start + block)
+        local = _interpolate(coefficients, positions[0][rows], block, 0)
+        local = _interpolate(local, positions[1], block, 1)
+        local = _interpolate(local, positions[2], block, 2)
+        prediction[rows] = local[..., 0] * charge[rows] + local[..., 1]
+    return prediction
+
+def _interpolate(coefficients: np.ndarray, positions: np.ndarray, block: int, axis: int):
+    centres = (positions + 0.5) / block - 0.5
+    low = np.floor(centres).astype(np.int64)
+    weight = (centres - low).reshape([-1 if a == axis else 1 for a in range(coefficients.ndim)])
+    n_blocks = coefficients.shape[axis]
+    return np.take(coefficients, low % n_blocks, axis=axis) * (1 - weight) + np.take(coefficients, (low + 1) % n_blocks, axis=axis) * weight
+
+def _block_sums(values: np.ndarray, block: int):
+    for axis in range(3):
+        values = np.add.reduceat(values, np.arange(0, values.shape[axis], block), axis=axis)
+    return values
+
+
+def can_transform(mag: np.ndarray, bounds: list[float]):
+    # A zero bound asks for an exact grid, which neither transform can keep, and a mag grid grid_analysis describes within
+    # its bound (non-spin-polarized files, noise of non-magnetic ISPIN=2 runs) is already nearly free, where either
+    # transform would send it through the codec
+    return min(bounds) > 0 and grid_analysis.analyze_grid(mag, bounds[1]) is None
+
+def choose_basis(charge: np.ndarray, mag: np.ndarray, bounds: list[float]):
+    if not can_transform(mag, bounds):
+        return "independent"
+
+    sample = tuple(slice(None, None, SAMPLE_STRIDE) for _ in range(3))
+    charge_sample, mag_sample = charge[sample], mag[sample]
+    up, down = to_updown(charge_sample, mag_sample)
+    sample_block = max(1, SPIN_BLOCK // SAMPLE_STRIDE)
+    residual = mag_sample - predict(charge_sample, fit_prediction(charge_sample, mag_sample, sample_block), sample_block)
+
+    charge_bits = estimate_bits(charge_sample, bounds[0])
+    n_blocks = np.prod([-(-dim // SPIN_BLOCK) for dim in charge.shape])
+    bits = {
+        "independent": charge_bits + estimate_bits(mag_sample, bounds[1]),
+        "updown": estimate_bits(up, min(bounds) / 2) + estimate_bits(down, min(bounds) / 2),
+        "predict": charge_bits + estimate_bits(residual, bounds[1]) + 8 * 2 * COEFFICIENT_DTYPE.itemsize * n_blocks / charge.size,
+    }
+    # Ties keep the grids as they are
+    return min(bits, key=bits.get)
+
+def estimate_bits(grid: np.ndarray, bound: float):
+    # Bits per value of an error bounded predictive coder, from the 3D Lorenzo prediction residual
+    residual = np.diff(np.diff(np.diff(grid, axis=0), axis=1), axis=2)
+    return float(np.mean(np.log2(1 + np.abs(residual) / (2 * bound))))
+
+
+def join(payload, descriptor: dict):
+    if descriptor["basis"] == "independent":
+        return payload
+    return {"payload": payload, "basis": descriptor}
+
+def split(payload):
+    # Payloads from the pipeline or older containers carry no basis
+    if isinstance(payload, dict) and "basis" in payload:
+        return payload["payload"], payload["basis"]
+    return payload, {"basis": "independent"}
+
+
+def container_components(section: str, descriptor: dict):
+    if descriptor["basis"] == "independent":
+        return []
+    components = [{"name": f"{section}_basis", "kind": "json", "payload": {key: value for key, value in descriptor.items() if key != "coefficients"}}]
+    if "coefficients" in descriptor:
+        components.append({"name": f"{section}_basis_coefficients", "kind": "ndarray", "payload": descriptor["coefficients"], "encoding": "auto"})
+    return components
+
+def component_names(toc: dict, section: str):
+    stored = {entry["name"] for entry in toc["sections"]}
+    return [name for name in [f"{section}_basis", f"{section}_basis_coefficients"] if name in stored]
+
+def from_container(sections: dict, section: str):
+    if f"{section}_basis" not in sections:
+        return {"basis": "independent"}
+    descriptor = dict(sections[f"{section}_basis"])
+    if f"{section}_basis_coefficients" in sections:
+        descriptor["coefficients"] = sections[f"{section}_basis_coefficients"]
+    return descriptor
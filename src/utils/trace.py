@@ -0,0 +1,170 @@
+import atexit
+from contextlib import nullcontext
+import functools
+import json
+import os
+import threading
+from time import perf_counter_ns
+import tracemalloc
+
+from utils import memory
+
+"""
+Environment:
+CHGCAR_TRACE = Chrome trace json written at exit (default unset, tracing disabled)
+CHGCAR_TRACE_MEMORY = 1 adds rss/peak rss deltas to every span, tracemalloc also traces python allocations (default unset)
+
+Spans are Chrome trace complete events ("ph": "X") with pid/tid, open them with
+    with trace.span("name", file=file_no_ext, component="charge"): ...
+or decorate a function with @trace.traced("name"). file tags the span and every span nested in it on the same thread,
+pop_file_events/summarize turn a file's spans into {"trace_{name}_duration": seconds} for the per-file metrics,
+plus {"memory_{name}_peak_rss_delta_mb": largest peak over the rss at span start} when memory is traced.
+The file loads in chrome://tracing and ui.perfetto.dev. Disabled, span returns one shared no-op context manager.
+"""
+
+TRACE_FILE = os.environ.get("CHGCAR_TRACE")
+TRACE_MEMORY = os.environ.get("CHGCAR_TRACE_MEMORY")
+
+_enabled = False
+_memory = False
+_events = []
+_lock = threading.Lock()
+_local = threading.local()
+_NULL_SPAN = nullcontext()
+
+
+def enable(trace_file: str = None, memory_mode: str = None):
+    # memory_mode is None, "rss" or "tracemalloc", spans are recorded even without a trace file to write
+    global _enabled, _memory, TRACE_FILE
+    TRACE_FILE = trace_file or TRACE_FILE
+    if not _enabled:
+        atexit.register(_write_at_exit)
+    _enabled = True
+    _memory = memory_mode is not None
+    if memory_mode == "tracemalloc" and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    global _enabled, _memory
+    _enabled, _memory = False, False
+
+def is_enabled():
+    return _enabled
+
+
+def span(name: str, file: str = None, **args):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, file, args)
+
+def traced(name: str = None):
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*func_args, **func_kwargs):
+            if not _enabled:
+                return func(*func_args, **func_kwargs)
+            with _Span(span_name, None, {}):
+                return func(*func_args, **func_kwargs)
+        return wrapper
+    return decorator
+
+
+def bind_file(func):
+    # Carries the calling thread's file tag into executor threads, so their spans still land in that file's summary
+    file = getattr(_local, "file", None)
+    if not _enabled or file is None:
+        return func
+
+    @functools.wraps(func)
+    def bound(*args, **kwargs):
+        previous_file = getattr(_local, "file", None)
+        _local.file = file
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.file = previous_file
+    return bound
+
+
+class _Span:
+    __slots__ = ("name", "file", "args", "start", "previous_file", "measurement")
+
+    def __init__(self, name: str, file: str, args: dict):
+        self.name, self.file, self.args = name, file, args
+
+    def __enter__(self):
+        self.previous_file = getattr(_local, "file", None)
+        if self.file is not None:
+            _local.file = self.file
+        self.measurement = memory.begin() if _memory else None
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = perf_counter_ns()
+        file = self.file if self.file is not None else self.previous_file
+        _local.file = self.previous_file
+
+        args = {key: value if isinstance(value, (int, float, str, bool)) else str(value) for key, value in self.args.items()}
+        if file is not None:
+            args["file"] = file
+        if exc[0] is not None:
+            args["error"] = exc[0].__name__
+        if self.measurement is not None:
+            args.update(memory.end(self.measurement))
+        event = {"name": self.name, "ph": "X", "ts": self.start / 1000, "dur": (end - self.start) / 1000,
+                 "pid": os.getpid(), "tid": threading.get_native_id(), "args": args}
+        with _lock:
+            _events.append(event)
+        return False
+
+
+def pop_file_events(file_no_ext: str):
+    # Events carry plain data, so they travel back from process workers with the result
+    global _events
+    if not _enabled:
+        return []
+    with _lock:
+        popped = [event for event in _events if event["args"].get("file") == file_no_ext]
+        _events = [event for event in _events if event["args"].get("file") != file_no_ext]
+    return popped
+
+def add_events(events: list):
+    if not events:
+        return
+    with _lock:
+        _events.extend(events)
+
+def summarize(events: list):
+    # Inclusive time per span name, nested spans count towards their parents as well
+    summary = {}
+    for event in events:
+        key = f"trace_{event['name']}_duration"
+        summary[key] = summary.get(key, 0.0) + event["dur"] / 1e6
+        for stat in ("peak_rss_delta_mb", "tracemalloc_peak_delta_mb"):
+            if stat in event["args"]:
+                key = f"memory_{event['name']}_{stat}"
+                summary[key] = max(summary.get(key, 0.0), event["args"][stat])
+    return summary
+
+
+def write_trace(trace_file: str = None):
+    trace_file = trace_file or TRACE_FILE
+    with _lock:
+        events = list(_events)
+
+    metadata = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": f"chgcar {pid}"}} for pid in sorted({event["pid"] for event in events})]
+    tmp_fn = f"{trace_file}.{os.getpid()}.tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp_fn, trace_file)
+
+def _write_at_exit():
+    if _enabled and TRACE_FILE:
+        write_trace()
+
+
+if TRACE_FILE or TRACE_MEMORY:
+    enable(memory_mode=None if not TRACE_MEMORY else "tracemalloc" if TRACE_MEMORY == "tracemalloc" else "rss")